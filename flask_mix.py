@@ -1,19 +1,39 @@
 # app_flask_combinado.py - API combinada SUNARP y SCPPP
-from flask import Flask, request, jsonify
+from __future__ import annotations
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_mysqldb import MySQL
 from datetime import datetime
 import os
+import sys
+import socket
 import time
 import re
-import google.generativeai as genai
-from seleniumbase import SB
+import json
 from PIL import Image
 import requests
-import easyocr
 from io import BytesIO
-from bs4 import BeautifulSoup
+import base64
+from typing import Union, TYPE_CHECKING
+from dataclasses import dataclass, fields
 import urllib3 
-import numpy as np
+import threading
+import queue
+import atexit
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+import uuid
+import math
+import importlib
+import tracemalloc
+import resource
+import struct
+import socketserver
+import subprocess
+
+if TYPE_CHECKING:
+    import numpy as np   # Solo para las anotaciones: en ejecución se carga con obtener_numpy()
 
 app = Flask(__name__)
 
@@ -30,36 +50,788 @@ mysql = MySQL(app)
 # SECCIÓN 1: CONFIGURACIÓN Y UTILIDADES COMUNES
 # ==============================================
 
+# --- MODOS DE DESPLIEGUE ---
+# completo: un solo proceso atiende la API y hace el scraping
+# api:      CRUD, estadísticas y caché; las consultas nuevas se encolan en trabajos_consulta
+# scraper:  consume trabajos_consulta (Chrome, EasyOCR, Gemini) y no atiende la API
+# completo y api se eligen con "python flask_mix.py api" o con la variable FLASK_MIX_MODO
+# (gunicorn). Un scraper no es un servidor web: solo arranca con "python flask_mix.py scraper".
+MODOS_DESPLIEGUE = ("completo", "api", "scraper")
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in ("api", "scraper"):
+    MODO_DESPLIEGUE = sys.argv[1]
+else:
+    MODO_DESPLIEGUE = os.environ.get("FLASK_MIX_MODO", "completo")
+    if MODO_DESPLIEGUE == "scraper":
+        raise ValueError('FLASK_MIX_MODO=scraper no consume trabajos_consulta: use "python flask_mix.py scraper"')
+if MODO_DESPLIEGUE not in MODOS_DESPLIEGUE:
+    raise ValueError(f"FLASK_MIX_MODO inválido: {MODO_DESPLIEGUE} (use {', '.join(MODOS_DESPLIEGUE)})")
+
+# Límites propios de cada tipo de proceso (cada lado se escala por separado)
+LIMITES_MODO = {
+    'api': {
+        # Un proceso api nunca carga estas dependencias
+        'modulos_prohibidos': ('seleniumbase', 'easyocr', 'google.generativeai'),
+    },
+    'scraper': {
+        'hilos': 2,              # Consultas simultáneas por proceso
+        'rss_max_mb': 3072,      # Proceso + Chrome/chromedriver; al superarlo termina los trabajos en curso y sale (el supervisor lo reinicia)
+        'trabajos_max': 500,     # Trabajos por proceso antes de reiniciarse
+    },
+}
+
+def _procesos_descendientes(pid: int) -> list:
+    """PIDs de los hijos, nietos, etc. de 'pid' (chromedriver lanza Chrome y sus renderers)"""
+    hijos = {}
+    for entrada in os.listdir('/proc'):
+        if not entrada.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entrada}/stat') as f:
+                # El nombre del proceso va entre paréntesis y puede contener espacios
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        hijos.setdefault(ppid, []).append(int(entrada))
+    
+    descendientes = []
+    pendientes = [pid]
+    while pendientes:
+        for hijo in hijos.get(pendientes.pop(), []):
+            descendientes.append(hijo)
+            pendientes.append(hijo)
+    return descendientes
+
+def rss_actual_mb() -> float:
+    """Memoria residente actual del proceso y de sus descendientes (navegadores incluidos)"""
+    pagina = os.sysconf('SC_PAGE_SIZE')
+    try:
+        with open('/proc/self/statm') as f:
+            total = int(f.read().split()[1]) * pagina
+    except (OSError, ValueError):
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    
+    for pid in _procesos_descendientes(os.getpid()):
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * pagina
+        except (OSError, ValueError):
+            continue    # El proceso terminó mientras se recorría /proc
+    return total / 1024 / 1024
+
+# --- DEPENDENCIAS PESADAS (CARGA DIFERIDA) ---
+# seleniumbase, easyocr (torch), google.generativeai, bs4 y numpy se importan recién
+# cuando una consulta los necesita; un proceso que solo lee la base de datos no los carga.
+_modulos_diferidos = {}
+_modulos_lock = threading.RLock()
+
+def importar_diferido(nombre: str):
+    """Importa el módulo la primera vez que se pide y lo reutiliza después"""
+    modulo = _modulos_diferidos.get(nombre)
+    if modulo is not None:
+        return modulo
+    if nombre in LIMITES_MODO['api']['modulos_prohibidos'] and MODO_DESPLIEGUE == "api":
+        raise RuntimeError(f"El proceso api no carga {nombre}: las consultas las resuelve el proceso scraper")
+    with _modulos_lock:
+        if nombre not in _modulos_diferidos:
+            inicio = time.perf_counter()
+            _modulos_diferidos[nombre] = importlib.import_module(nombre)
+            print(f"📦 {nombre} importado en {time.perf_counter() - inicio:.2f}s")
+        return _modulos_diferidos[nombre]
+
+def obtener_numpy():
+    return importar_diferido('numpy')
+
+def obtener_clase_sb():
+    return importar_diferido('seleniumbase').SB
+
+def analizar_html(html_content: str):
+    """BeautifulSoup con html.parser"""
+    return importar_diferido('bs4').BeautifulSoup(html_content, 'html.parser')
+
 # --- CONFIGURACIÓN GEMINI API ---
 GEMINI_API_KEY = "TU_API_KEY_AQUÍ"
-if not GEMINI_API_KEY or GEMINI_API_KEY == "TU_API_KEY_AQUÍ":
-    print("❌ ERROR: Configura tu API Key de Gemini")
-    print("1. Obtén una API Key en: https://makersuite.google.com/app/apikey")
-    print("2. Reemplaza 'TU_API_KEY_AQUÍ' con tu clave")
-    exit(1)
-
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    print("✅ Gemini API configurada correctamente")
-except Exception as e:
-    print(f"❌ Error configurando Gemini: {e}")
-    exit(1)
+_gemini_configurado = False
+
+def obtener_genai():
+    """google.generativeai configurado con la API Key (se configura en el primer uso)"""
+    global _gemini_configurado
+    with _modulos_lock:
+        if not _gemini_configurado:
+            if not GEMINI_API_KEY or GEMINI_API_KEY == "TU_API_KEY_AQUÍ":
+                print("❌ ERROR: Configura tu API Key de Gemini")
+                print("1. Obtén una API Key en: https://makersuite.google.com/app/apikey")
+                print("2. Reemplaza 'TU_API_KEY_AQUÍ' con tu clave")
+                raise RuntimeError("API Key de Gemini no configurada")
+            importar_diferido('google.generativeai').configure(api_key=GEMINI_API_KEY)
+            _gemini_configurado = True
+            print("✅ Gemini API configurada correctamente")
+        return importar_diferido('google.generativeai')
 
 # --- CONFIGURACIÓN SCPPP ---
 URL_BASE_SCPPP = "https://scppp.mtc.gob.pe/"
 
-# Inicializar EasyOCR (solo una vez)
-print("🔧 Inicializando EasyOCR...")
-reader = easyocr.Reader(['en'], gpu=False)
-print("✅ EasyOCR listo\n")
+# --- CONFIGURACIÓN OCR ---
+# Con OCR_SERVIDOR_ACTIVO los procesos web no cargan EasyOCR/torch: le piden el OCR a
+# un único proceso "python flask_mix.py ocr-servidor" a través de un socket Unix.
+OCR_SERVIDOR_ACTIVO = False
+OCR_SOCKET = "/tmp/flask_mix_ocr.sock"
+OCR_TIMEOUT = 15            # s máximos esperando la respuesta del servidor OCR
+OCR_LOTE_ESPERA = 0.02      # s que el servidor espera por más imágenes antes de lanzar la inferencia
+OCR_LOTE_MAX = 16           # Imágenes máximas por inferencia
+OCR_LOTE_TIMEOUT = 10       # s que el servidor espera un lote antes de leer la imagen por su cuenta (< OCR_TIMEOUT)
+
+reader = None
+_reader_lock = threading.Lock()   # Distinto de _modulos_lock: construir el lector puede tardar
+
+def obtener_lector_easyocr():
+    """Crea el lector de EasyOCR la primera vez que se necesita (solo una vez por proceso)"""
+    global reader
+    with _reader_lock:
+        if reader is None:
+            print("🔧 Inicializando EasyOCR...")
+            reader = importar_diferido('easyocr').Reader(['en'], gpu=False)
+            print("✅ EasyOCR listo\n")
+        return reader
 
 # Deshabilitar advertencias SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# --- POLÍTICA DE CACHÉ DE CONSULTAS ---
+CACHE_MAX_EDAD_LIMITE = 30 * 24 * 3600   # Tope (s) de 'max_age_seconds' antes de llegar al INTERVAL de MySQL
+
+def leer_politica_cache(data: dict, max_edad_defecto: int) -> tuple:
+    """Lee 'max_age_seconds' y 'force_refresh' del cuerpo de la petición. Devuelve (max_edad, forzar)"""
+    max_edad = data.get('max_age_seconds', max_edad_defecto)
+    if isinstance(max_edad, bool) or not isinstance(max_edad, (int, float, str)):
+        raise ValueError('"max_age_seconds" debe ser un número de segundos')
+    try:
+        max_edad = int(max_edad)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('"max_age_seconds" debe ser un número de segundos')
+    if max_edad < 0:
+        raise ValueError('"max_age_seconds" no puede ser negativo')
+    max_edad = min(max_edad, CACHE_MAX_EDAD_LIMITE)
+    
+    forzar = data.get('force_refresh', False)
+    if isinstance(forzar, str):
+        forzar = forzar.strip().lower() in ('1', 'true', 'si', 'sí', 'yes')
+    return max_edad, bool(forzar)
+
+class CacheMemoria:
+    """Caché en proceso con marca de tiempo por entrada y tamaño acotado (LRU).
+    
+    'ttl' limita cuánto vive una entrada en memoria desde que se guardó, aparte de la edad del dato.
+    """
+    def __init__(self, max_entradas: int, ttl: float = None):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def guardar(self, clave, valor, guardado_en: float = None):
+        with self._lock:
+            self._entradas[clave] = (guardado_en or time.time(), time.time(), valor)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def obtener(self, clave, max_edad: int):
+        """Devuelve (valor, edad_segundos) si la entrada existe y no supera max_edad ni el ttl"""
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if not entrada:
+                return None
+            ahora = time.time()
+            if self.ttl is not None and ahora - entrada[1] > self.ttl:
+                del self._entradas[clave]
+                return None
+            edad = ahora - entrada[0]
+            if edad > max_edad:
+                return None
+            self._entradas.move_to_end(clave)
+            return entrada[2], int(edad)
+
+    def invalidar(self, clave):
+        with self._lock:
+            self._entradas.pop(clave, None)
+
+    def __len__(self):
+        return len(self._entradas)
+
+# --- TRABAJOS ASÍNCRONOS ---
+TRABAJOS_MAX_WORKERS = 4          # Scrapings simultáneos ejecutados por el pool de trabajos
+TRABAJOS_MAX_PENDIENTES = 100     # Trabajos en cola + ejecutándose antes de responder 503
+TRABAJOS_RETENCION = 3600         # Segundos que se conserva un trabajo terminado
+
+class TrabajosSaturadosError(Exception):
+    """La cola de trabajos asíncronos está llena"""
+
+_contexto_trabajo = threading.local()
+
+def reportar_etapa(etapa: str):
+    """Registra la etapa actual en el trabajo asíncrono que corre en este hilo (si lo hay)"""
+    reportar = getattr(_contexto_trabajo, 'reportar', None)
+    if reportar is not None:
+        try:
+            reportar(etapa)
+        except Exception as e:
+            print(f"⚠️ Error registrando etapa '{etapa}': {e}")
+
+class GestorTrabajos:
+    """Trabajos en memoria ejecutados por un pool acotado de hilos"""
+    def __init__(self, max_workers: int, max_pendientes: int, retencion: int):
+        self.max_pendientes = max_pendientes
+        self.retencion = retencion
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="trabajo")
+        self._trabajos = {}
+        self._lock = threading.Lock()
+        self.max_workers = max_workers
+
+    def _purgar(self):
+        limite = time.time() - self.retencion
+        for trabajo_id in [t['id'] for t in self._trabajos.values()
+                           if t['_terminado'] and t['_terminado'] < limite]:
+            del self._trabajos[trabajo_id]
+
+    def _activos(self) -> int:
+        return sum(1 for t in self._trabajos.values() if t['estado'] in ('en_cola', 'ejecutando'))
+
+    def crear(self, fuente: str, funcion, parametros: dict) -> dict:
+        with self._lock:
+            self._purgar()
+            if self._activos() >= self.max_pendientes:
+                raise TrabajosSaturadosError(f"Hay {self.max_pendientes} trabajos pendientes, intente más tarde")
+            trabajo = {
+                'id': uuid.uuid4().hex,
+                'fuente': fuente,
+                'estado': 'en_cola',
+                'parametros': parametros,
+                'creado_en': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'iniciado_en': None,
+                'terminado_en': None,
+                'etapa_actual': None,
+                'etapas': [],
+                'resultado': None,
+                'codigo_http': None,
+                'error': None,
+                '_inicio': None,
+                '_fin': None,
+                '_terminado': None
+            }
+            self._trabajos[trabajo['id']] = trabajo
+        self._executor.submit(self._ejecutar, trabajo, funcion)
+        return trabajo
+
+    def _cerrar_etapa(self, trabajo: dict, ahora: float):
+        if trabajo['etapas'] and trabajo['etapas'][-1]['segundos'] is None:
+            anterior = trabajo['etapas'][-1]
+            anterior['segundos'] = round(ahora - trabajo['_inicio'] - anterior['inicio'], 3)
+
+    def marcar_etapa(self, trabajo: dict, etapa: str):
+        ahora = time.perf_counter()
+        with self._lock:
+            self._cerrar_etapa(trabajo, ahora)
+            trabajo['etapas'].append({
+                'etapa': etapa,
+                'inicio': round(ahora - trabajo['_inicio'], 3),
+                'segundos': None
+            })
+            trabajo['etapa_actual'] = etapa
+
+    def _ejecutar(self, trabajo: dict, funcion):
+        with self._lock:
+            trabajo['estado'] = 'ejecutando'
+            trabajo['iniciado_en'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            trabajo['_inicio'] = time.perf_counter()
+        _contexto_trabajo.reportar = lambda etapa: self.marcar_etapa(trabajo, etapa)
+        try:
+            respuesta, codigo = funcion(**trabajo['parametros'])
+            estado, error = ('completado' if respuesta.get('success') else 'fallido'), respuesta.get('error')
+        except Exception as e:
+            print(f"❌ Error en trabajo {trabajo['id']}: {e}")
+            respuesta, codigo, estado, error = None, 500, 'fallido', str(e)
+        finally:
+            _contexto_trabajo.reportar = None
+        
+        with self._lock:
+            trabajo['_fin'] = time.perf_counter()
+            self._cerrar_etapa(trabajo, trabajo['_fin'])
+            trabajo['etapa_actual'] = None
+            trabajo['resultado'] = respuesta
+            trabajo['codigo_http'] = codigo
+            trabajo['error'] = error
+            trabajo['estado'] = estado
+            trabajo['terminado_en'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            trabajo['_terminado'] = time.time()
+
+    def obtener(self, trabajo_id: str) -> dict:
+        with self._lock:
+            trabajo = self._trabajos.get(trabajo_id)
+            if not trabajo:
+                return None
+            copia = {k: v for k, v in trabajo.items() if not k.startswith('_')}
+            copia['etapas'] = [dict(e) for e in trabajo['etapas']]
+            if trabajo['_inicio'] is not None:
+                fin = trabajo['_fin'] or time.perf_counter()
+                copia['segundos'] = round(fin - trabajo['_inicio'], 3)
+            return copia
+
+    def estado(self) -> dict:
+        with self._lock:
+            por_estado = {}
+            for t in self._trabajos.values():
+                por_estado[t['estado']] = por_estado.get(t['estado'], 0) + 1
+            return {
+                'max_workers': self.max_workers,
+                'max_pendientes': self.max_pendientes,
+                'por_estado': por_estado
+            }
+
+gestor_trabajos = GestorTrabajos(TRABAJOS_MAX_WORKERS, TRABAJOS_MAX_PENDIENTES, TRABAJOS_RETENCION)
+
+# --- COLA DURABLE DE TRABAJOS EN MYSQL ---
+# "memoria": hilos de este proceso | "mysql": tabla trabajos_consulta + workers (obligatorio al separar api/scraper)
+TRABAJOS_BACKEND = "memoria" if MODO_DESPLIEGUE == "completo" else "mysql"
+COLA_VISIBILIDAD = 300             # s: si el worker no termina ni reporta progreso, el trabajo vuelve a la cola
+COLA_MAX_INTENTOS = 3              # Intentos antes de mandar el trabajo a 'dead_letter'
+COLA_ESPERA_REINTENTO = 30         # s de espera base entre reintentos (se multiplica por el intento)
+COLA_SONDEO = 1.0                  # s entre sondeos cuando no hay trabajos disponibles
+
+class ColaTrabajosMySQL:
+    """Cola de trabajos persistida en trabajos_consulta; los workers de cualquier nodo la consumen con SKIP LOCKED"""
+    def __init__(self):
+        self._funciones = {}
+
+    def registrar_funcion(self, fuente: str, funcion):
+        """funcion(**parametros) -> (respuesta, código HTTP)"""
+        self._funciones[fuente] = funcion
+
+    def encolar(self, fuente: str, parametros: dict) -> dict:
+        trabajo_id = uuid.uuid4().hex
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            cur.execute("""
+                INSERT INTO trabajos_consulta (id, fuente, parametros, max_intentos, etapas)
+                VALUES (%s, %s, %s, %s, '[]')
+            """, (trabajo_id, fuente, json.dumps(parametros), COLA_MAX_INTENTOS))
+            mysql.connection.commit()
+            cur.close()
+        return {'id': trabajo_id, 'estado': 'en_cola'}
+
+    def reclamar(self) -> dict:
+        """Toma el siguiente trabajo visible (en cola, o ejecutándose con la visibilidad vencida)"""
+        with app.app_context():
+            conexion = mysql.connection
+            cur = conexion.cursor()
+            try:
+                while True:
+                    cur.execute("""
+                        SELECT id, fuente, parametros, intentos, max_intentos
+                        FROM trabajos_consulta
+                        WHERE estado IN ('en_cola', 'ejecutando') AND visible_desde <= NOW()
+                        ORDER BY created_at
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    """)
+                    trabajo = cur.fetchone()
+                    if not trabajo:
+                        conexion.commit()
+                        return None
+                    
+                    if trabajo['intentos'] >= trabajo['max_intentos']:
+                        # El último worker que lo tomó nunca terminó: se descarta
+                        cur.execute("""
+                            UPDATE trabajos_consulta
+                            SET estado = 'dead_letter', etapa_actual = NULL, terminado_en = NOW(),
+                                error = COALESCE(error, 'Visibilidad vencida en el último intento')
+                            WHERE id = %s
+                        """, (trabajo['id'],))
+                        conexion.commit()
+                        print(f"☠️ Trabajo {trabajo['id']} enviado a dead_letter")
+                        continue
+                    
+                    cur.execute("""
+                        UPDATE trabajos_consulta
+                        SET estado = 'ejecutando', intentos = intentos + 1, nodo = %s,
+                            visible_desde = NOW() + INTERVAL %s SECOND,
+                            iniciado_en = NOW(), etapa_actual = NULL, etapas = '[]'
+                        WHERE id = %s
+                    """, (NODO_ID, COLA_VISIBILIDAD, trabajo['id']))
+                    conexion.commit()
+                    trabajo['intentos'] += 1
+                    trabajo['parametros'] = json.loads(trabajo['parametros'])
+                    trabajo['etapas'] = []
+                    trabajo['_inicio'] = time.perf_counter()
+                    return trabajo
+            except Exception:
+                conexion.rollback()
+                raise
+            finally:
+                cur.close()
+
+    def _actualizar(self, trabajo: dict, sql_set: str, valores: tuple) -> bool:
+        """Actualiza el trabajo solo si este worker sigue siendo su dueño (mismo intento)"""
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            cur.execute(
+                f"UPDATE trabajos_consulta SET {sql_set} "
+                "WHERE id = %s AND intentos = %s AND estado = 'ejecutando'",
+                valores + (trabajo['id'], trabajo['intentos'])
+            )
+            mysql.connection.commit()
+            vigente = cur.rowcount > 0
+            cur.close()
+            return vigente
+
+    def registrar_etapa(self, trabajo: dict, etapa: str):
+        """Guarda la etapa y extiende la visibilidad (latido del worker)"""
+        ahora = round(time.perf_counter() - trabajo['_inicio'], 3)
+        if trabajo['etapas'] and trabajo['etapas'][-1]['segundos'] is None:
+            trabajo['etapas'][-1]['segundos'] = round(ahora - trabajo['etapas'][-1]['inicio'], 3)
+        trabajo['etapas'].append({'etapa': etapa, 'inicio': ahora, 'segundos': None})
+        self._actualizar(
+            trabajo,
+            "etapa_actual = %s, etapas = %s, visible_desde = NOW() + INTERVAL %s SECOND",
+            (etapa, json.dumps(trabajo['etapas']), COLA_VISIBILIDAD)
+        )
+
+    def _cerrar_etapas(self, trabajo: dict) -> str:
+        if trabajo['etapas'] and trabajo['etapas'][-1]['segundos'] is None:
+            ultima = trabajo['etapas'][-1]
+            ultima['segundos'] = round(time.perf_counter() - trabajo['_inicio'] - ultima['inicio'], 3)
+        return json.dumps(trabajo['etapas'])
+
+    def completar(self, trabajo: dict, respuesta: dict, codigo: int):
+        self._actualizar(
+            trabajo,
+            "estado = 'completado', etapa_actual = NULL, etapas = %s, resultado = %s, "
+            "codigo_http = %s, error = NULL, terminado_en = NOW()",
+            (self._cerrar_etapas(trabajo), json.dumps(respuesta, default=str), codigo)
+        )
+
+    def fallar(self, trabajo: dict, error: str, respuesta: dict = None, codigo: int = None):
+        """Reencola con espera creciente o envía a dead_letter si se agotaron los intentos"""
+        resultado = json.dumps(respuesta, default=str) if respuesta is not None else None
+        if trabajo['intentos'] < trabajo['max_intentos']:
+            espera = COLA_ESPERA_REINTENTO * trabajo['intentos']
+            print(f"🔁 Trabajo {trabajo['id']} falló (intento {trabajo['intentos']}), reintento en {espera}s")
+            self._actualizar(
+                trabajo,
+                "estado = 'en_cola', etapa_actual = NULL, etapas = %s, resultado = %s, codigo_http = %s, "
+                "error = %s, visible_desde = NOW() + INTERVAL %s SECOND",
+                (self._cerrar_etapas(trabajo), resultado, codigo, error, espera)
+            )
+        else:
+            print(f"☠️ Trabajo {trabajo['id']} agotó {trabajo['max_intentos']} intentos, enviado a dead_letter")
+            self._actualizar(
+                trabajo,
+                "estado = 'dead_letter', etapa_actual = NULL, etapas = %s, resultado = %s, "
+                "codigo_http = %s, error = %s, terminado_en = NOW()",
+                (self._cerrar_etapas(trabajo), resultado, codigo, error)
+            )
+
+    def procesar_uno(self) -> bool:
+        """Reclama y ejecuta un trabajo. Devuelve False si no había trabajos"""
+        trabajo = self.reclamar()
+        if not trabajo:
+            return False
+        
+        print(f"🛠️ Trabajo {trabajo['id']} ({trabajo['fuente']}) intento {trabajo['intentos']}/{trabajo['max_intentos']}")
+        funcion = self._funciones.get(trabajo['fuente'])
+        if funcion is None:
+            self.fallar(trabajo, f"Fuente desconocida: {trabajo['fuente']}")
+            return True
+        
+        _contexto_trabajo.reportar = lambda etapa: self.registrar_etapa(trabajo, etapa)
+        try:
+            respuesta, codigo = funcion(**trabajo['parametros'])
+        except Exception as e:
+            print(f"❌ Error en trabajo {trabajo['id']}: {e}")
+            self.fallar(trabajo, str(e), codigo=500)
+            return True
+        finally:
+            _contexto_trabajo.reportar = None
+        
+        # Los errores del servidor (CAPTCHA, pool agotado, upstream caído) se reintentan
+        if respuesta.get('success') or codigo < 500:
+            self.completar(trabajo, respuesta, codigo)
+        else:
+            self.fallar(trabajo, respuesta.get('error', 'Error desconocido'), respuesta, codigo)
+        return True
+
+    def ejecutar_worker(self, hilos: int = 1, rss_max_mb: float = None, trabajos_max: int = None):
+        """Bucle de consumo con 'hilos' workers en este proceso.
+        
+        Sin límites no retorna. Al superar rss_max_mb o trabajos_max deja de reclamar,
+        termina los trabajos en curso y retorna para que el supervisor lo reinicie.
+        """
+        detener = threading.Event()
+        lock = threading.Lock()
+        procesados = [0]
+        
+        def bucle():
+            while not detener.is_set():
+                try:
+                    if not self.procesar_uno():
+                        time.sleep(COLA_SONDEO)
+                        continue
+                except Exception as e:
+                    print(f"❌ Error en worker de trabajos: {e}")
+                    time.sleep(COLA_SONDEO * 5)
+                    continue
+                
+                with lock:
+                    procesados[0] += 1
+                    total = procesados[0]
+                if trabajos_max and total >= trabajos_max:
+                    print(f"🔁 Worker alcanzó {trabajos_max} trabajos, reiniciando...")
+                    detener.set()
+                elif rss_max_mb and rss_actual_mb() > rss_max_mb:
+                    print(f"🔁 Worker superó {rss_max_mb} MB de memoria, reiniciando...")
+                    detener.set()
+        
+        print(f"👷 Worker {NODO_ID} consumiendo trabajos_consulta con {hilos} hilo(s)")
+        hilos_worker = [threading.Thread(target=bucle, name=f"worker-{i + 1}") for i in range(hilos)]
+        for hilo in hilos_worker:
+            hilo.start()
+        for hilo in hilos_worker:
+            hilo.join()
+        print(f"👋 Worker {NODO_ID} detenido tras {procesados[0]} trabajos")
+
+    def obtener(self, trabajo_id: str) -> dict:
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            cur.execute("""
+                SELECT id, fuente, parametros, estado, intentos, max_intentos, nodo, etapa_actual,
+                       etapas, resultado, codigo_http, error, created_at, iniciado_en, terminado_en
+                FROM trabajos_consulta WHERE id = %s
+            """, (trabajo_id,))
+            trabajo = cur.fetchone()
+            cur.close()
+        if not trabajo:
+            return None
+        for campo in ('parametros', 'etapas', 'resultado'):
+            trabajo[campo] = json.loads(trabajo[campo]) if trabajo[campo] else None
+        for campo in ('created_at', 'iniciado_en', 'terminado_en'):
+            if trabajo[campo]:
+                trabajo[campo] = trabajo[campo].strftime("%Y-%m-%d %H:%M:%S")
+        trabajo['creado_en'] = trabajo.pop('created_at')
+        return trabajo
+
+    def estado(self) -> dict:
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            cur.execute("SELECT estado, COUNT(*) AS cantidad FROM trabajos_consulta GROUP BY estado")
+            por_estado = {fila['estado']: fila['cantidad'] for fila in cur.fetchall()}
+            cur.close()
+        return {
+            'backend': 'mysql',
+            'visibilidad': COLA_VISIBILIDAD,
+            'max_intentos': COLA_MAX_INTENTOS,
+            'por_estado': por_estado
+        }
+
+cola_trabajos = ColaTrabajosMySQL()
+
+# --- COALESCENCIA DE CONSULTAS IDÉNTICAS (SINGLE-FLIGHT) ---
+class _LlamadaEnVuelo:
+    __slots__ = ('evento', 'resultado', 'error', 'seguidores')
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.error = None
+        self.seguidores = 0
+
+class ConsultasEnVuelo:
+    """Agrupa consultas idénticas simultáneas: la primera ejecuta el scraping y las demás esperan su resultado"""
+    def __init__(self):
+        self._en_vuelo = {}
+        self._lock = threading.Lock()
+        self.contadores = {}
+
+    def _contar(self, fuente: str, clave_contador: str):
+        por_fuente = self.contadores.setdefault(fuente, {'ejecutadas': 0, 'coalescidas': 0})
+        por_fuente[clave_contador] += 1
+
+    def ejecutar(self, fuente: str, clave: str, funcion, *args, **kwargs) -> tuple:
+        """Ejecuta funcion(*args) una sola vez por (fuente, clave) en vuelo. Devuelve (resultado, coalescida)"""
+        llave = (fuente, clave)
+        with self._lock:
+            llamada = self._en_vuelo.get(llave)
+            es_lider = llamada is None
+            if es_lider:
+                llamada = _LlamadaEnVuelo()
+                self._en_vuelo[llave] = llamada
+                self._contar(fuente, 'ejecutadas')
+            else:
+                llamada.seguidores += 1
+                self._contar(fuente, 'coalescidas')
+        
+        if not es_lider:
+            print(f"🔗 {fuente} {clave}: esperando la consulta en curso")
+            reportar_etapa('esperando_consulta_en_curso')
+            llamada.evento.wait()
+            if llamada.error is not None:
+                raise llamada.error
+            return llamada.resultado, True
+        
+        try:
+            llamada.resultado = funcion(*args, **kwargs)
+            return llamada.resultado, False
+        except Exception as e:
+            llamada.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._en_vuelo[llave]
+            llamada.evento.set()
+
+    def estado(self) -> dict:
+        with self._lock:
+            return {
+                'en_vuelo': [
+                    {'fuente': fuente, 'clave': clave, 'seguidores': llamada.seguidores}
+                    for (fuente, clave), llamada in self._en_vuelo.items()
+                ],
+                'contadores': {fuente: dict(c) for fuente, c in self.contadores.items()}
+            }
+
+consultas_en_vuelo = ConsultasEnVuelo()
+
+def normalizar_placa(placa: str) -> str:
+    return re.sub(r'[^A-Z0-9]', '', placa.strip().upper())
+
+def normalizar_clave_scppp(valor: str, tipo: str) -> str:
+    return f"{tipo}:{re.sub(r'[^A-Z0-9]', '', str(valor).strip().upper())}"
+
+# --- COORDINACIÓN ENTRE NODOS (GET_LOCK DE MYSQL) ---
+COORDINACION_ACTIVA = True
+COORDINACION_LEASE = 180       # s: MySQL corta la conexión ociosa del líder (y libera el lock) pasado este tiempo
+COORDINACION_ESPERA = 150      # s: máximo que un nodo espera a que el líder de otro nodo termine
+NODO_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def _primer_valor(fila):
+    if fila is None:
+        return None
+    return list(fila.values())[0] if isinstance(fila, dict) else fila[0]
+
+class CoordinadorNodos:
+    """Un solo nodo hace el scraping de cada clave; los demás esperan y leen la fila recién guardada.
+    
+    El lock vive en una conexión MySQL dedicada con wait_timeout = COORDINACION_LEASE: si el nodo
+    líder cae, la conexión se cierra y MySQL libera el lock; si se cuelga, el servidor corta la
+    conexión ociosa al vencer el lease.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contadores = {
+            'lider': 0,
+            'servidas_por_otro_nodo': 0,
+            'timeouts': 0,
+            'sin_coordinacion': 0,
+        }
+
+    def _contar(self, clave: str):
+        with self._lock:
+            self.contadores[clave] += 1
+
+    def _conectar(self):
+        with app.app_context():
+            conexion = mysql.connect
+        cur = conexion.cursor()
+        cur.execute("SET SESSION wait_timeout = %s", (COORDINACION_LEASE,))
+        cur.close()
+        return conexion
+
+    def _get_lock(self, conexion, nombre: str, espera: int) -> bool:
+        cur = conexion.cursor()
+        cur.execute("SELECT GET_LOCK(%s, %s) AS obtenido", (nombre, espera))
+        obtenido = _primer_valor(cur.fetchone())
+        cur.close()
+        return obtenido == 1
+
+    def _release_lock(self, conexion, nombre: str):
+        try:
+            cur = conexion.cursor()
+            cur.execute("SELECT RELEASE_LOCK(%s) AS liberado", (nombre,))
+            cur.fetchone()
+            cur.close()
+        except Exception as e:
+            print(f"⚠️ Error liberando lock {nombre}: {e}")
+
+    def ejecutar(self, fuente: str, clave: str, funcion, args: tuple, leer_reciente):
+        """Ejecuta funcion(*args) como líder, o devuelve leer_reciente(max_edad) si otro nodo ya lo hizo"""
+        if not COORDINACION_ACTIVA:
+            return funcion(*args)
+        
+        nombre = f"vehiculos:{fuente}:{clave}"[:64]
+        try:
+            conexion = self._conectar()
+        except Exception as e:
+            print(f"⚠️ Sin coordinación entre nodos ({e}), consultando directamente")
+            self._contar('sin_coordinacion')
+            return funcion(*args)
+        
+        try:
+            inicio = time.time()
+            if not self._get_lock(conexion, nombre, 0):
+                print(f"⏳ {fuente} {clave}: otro nodo está consultando, esperando su resultado...")
+                reportar_etapa('esperando_otro_nodo')
+                if not self._get_lock(conexion, nombre, COORDINACION_ESPERA):
+                    print(f"⚠️ {fuente} {clave}: el otro nodo no terminó en {COORDINACION_ESPERA}s, consultando directamente")
+                    self._contar('timeouts')
+                    return funcion(*args)
+                
+                # Ahora tenemos el lock: si el otro nodo guardó la fila, se usa
+                reciente = leer_reciente(int(time.time() - inicio) + 5)
+                if reciente:
+                    self._contar('servidas_por_otro_nodo')
+                    return reciente
+            
+            self._contar('lider')
+            return funcion(*args)
+        finally:
+            self._release_lock(conexion, nombre)
+            try:
+                conexion.close()
+            except Exception:
+                pass
+
+    def estado(self) -> dict:
+        with self._lock:
+            return {'nodo': NODO_ID, 'activa': COORDINACION_ACTIVA, **self.contadores}
+
+coordinador_nodos = CoordinadorNodos()
+
 # ==============================================
 # SECCIÓN 2: CREACIÓN DE TABLAS EN MYSQL
 # ==============================================
 
+# Cola durable de trabajos de scraping (requiere MySQL 8.0+ por SKIP LOCKED)
+SQL_TABLA_TRABAJOS = '''CREATE TABLE IF NOT EXISTS trabajos_consulta (
+    id CHAR(32) PRIMARY KEY,
+    fuente VARCHAR(20) NOT NULL,
+    parametros TEXT NOT NULL,
+    estado VARCHAR(20) NOT NULL DEFAULT 'en_cola',
+    intentos INT NOT NULL DEFAULT 0,
+    max_intentos INT NOT NULL DEFAULT 3,
+    visible_desde TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    nodo VARCHAR(100),
+    etapa_actual VARCHAR(50),
+    etapas TEXT,
+    resultado LONGTEXT,
+    codigo_http INT,
+    error TEXT,
+    iniciado_en TIMESTAMP NULL,
+    terminado_en TIMESTAMP NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_estado_visible (estado, visible_desde),
+    INDEX idx_created_at (created_at)
+)'''
+
 def crear_tablas_mysql():
     try:
         # Usar el contexto de aplicación directamente
@@ -113,9 +885,12 @@ def crear_tablas_mysql():
                 INDEX idx_estado (estado_licencia)
             )''')
             
+            # Tabla de la cola durable de trabajos
+            cur.execute(SQL_TABLA_TRABAJOS)
+            
             mysql.connection.commit()
             cur.close()
-            print("✅ Tablas 'sunarp_vehiculos' y 'scppp_conductores' creadas/verificadas en base de datos 'vehiculos_db'")
+            print("✅ Tablas 'sunarp_vehiculos', 'scppp_conductores' y 'trabajos_consulta' creadas/verificadas en base de datos 'vehiculos_db'")
     except Exception as e:
         print(f"❌ Error creando tablas: {e}")
         # Intentar nuevamente sin contexto si falla
@@ -174,6 +949,9 @@ def crear_tablas_mysql():
                     INDEX idx_estado (estado_licencia)
                 )''')
                 
+                # Tabla de trabajos
+                cur.execute(SQL_TABLA_TRABAJOS)
+                
             connection.commit()
             connection.close()
             print("✅ Tablas creadas usando pymysql directamente")
@@ -184,98 +962,334 @@ def crear_tablas_mysql():
 # SECCIÓN 3: FUNCIONES SUNARP
 # ==============================================
 
+# --- REGISTRO DE MODELOS GEMINI ---
+# Niveles de enrutamiento: se empieza por el modelo más rápido y barato y solo se
+# escala al siguiente nivel si la extracción devuelve menos de GEMINI_CAMPOS_MINIMOS campos.
+# Dentro de cada nivel los modelos se usan como respaldo ante errores o timeouts.
+GEMINI_NIVELES = [
+    ["gemini-2.5-flash-lite"],
+    ["gemini-2.5-flash", "gemini-1.5-flash"],
+]
+GEMINI_CAMPOS_MINIMOS = 9
+GEMINI_MODELOS = [modelo for nivel in GEMINI_NIVELES for modelo in nivel]   # Orden de respaldo
+GEMINI_TIMEOUT = 30                   # Segundos máximos por llamada a un modelo
+GEMINI_FALLOS_CONSECUTIVOS = 3        # Fallos seguidos para enfriar un modelo
+GEMINI_ENFRIAMIENTO = 60              # Segundos que un modelo enfriado pasa al final de la cola
+
+class RegistroModelosGemini:
+    """Modelos Gemini construidos una sola vez, con respaldo ordenado y métricas por modelo"""
+    def __init__(self, modelos: list, timeout: int):
+        self.orden = list(modelos)
+        self.timeout = timeout
+        self._modelos = {}
+        self._lock = threading.Lock()
+        self.metricas = {}
+        for nombre in self.orden:
+            self._registrar_metricas(nombre)
+
+    def _registrar_metricas(self, nombre: str):
+        self.metricas.setdefault(nombre, {
+            'llamadas': 0,
+            'exitos': 0,
+            'fallos': 0,
+            'timeouts': 0,
+            'fallos_consecutivos': 0,
+            'enfriado_hasta': 0,
+            'latencia_total': 0.0,
+            'latencia_ultima': None,
+            'ultimo_error': None
+        })
+
+    def modelo(self, nombre: str):
+        """Devuelve el modelo ya construido (o lo construye la primera vez)"""
+        with self._lock:
+            if nombre not in self._modelos:
+                self._modelos[nombre] = obtener_genai().GenerativeModel(nombre)
+                self._registrar_metricas(nombre)
+            return self._modelos[nombre]
+
+    def precargar(self):
+        for nombre in self.orden:
+            try:
+                self.modelo(nombre)
+            except Exception as e:
+                print(f"⚠️ No se pudo construir el modelo {nombre}: {e}")
+
+    def _orden_efectivo(self, modelos: list) -> list:
+        """Los modelos enfriados por fallos recientes se intentan al final"""
+        ahora = time.time()
+        with self._lock:
+            return sorted(modelos, key=lambda m: self.metricas.get(m, {}).get('enfriado_hasta', 0) > ahora)
+
+    def _registrar(self, nombre: str, latencia: float, error: Exception = None):
+        with self._lock:
+            m = self.metricas[nombre]
+            m['llamadas'] += 1
+            m['latencia_ultima'] = round(latencia, 3)
+            m['latencia_total'] += latencia
+            if error is None:
+                m['exitos'] += 1
+                m['fallos_consecutivos'] = 0
+                m['enfriado_hasta'] = 0
+                return
+            m['fallos'] += 1
+            m['fallos_consecutivos'] += 1
+            m['ultimo_error'] = str(error)[:200]
+            if 'deadline' in type(error).__name__.lower() or 'timeout' in str(error).lower():
+                m['timeouts'] += 1
+            if m['fallos_consecutivos'] >= GEMINI_FALLOS_CONSECUTIVOS:
+                m['enfriado_hasta'] = time.time() + GEMINI_ENFRIAMIENTO
+
+    def generar(self, contenido: list, modelos: list = None, timeout: int = None, configuracion: dict = None) -> tuple:
+        """Llama a los modelos en orden hasta que uno responda. Devuelve (texto, modelo, latencia)"""
+        timeout = timeout or self.timeout
+        errores = []
+        for nombre in self._orden_efectivo(modelos or self.orden):
+            inicio = time.perf_counter()
+            try:
+                response = self.modelo(nombre).generate_content(
+                    contenido,
+                    generation_config=configuracion,
+                    request_options={"timeout": timeout}
+                )
+                texto = response.text.strip()
+            except Exception as e:
+                latencia = time.perf_counter() - inicio
+                self._registrar(nombre, latencia, e)
+                print(f"⚠️ Gemini {nombre} falló en {latencia:.2f}s: {e}")
+                errores.append(f"{nombre}: {e}")
+                continue
+            latencia = time.perf_counter() - inicio
+            self._registrar(nombre, latencia)
+            return texto, nombre, round(latencia, 3)
+        raise Exception("Todos los modelos Gemini fallaron - " + " | ".join(errores))
+
+    def estado(self) -> dict:
+        ahora = time.time()
+        with self._lock:
+            return {
+                nombre: {
+                    'llamadas': m['llamadas'],
+                    'exitos': m['exitos'],
+                    'fallos': m['fallos'],
+                    'timeouts': m['timeouts'],
+                    'latencia_promedio': round(m['latencia_total'] / m['llamadas'], 3) if m['llamadas'] else None,
+                    'latencia_ultima': m['latencia_ultima'],
+                    'enfriado': m['enfriado_hasta'] > ahora,
+                    'ultimo_error': m['ultimo_error']
+                }
+                for nombre, m in self.metricas.items()
+            }
+
+registro_gemini = RegistroModelosGemini(GEMINI_MODELOS, GEMINI_TIMEOUT)
+
+# Campos de la sección "DATOS DEL VEHÍCULO" en el orden en que se muestran
+CAMPOS_VEHICULO = [
+    "Nº PLACA:", "Nº SERIE:", "Nº VIN:", "Nº MOTOR:", 
+    "COLOR:", "MARCA:", "MODELO:", "PLACA VIGENTE:", 
+    "PLACA ANTERIOR:", "ESTADO:", "ANOTACIONES:"
+]
+
+@dataclass(slots=True)
+class DatosVehiculo:
+    """Los once campos de 'DATOS DEL VEHÍCULO', en el mismo orden que CAMPOS_VEHICULO"""
+    placa: str = ""
+    serie: str = ""
+    vin: str = ""
+    motor: str = ""
+    color: str = ""
+    marca: str = ""
+    modelo: str = ""
+    placa_vigente: str = ""
+    placa_anterior: str = ""
+    estado: str = ""
+    anotaciones: str = ""
+
+    @classmethod
+    def desde_dict(cls, datos: dict) -> "DatosVehiculo":
+        """Acepta claves en minúscula (JSON de Gemini) o en mayúscula (salida de parsear_datos_vehiculo)"""
+        return cls(**{
+            atributo: str(datos.get(atributo) or datos.get(atributo.upper()) or "").strip()
+            for atributo in ATRIBUTOS_VEHICULO
+        })
+
+    @classmethod
+    def desde_texto(cls, texto_datos: str) -> "DatosVehiculo":
+        return cls.desde_dict(parsear_datos_vehiculo(texto_datos))
+
+    @classmethod
+    def desde_etiquetas(cls, valores: dict) -> "DatosVehiculo":
+        """Construye el registro desde {etiqueta de CAMPOS_VEHICULO: valor}"""
+        return cls(**{
+            atributo: valores.get(etiqueta, "")
+            for etiqueta, atributo in zip(CAMPOS_VEHICULO, ATRIBUTOS_VEHICULO)
+        })
+
+    def campos_encontrados(self) -> int:
+        return sum(1 for atributo in ATRIBUTOS_VEHICULO if getattr(self, atributo))
+
+    def a_dict(self) -> dict:
+        """Mismo formato que devolvía parsear_datos_vehiculo (PLACA, SERIE, ..., ANOTACIONES)"""
+        return {atributo.upper(): getattr(self, atributo) for atributo in ATRIBUTOS_VEHICULO}
+
+    def a_texto(self) -> str:
+        """Texto 'CAMPO: valor' como el que devolvía limpiar_datos_gemini"""
+        return '\n'.join(
+            f"{etiqueta} {getattr(self, atributo)}"
+            for etiqueta, atributo in zip(CAMPOS_VEHICULO, ATRIBUTOS_VEHICULO)
+        )
+
+ATRIBUTOS_VEHICULO = tuple(campo.name for campo in fields(DatosVehiculo))
+
+# Esquema de respuesta JSON para Gemini (modo JSON: sin etiquetas repetidas en la salida)
+ESQUEMA_DATOS_VEHICULO = {
+    "type": "OBJECT",
+    "properties": {atributo: {"type": "STRING"} for atributo in ATRIBUTOS_VEHICULO},
+    "required": list(ATRIBUTOS_VEHICULO)
+}
+
+CONFIGURACION_GEMINI_JSON = {
+    "response_mime_type": "application/json",
+    "response_schema": ESQUEMA_DATOS_VEHICULO,
+    "temperature": 0
+}
+
 # --- FUNCIONES GEMINI OCR ---
-def obtener_datos_vehiculo_con_gemini(ruta_imagen: str) -> dict:
+def cargar_imagen_en_memoria(imagen: Union[bytes, Image.Image]) -> Image.Image:
+    """Convierte bytes (PNG/JPEG) o una imagen PIL en imagen PIL, sin tocar el disco"""
+    if isinstance(imagen, Image.Image):
+        return imagen
+    if isinstance(imagen, (bytes, bytearray, memoryview)):
+        if not imagen:
+            raise ValueError("Imagen vacía")
+        img = Image.open(BytesIO(imagen))
+        img.load()
+        return img
+    raise TypeError(f"Tipo de imagen no soportado: {type(imagen).__name__}")
+
+def obtener_datos_vehiculo_con_gemini(imagen: Union[bytes, Image.Image], modelos: list = None) -> dict:
+    """Extrae los datos del vehículo con Gemini a partir de una imagen en memoria (bytes o PIL)"""
     try:
-        print(f"🔍 Enviando imagen a Gemini para extraer datos del vehículo: {os.path.basename(ruta_imagen)}")
-        
-        if not os.path.exists(ruta_imagen):
-            print("❌ La imagen no existe")
-            return {"datos_vehiculo": "", "error": "Imagen no encontrada"}
-        
         try:
-            imagen = Image.open(ruta_imagen)
+            imagen_pil = cargar_imagen_en_memoria(imagen)
         except Exception as e:
             print(f"❌ Error cargando imagen: {e}")
-            return {"datos_vehiculo": "", "error": f"Error cargando imagen: {e}"}
+            return {"datos_vehiculo_crudo": "", "datos": DatosVehiculo(), "campos_encontrados": 0, "error": f"Error cargando imagen: {e}"}
         
-        try:
-            model = genai.GenerativeModel("gemini-2.5-flash")
-        except:
-            model = genai.GenerativeModel("gemini-1.5-flash")
+        # Los bytes ya codificados se envían tal cual (sin que el SDK vuelva a codificarlos)
+        if isinstance(imagen, Image.Image):
+            parte_imagen = imagen_pil
+        else:
+            parte_imagen = {
+                "mime_type": Image.MIME.get(imagen_pil.format, "image/png"),
+                "data": bytes(imagen)
+            }
+        
+        print(f"🔍 Enviando imagen a Gemini para extraer datos del vehículo ({imagen_pil.width}x{imagen_pil.height})")
         
         prompt = """Analiza esta imagen de una consulta vehicular de SUNARP (Registro Público Peruano).
 
-Busca específicamente la sección que dice "DATOS DEL VEHÍCULO" y extrae SOLO la información contenida en esa sección.
-
-Extrae EXACTAMENTE estos campos en el formato original:
-
-Nº PLACA: [valor]
-Nº SERIE: [valor]
-Nº VIN: [valor]
-Nº MOTOR: [valor]
-COLOR: [valor]
-MARCA: [valor]
-MODELO: [valor]
-PLACA VIGENTE: [valor]
-PLACA ANTERIOR: [valor]
-ESTADO: [valor]
-ANOTACIONES: [valor]
+Extrae SOLO los datos de la sección "DATOS DEL VEHÍCULO" y devuélvelos en el JSON indicado:
+placa (Nº PLACA), serie (Nº SERIE), vin (Nº VIN), motor (Nº MOTOR), color, marca, modelo,
+placa_vigente, placa_anterior, estado y anotaciones.
 
 INSTRUCCIONES IMPORTANTES:
-1. Extrae SOLO los datos de la sección "DATOS DEL VEHÍCULO"
-2. IGNORA completamente todo el texto de fondo/watermark que dice "sunarp", "Superintendencia Nacional de los Registros Públicos", "Esta información no constituye Publicidad Registral", etc.
-3. IGNORA los encabezados, títulos y logotipos
-4. IGNORA el texto repetido del watermark
-5. Devuelve SOLO los 11 campos listados arriba, uno por línea
-6. Mantén el formato exacto con los dos puntos (:)
-7. Si algún campo no está presente, escríbelo igual pero déjalo vacío
-
-Ejemplo de lo que quiero:
-Nº PLACA: A3V315
-Nº SERIE: JS3TA04V9A4601578
-Nº VIN: JS3TA04V9A4601578
-Nº MOTOR: J24B1068781
-COLOR: GRIS
-MARCA: SUZUKI
-MODELO: GRAND VITARA
-PLACA VIGENTE: A3V315
-PLACA ANTERIOR: NINGUNA
-ESTADO: EN CIRCULACION
-ANOTACIONES: NINGUNA"""
-
-        print("⏳ Enviando a Gemini (extracción específica de datos)...")
+1. IGNORA el texto de fondo/watermark ("sunarp", "Superintendencia Nacional de los Registros Públicos", "Esta información no constituye Publicidad Registral", etc.)
+2. Copia los valores exactamente como aparecen (por ejemplo "NINGUNA", "EN CIRCULACION")
+3. Si algún campo no está presente, devuélvelo como cadena vacía"""
+
+        print("⏳ Enviando a Gemini (extracción en modo JSON)...")
         try:
-            response = model.generate_content([prompt, imagen])
-            texto_datos = response.text.strip()
-            print(f"✅ Gemini devolvió datos del vehículo")
+            texto_datos, modelo_usado, latencia = registro_gemini.generar(
+                [prompt, parte_imagen], modelos, configuracion=CONFIGURACION_GEMINI_JSON
+            )
+            print(f"✅ Gemini ({modelo_usado}) devolvió datos del vehículo en {latencia}s")
             
-            datos_limpios = limpiar_datos_gemini(texto_datos)
+            try:
+                datos = DatosVehiculo.desde_dict(json.loads(texto_datos))
+            except (ValueError, AttributeError):
+                # Respuesta fuera de esquema: se recurre al análisis por líneas
+                print("⚠️ Gemini no devolvió JSON válido, analizando como texto")
+                datos = DatosVehiculo.desde_texto(limpiar_datos_gemini(texto_datos))
             
             return {
                 "datos_vehiculo_crudo": texto_datos,
-                "datos_vehiculo_limpio": datos_limpios,
-                "campos_encontrados": contar_campos_encontrados(datos_limpios),
+                "datos": datos,
+                "campos_encontrados": datos.campos_encontrados(),
+                "modelo": modelo_usado,
+                "latencia": latencia,
                 "error": None
             }
             
         except Exception as e:
             print(f"❌ Error en Gemini: {e}")
-            return {"datos_vehiculo_crudo": "", "datos_vehiculo_limpio": "", "error": str(e)}
+            return {"datos_vehiculo_crudo": "", "datos": DatosVehiculo(), "campos_encontrados": 0, "error": str(e)}
         
     except Exception as e:
         print(f"❌ Error general en Gemini: {e}")
-        return {"datos_vehiculo_crudo": "", "datos_vehiculo_limpio": "", "error": str(e)}
+        return {"datos_vehiculo_crudo": "", "datos": DatosVehiculo(), "campos_encontrados": 0, "error": str(e)}
+
+# --- ENRUTAMIENTO DE MODELOS POR CALIDAD DE EXTRACCIÓN ---
+_lock_enrutamiento = threading.Lock()
+contadores_enrutamiento = {
+    'extracciones': 0,
+    'escalamientos': 0,             # Por calidad: el nivel respondió con pocos campos
+    'escalamientos_por_error': 0,   # El nivel falló (timeouts, cuota, imagen inválida)
+    'resueltas_por_nivel': [0] * len(GEMINI_NIVELES),
+    'bajo_umbral_final': 0,
+}
+
+def obtener_datos_vehiculo_enrutado(imagen: Union[bytes, Image.Image]) -> dict:
+    """Usa primero el nivel de modelos más barato y escala solo si faltan campos"""
+    mejor = None
+    for nivel, modelos in enumerate(GEMINI_NIVELES):
+        resultado = obtener_datos_vehiculo_con_gemini(imagen, modelos)
+        resultado["nivel"] = nivel
+        if mejor is None or resultado.get("campos_encontrados", 0) > mejor.get("campos_encontrados", 0):
+            mejor = resultado
+        if mejor.get("campos_encontrados", 0) >= GEMINI_CAMPOS_MINIMOS:
+            break
+        if nivel + 1 < len(GEMINI_NIVELES):
+            # Un fallo del nivel no dice nada de su calidad: se cuenta aparte de la tasa de escalamiento
+            if resultado.get("error"):
+                print(f"⬆️ Nivel {nivel} falló ({resultado['error']}), "
+                      f"pasando al nivel {nivel + 1}: {', '.join(GEMINI_NIVELES[nivel + 1])}")
+                contador = 'escalamientos_por_error'
+            else:
+                print(f"⬆️ {mejor.get('campos_encontrados', 0)}/{len(CAMPOS_VEHICULO)} campos "
+                      f"(mínimo {GEMINI_CAMPOS_MINIMOS}), escalando al nivel {nivel + 1}: {', '.join(GEMINI_NIVELES[nivel + 1])}")
+                contador = 'escalamientos'
+            with _lock_enrutamiento:
+                contadores_enrutamiento[contador] += 1
+    
+    mejor["niveles_intentados"] = nivel + 1
+    with _lock_enrutamiento:
+        contadores_enrutamiento['extracciones'] += 1
+        if mejor.get("campos_encontrados", 0) >= GEMINI_CAMPOS_MINIMOS:
+            contadores_enrutamiento['resueltas_por_nivel'][mejor["nivel"]] += 1
+        else:
+            contadores_enrutamiento['bajo_umbral_final'] += 1
+    return mejor
+
+def estado_enrutamiento() -> dict:
+    with _lock_enrutamiento:
+        extracciones = contadores_enrutamiento['extracciones']
+        return {
+            'niveles': GEMINI_NIVELES,
+            'campos_minimos': GEMINI_CAMPOS_MINIMOS,
+            'extracciones': extracciones,
+            'escalamientos': contadores_enrutamiento['escalamientos'],
+            'tasa_escalamiento': round(contadores_enrutamiento['escalamientos'] / extracciones, 3) if extracciones else 0,
+            'escalamientos_por_error': contadores_enrutamiento['escalamientos_por_error'],
+            'resueltas_por_nivel': list(contadores_enrutamiento['resueltas_por_nivel']),
+            'bajo_umbral_final': contadores_enrutamiento['bajo_umbral_final']
+        }
 
 def limpiar_datos_gemini(texto_gemini: str) -> str:
     if not texto_gemini:
         return ""
     
-    campos_esperados = [
-        "Nº PLACA:", "Nº SERIE:", "Nº VIN:", "Nº MOTOR:", 
-        "COLOR:", "MARCA:", "MODELO:", "PLACA VIGENTE:", 
-        "PLACA ANTERIOR:", "ESTADO:", "ANOTACIONES:"
-    ]
+    campos_esperados = CAMPOS_VEHICULO
     
     lineas = texto_gemini.strip().split('\n')
     lineas_limpias = []
@@ -313,23 +1327,6 @@ def limpiar_datos_gemini(texto_gemini: str) -> str:
     
     return '\n'.join(resultado_final)
 
-def contar_campos_encontrados(texto_datos: str) -> int:
-    if not texto_datos:
-        return 0
-    
-    campos_con_valor = 0
-    lineas = texto_datos.strip().split('\n')
-    
-    for linea in lineas:
-        if ':' in linea:
-            partes = linea.split(':', 1)
-            if len(partes) == 2:
-                valor = partes[1].strip()
-                if valor and valor != "":
-                    campos_con_valor += 1
-    
-    return campos_con_valor
-
 def parsear_datos_vehiculo(texto_datos: str) -> dict:
     datos = {}
     
@@ -353,7 +1350,7 @@ def parsear_datos_vehiculo(texto_datos: str) -> dict:
     return datos
 
 # --- FUNCIÓN PARA GUARDAR SUNARP EN BASE DE DATOS ---
-def guardar_placa_sunarp_en_db(placa: str, datos_parseados: dict):
+def guardar_placa_sunarp_en_db(placa: str, datos: DatosVehiculo):
     """Guarda o actualiza la placa en la base de datos SUNARP"""
     try:
         # Asegurar que estamos en el contexto de la aplicación
@@ -381,16 +1378,16 @@ def guardar_placa_sunarp_en_db(placa: str, datos_parseados: dict):
                     updated_at = CURRENT_TIMESTAMP
                     WHERE placa = %s AND deleted_at IS NULL''',
                     (
-                        datos_parseados.get('SERIE', ''),
-                        datos_parseados.get('VIN', ''),
-                        datos_parseados.get('MOTOR', ''),
-                        datos_parseados.get('COLOR', ''),
-                        datos_parseados.get('MARCA', ''),
-                        datos_parseados.get('MODELO', ''),
-                        datos_parseados.get('PLACA_VIGENTE', ''),
-                        datos_parseados.get('PLACA_ANTERIOR', ''),
-                        datos_parseados.get('ESTADO', ''),
-                        datos_parseados.get('ANOTACIONES', ''),
+                        datos.serie,
+                        datos.vin,
+                        datos.motor,
+                        datos.color,
+                        datos.marca,
+                        datos.modelo,
+                        datos.placa_vigente,
+                        datos.placa_anterior,
+                        datos.estado,
+                        datos.anotaciones,
                         placa
                     ))
                 accion = "actualizado"
@@ -404,16 +1401,16 @@ def guardar_placa_sunarp_en_db(placa: str, datos_parseados: dict):
                 ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)''',
                     (
                         placa,
-                        datos_parseados.get('SERIE', ''),
-                        datos_parseados.get('VIN', ''),
-                        datos_parseados.get('MOTOR', ''),
-                        datos_parseados.get('COLOR', ''),
-                        datos_parseados.get('MARCA', ''),
-                        datos_parseados.get('MODELO', ''),
-                        datos_parseados.get('PLACA_VIGENTE', ''),
-                        datos_parseados.get('PLACA_ANTERIOR', ''),
-                        datos_parseados.get('ESTADO', ''),
-                        datos_parseados.get('ANOTACIONES', '')
+                        datos.serie,
+                        datos.vin,
+                        datos.motor,
+                        datos.color,
+                        datos.marca,
+                        datos.modelo,
+                        datos.placa_vigente,
+                        datos.placa_anterior,
+                        datos.estado,
+                        datos.anotaciones
                     ))
                 placa_id = cur.lastrowid
                 accion = "creado"
@@ -441,205 +1438,1469 @@ def guardar_placa_sunarp_en_db(placa: str, datos_parseados: dict):
             print("⚠️ La tabla no existe, intentando crear...")
             crear_tablas_mysql()
             # Reintentar después de crear la tabla
-            return guardar_placa_sunarp_en_db(placa, datos_parseados)
+            return guardar_placa_sunarp_en_db(placa, datos)
         return {'success': False, 'error': str(e)}
 
-# --- FUNCIÓN DE CONSULTA SUNARP (OPTIMIZADA) ---
-def consultar_sunarp_con_gemini(placa: str):
-    print("=" * 80)
-    print("🚗 CONSULTA SUNARP - GEMINI (SOLO DATOS DEL VEHÍCULO)")
-    print("=" * 80)
-    print(f"🎯 Consultando placa: {placa}")
-    
-    with SB(
-        uc=True,
-        headless=False,
-        page_load_strategy="normal",
-        disable_csp=True,
-        agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        undetectable=True,
-    ) as sb:
+# --- CACHÉ DE LECTURA SUNARP ---
+SUNARP_CACHE_MAX_EDAD = 24 * 3600   # Edad máxima (s) por defecto de un registro servido desde la BD; 0 = sin caché
+
+def buscar_placa_en_cache(placa: str, max_edad: int) -> dict:
+    """Devuelve la placa guardada si se actualizó hace menos de max_edad segundos (o None)"""
+    if max_edad <= 0:
+        return None
+    try:
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            cur.execute("""
+                SELECT id, placa, numero_serie, numero_vin, numero_motor, color, marca, modelo,
+                       placa_vigente, placa_anterior, estado, anotaciones, consultas_realizadas,
+                       TIMESTAMPDIFF(SECOND, updated_at, NOW()) AS edad_segundos
+                FROM sunarp_vehiculos
+                WHERE placa = %s AND deleted_at IS NULL
+                  AND updated_at >= NOW() - INTERVAL %s SECOND
+                  AND COALESCE(marca, '') <> '' AND COALESCE(estado, '') <> ''
+            """, (placa, max_edad))
+            registro = cur.fetchone()
+            
+            if registro:
+                # Contar la consulta sin renovar updated_at (la frescura es la del último scraping)
+                cur.execute("""
+                    UPDATE sunarp_vehiculos
+                    SET consultas_realizadas = consultas_realizadas + 1, updated_at = updated_at
+                    WHERE id = %s
+                """, (registro['id'],))
+                mysql.connection.commit()
+                registro['consultas_realizadas'] += 1
+            cur.close()
+            return registro
+    except Exception as e:
+        print(f"⚠️ Error leyendo caché SUNARP: {e}")
+        return None
+
+def respuesta_sunarp_desde_cache(registro: dict, max_edad: int) -> dict:
+    """Arma la respuesta de /sunarp/consultar con un registro de la BD"""
+    datos = DatosVehiculo(
+        placa=registro['placa'] or "",
+        serie=registro['numero_serie'] or "",
+        vin=registro['numero_vin'] or "",
+        motor=registro['numero_motor'] or "",
+        color=registro['color'] or "",
+        marca=registro['marca'] or "",
+        modelo=registro['modelo'] or "",
+        placa_vigente=registro['placa_vigente'] or "",
+        placa_anterior=registro['placa_anterior'] or "",
+        estado=registro['estado'] or "",
+        anotaciones=registro['anotaciones'] or ""
+    )
+    return {
+        'success': True,
+        'message': 'Consulta SUNARP servida desde caché',
+        'placa': registro['placa'],
+        'datos_vehiculo_texto': datos.a_texto(),
+        'datos_vehiculo_estructurado': datos.a_dict(),
+        'base_datos': {
+            'success': True,
+            'accion': 'cache',
+            'placa_id': registro['id'],
+            'consultas_realizadas': registro['consultas_realizadas'],
+            'placa': registro['placa']
+        },
+        'estadisticas': {
+            'campos_encontrados': datos.campos_encontrados(),
+            'metodo_extraccion': 'cache'
+        },
+        'cache': {
+            'hit': True,
+            'edad_segundos': registro['edad_segundos'],
+            'max_edad_segundos': max_edad
+        }
+    }
+
+# --- POOL DE NAVEGADORES SUNARP ---
+URL_SUNARP = "https://consultavehicular.sunarp.gob.pe/consulta-vehicular/"
+SUNARP_POOL_TAMANO = 2             # Navegadores precargados en la página de consulta
+SUNARP_POOL_MAX_USOS = 50          # Reciclar un navegador después de N consultas
+SUNARP_POOL_TIMEOUT = 120          # Segundos máximos esperando un navegador libre
+SUNARP_POOL_PRECALENTAR = True     # Lanzar los navegadores al iniciar el servidor
+
+OPCIONES_SB_SUNARP = {
+    'uc': True,
+    'headless': False,
+    'page_load_strategy': "normal",
+    'disable_csp': True,
+    'agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    'undetectable': True,
+    'log_cdp_events': True,   # Eventos Network de CDP para capturar el JSON del backend
+}
+
+class PoolAgotadoError(Exception):
+    """No se obtuvo un navegador libre dentro del tiempo de espera"""
+
+class SesionNavegador:
+    """Navegador SeleniumBase abierto fuera de un bloque 'with'"""
+    def __init__(self, numero: int):
+        self.numero = numero
+        self.usos = 0
+        self.reciclar = False
+        self.creada_en = time.time()
+        self._contexto = obtener_clase_sb()(**OPCIONES_SB_SUNARP)
+        self.sb = self._contexto.__enter__()
+        try:
+            self.sb.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+        except Exception:
+            self.cerrar()
+            raise
+
+    def cerrar(self):
+        try:
+            self._contexto.__exit__(None, None, None)
+        except Exception as e:
+            print(f"⚠️ Error cerrando navegador #{self.numero}: {e}")
+
+class PoolNavegadoresSunarp:
+    """Pool de navegadores precargados en la página de consulta SUNARP"""
+    def __init__(self, tamano: int, max_usos: int, timeout: int):
+        self.tamano = tamano
+        self.max_usos = max_usos
+        self.timeout = timeout
+        self._libres = queue.Queue()
+        self._lock = threading.Lock()
+        self._creados = 0      # Sesiones vivas: libres + en uso + preparándose
+        self._en_uso = 0
+        self._numero = 0
+        self.estadisticas = {
+            'lanzados': 0,
+            'reciclados': 0,
+            'fallos_salud': 0,
+            'prestamos': 0,
+            'esperas': 0,
+        }
+
+    def _lanzar(self) -> SesionNavegador:
+        with self._lock:
+            self._numero += 1
+            numero = self._numero
+        print(f"🌐 Lanzando navegador #{numero} del pool SUNARP...")
+        sesion = SesionNavegador(numero)
         try:
-            # Configurar navegador
-            sb.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-            
-            # 1) Abrir SUNARP
-            print("\n🌐 Navegando a SUNARP...")
-            sb.open("https://consultavehicular.sunarp.gob.pe/consulta-vehicular/")
-            print(f"📄 Título: {sb.get_title()}")
-            time.sleep(5)
-            
-            # 2) Detectar CAPTCHA
-            print("\n🔍 Verificando CAPTCHA...")
-            captcha_detectado = False
+            sesion.sb.open(URL_SUNARP)
+        except Exception:
+            sesion.cerrar()
+            raise
+        with self._lock:
+            self.estadisticas['lanzados'] += 1
+        print(f"✅ Navegador #{numero} listo en SUNARP")
+        return sesion
+
+    def _reservar_cupo(self) -> bool:
+        with self._lock:
+            if self._creados >= self.tamano:
+                return False
+            self._creados += 1
+            return True
+
+    def _liberar_cupo(self):
+        with self._lock:
+            self._creados -= 1
+
+    def calentar(self):
+        """Lanza los navegadores que falten hasta completar el tamaño del pool"""
+        while self._reservar_cupo():
             try:
-                time.sleep(3)
-                captcha_selectors = [
-                    "div.cf-turnstile",
-                    "iframe[src*='cloudflare.com']",
-                    ".cf-turnstile",
-                ]
-                for selector in captcha_selectors:
-                    try:
-                        elements = sb.find_elements(selector)
-                        if elements:
-                            captcha_detectado = True
-                            print(f"🛡️ CAPTCHA detectado con selector: {selector}")
-                            break
-                    except:
-                        continue
-                
-                if not captcha_detectado:
-                    page_source = sb.get_page_source().lower()
-                    if "turnstile" in page_source or "cloudflare" in page_source:
-                        captcha_detectado = True
-                        print("🛡️ CAPTCHA detectado en código fuente")
+                self._libres.put(self._lanzar())
             except Exception as e:
-                print(f"⚠️ Error verificando CAPTCHA: {e}")
-            
-            if captcha_detectado:
-                print("\n👤 CAPTCHA detectado - Requiere intervención manual")
-                print("=" * 60)
-                print("INSTRUCCIONES:")
-                print("1. Busque el widget de Cloudflare en la página")
-                print("2. Resuelva el CAPTCHA manualmente")
-                print("3. El script continuará automáticamente")
-                print("=" * 60)
-                
-                print("\n⏳ Esperando a que resuelva el CAPTCHA (máximo 90 segundos)...")
-                for i in range(90):
+                self._liberar_cupo()
+                print(f"❌ Error lanzando navegador del pool: {e}")
+                return
+
+    def _esta_sana(self, sesion: SesionNavegador) -> bool:
+        try:
+            estado_doc = sesion.sb.driver.execute_script("return document.readyState")
+            return estado_doc in ("loading", "interactive", "complete")
+        except Exception:
+            return False
+
+    def _descartar(self, sesion: SesionNavegador, motivo: str):
+        print(f"♻️ Reciclando navegador #{sesion.numero} ({motivo})")
+        sesion.cerrar()
+        self._liberar_cupo()
+        with self._lock:
+            self.estadisticas['reciclados'] += 1
+        # Reponer el navegador en segundo plano
+        threading.Thread(target=self.calentar, daemon=True).start()
+
+    def _obtener(self) -> SesionNavegador:
+        limite = time.time() + self.timeout
+        while True:
+            try:
+                sesion = self._libres.get_nowait()
+            except queue.Empty:
+                if self._reservar_cupo():
                     try:
-                        token_value = sb.get_attribute("input[name='cf-turnstile-response']", "value")
-                        if token_value and len(token_value) > 20:
-                            print("✅ CAPTCHA resuelto exitosamente")
-                            break
-                    except:
-                        pass
-                    
-                    if i % 10 == 0 and i > 0:
-                        minutos = i // 60
-                        segundos = i % 60
-                        print(f"⏳ Esperando... {minutos}:{segundos:02d} / 1:30")
-                    
-                    time.sleep(1)
-                
-                time.sleep(2)
-            else:
-                print("✅ No se detectó CAPTCHA, continuando...")
-            
-            # 3) Consultar placa
-            print(f"\n📝 CONSULTANDO PLACA: {placa}")
-            sb.wait_for_element("#nroPlaca", timeout=20)
-            sb.clear("#nroPlaca")
-            time.sleep(0.5)
-            sb.type("#nroPlaca", placa)
-            print(f"✅ Placa '{placa}' ingresada")
-            
-            sb.wait_for_element("button.btn-sunarp-green", timeout=5)
-            sb.click("button.btn-sunarp-green")
-            print("✅ Consulta enviada")
-            
-            # 4) Esperar resultados
-            print("\n⏳ Esperando resultados...")
-            for i in range(5):
-                try:
-                    if sb.is_element_visible(".swal2-popup"):
-                        alert_text = sb.get_text(".swal2-title")
-                        if "captcha" in alert_text.lower() or "verificación" in alert_text.lower():
-                            print("❌ Error de CAPTCHA - Intente nuevamente")
-                            try:
-                                sb.click(".swal2-confirm")
-                                time.sleep(2)
-                            except:
-                                pass
-                            return {"success": False, "error": "CAPTCHA no resuelto"}
-                except:
-                    pass
-                
-                try:
-                    page_text = sb.get_page_source()
-                    if "DATOS DEL VEH" in page_text.upper():
-                        print("✅ Sección 'DATOS DEL VEHÍCULO' detectada")
-                        break
-                except:
-                    pass
-                
-                print(f"  Esperando... {i+1}/5 segundos", end="\r")
-                time.sleep(1)
-            print()
-            
-            # 5) Capturar screenshot
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            screenshot_filename = f"temp_sunarp_{placa}_{timestamp}.png"
-            
-            # Guardar screenshot temporal
-            sb.save_screenshot(screenshot_filename)
-            print(f"📸 Screenshot temporal guardado: {screenshot_filename}")
+                        sesion = self._lanzar()
+                    except Exception:
+                        self._liberar_cupo()
+                        raise
+                else:
+                    restante = limite - time.time()
+                    if restante <= 0:
+                        raise PoolAgotadoError(f"No hay navegadores libres en el pool SUNARP ({self.timeout}s)")
+                    with self._lock:
+                        self.estadisticas['esperas'] += 1
+                    try:
+                        sesion = self._libres.get(timeout=restante)
+                    except queue.Empty:
+                        raise PoolAgotadoError(f"No hay navegadores libres en el pool SUNARP ({self.timeout}s)")
+
+            if self._esta_sana(sesion):
+                with self._lock:
+                    self._en_uso += 1
+                    self.estadisticas['prestamos'] += 1
+                return sesion
+
+            with self._lock:
+                self.estadisticas['fallos_salud'] += 1
+            self._descartar(sesion, "falló el chequeo de salud")
+
+    def _preparar_y_liberar(self, sesion: SesionNavegador):
+        """Vuelve a dejar el navegador en la página de consulta antes de liberarlo"""
+        try:
+            sesion.sb.open(URL_SUNARP)
+            self._libres.put(sesion)
+        except Exception as e:
+            self._descartar(sesion, f"error recargando SUNARP: {e}")
+
+    def devolver(self, sesion: SesionNavegador):
+        with self._lock:
+            self._en_uso -= 1
+        sesion.usos += 1
+
+        if sesion.reciclar:
+            self._descartar(sesion, "marcado tras un error")
+        elif sesion.usos >= self.max_usos:
+            self._descartar(sesion, f"alcanzó {self.max_usos} usos")
+        elif not self._esta_sana(sesion):
+            with self._lock:
+                self.estadisticas['fallos_salud'] += 1
+            self._descartar(sesion, "falló el chequeo de salud")
+        else:
+            threading.Thread(target=self._preparar_y_liberar, args=(sesion,), daemon=True).start()
+
+    @contextmanager
+    def prestar(self):
+        """Presta un navegador del pool y lo devuelve al terminar"""
+        sesion = self._obtener()
+        try:
+            yield sesion
+        except Exception:
+            sesion.reciclar = True
+            raise
+        finally:
+            self.devolver(sesion)
+
+    def estado(self) -> dict:
+        with self._lock:
+            libres = self._libres.qsize()
+            return {
+                'tamano': self.tamano,
+                'vivos': self._creados,
+                'libres': libres,
+                'en_uso': self._en_uso,
+                'preparando': max(self._creados - libres - self._en_uso, 0),
+                'max_usos': self.max_usos,
+                **self.estadisticas
+            }
+
+    def cerrar(self):
+        """Cierra todos los navegadores libres (al apagar el servidor)"""
+        while True:
+            try:
+                sesion = self._libres.get_nowait()
+            except queue.Empty:
+                break
+            sesion.cerrar()
+            self._liberar_cupo()
+
+pool_sunarp = PoolNavegadoresSunarp(SUNARP_POOL_TAMANO, SUNARP_POOL_MAX_USOS, SUNARP_POOL_TIMEOUT)
+atexit.register(pool_sunarp.cerrar)
+
+# --- MOTOR DE ESPERAS POR CONDICIÓN DEL DOM ---
+# Timeouts por paso (segundos). Cada espera termina apenas se cumple su condición.
+TIMEOUTS_SUNARP = {
+    'formulario': 20,
+    'captcha_deteccion': 2,
+    'captcha_auto': 4,
+    'captcha_token': 90,
+    'campo_limpio': 2,
+    'resultado': 10,
+    'alerta_cerrada': 2,
+    'formulario_reuso': 3,
+}
+ESPERA_TRAMO_MAXIMO = 10   # Segundos por llamada asíncrona al navegador (avisos de progreso entre tramos)
+
+XPATH_DATOS_VEHICULO = (
+    "//*[contains(translate(normalize-space(text()), 'abcdefghijklmnopqrstuvwxyzí', "
+    "'ABCDEFGHIJKLMNOPQRSTUVWXYZÍ'), 'DATOS DEL VEH')]"
+)
+# Excluye el resultado de la placa anterior cuando se reutiliza la página (ver JS_MARCAR_RESULTADO_ANTERIOR)
+XPATH_DATOS_VEHICULO_NUEVOS = XPATH_DATOS_VEHICULO + "[not(@data-consulta-anterior)]"
+
+# Condiciones (expresiones JavaScript evaluadas dentro de la página)
+JS_FORMULARIO_LISTO = "document.readyState === 'complete' && !!document.querySelector('#nroPlaca')"
+JS_CAPTCHA_PRESENTE = (
+    "!!document.querySelector(\"div.cf-turnstile, .cf-turnstile, iframe[src*='cloudflare.com'], "
+    "input[name='cf-turnstile-response'], script[src*='turnstile']\")"
+)
+# Turnstile puede inyectarse después de que el formulario esté listo: sin CAPTCHA visible, la página
+# se da por libre de CAPTCHA solo cuando el DOM lleva CAPTCHA_ASENTAMIENTO_MS sin cambios
+CAPTCHA_ASENTAMIENTO_MS = 400
+JS_VIGILAR_MUTACIONES = (
+    "window.__ultimaMutacion = Date.now(); "
+    "if (!window.__vigiaMutaciones) { "
+    "window.__vigiaMutaciones = new MutationObserver(function() { window.__ultimaMutacion = Date.now(); }); "
+    "window.__vigiaMutaciones.observe(document, {subtree: true, childList: true, attributes: true}); }"
+)
+JS_CAPTCHA_O_FORMULARIO_LISTO = (
+    f"({JS_CAPTCHA_PRESENTE}) || (({JS_FORMULARIO_LISTO}) && !!document.querySelector('button.btn-sunarp-green') "
+    f"&& Date.now() - window.__ultimaMutacion >= {CAPTCHA_ASENTAMIENTO_MS})"
+)
+JS_TOKEN_TURNSTILE = (
+    "(function(){ var i = document.querySelector(\"input[name='cf-turnstile-response']\"); "
+    "return !!i && !!i.value && i.value.length > 20; })()"
+)
+JS_CAMPO_PLACA_VACIO = "(function(){ var i = document.querySelector('#nroPlaca'); return !!i && i.value === ''; })()"
+JS_DATOS_VEHICULO_VISIBLES = (
+    "!!document.evaluate(\"" + XPATH_DATOS_VEHICULO_NUEVOS + "\", document, null, "
+    "XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue"
+)
+JS_ALERTA_VISIBLE = "(function(){ var p = document.querySelector('.swal2-popup'); return !!p && p.offsetParent !== null; })()"
+JS_RESULTADO_O_ALERTA = f"({JS_DATOS_VEHICULO_VISIBLES}) || ({JS_ALERTA_VISIBLE})"
+JS_ALERTA_CERRADA = "!document.querySelector('.swal2-container')"
+JS_MARCAR_RESULTADO_ANTERIOR = (
+    "var r = document.evaluate(\"" + XPATH_DATOS_VEHICULO + "\", document, null, "
+    "XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null); "
+    "for (var i = 0; i < r.snapshotLength; i++) r.snapshotItem(i).setAttribute('data-consulta-anterior', '1'); "
+    "return r.snapshotLength;"
+)
+
+# Espera dentro del navegador: MutationObserver + sondeo corto, una sola llamada WebDriver
+JS_ESPERAR_CONDICION = """
+var limite = arguments[0];
+var terminar = arguments[arguments.length - 1];
+var fin = false, obs = null, intervalo = null, temporizador = null;
+function cumplida() { try { return !!(__CONDICION__); } catch (e) { return false; } }
+function cerrar(valor) {
+    if (fin) return;
+    fin = true;
+    if (obs) obs.disconnect();
+    clearInterval(intervalo);
+    clearTimeout(temporizador);
+    terminar(valor);
+}
+function revisar() { if (cumplida()) cerrar(true); }
+obs = new MutationObserver(revisar);
+obs.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+intervalo = setInterval(revisar, 50);
+temporizador = setTimeout(function() { cerrar(cumplida()); }, limite);
+revisar();
+"""
+
+class MotorEsperas:
+    """Esperas que terminan apenas se cumple una condición del DOM, con registro de tiempos"""
+    def __init__(self, sb):
+        self.sb = sb
+        self.tiempos = {}
+
+    def _tramo(self, condicion_js: str, segundos: float) -> bool:
+        script = JS_ESPERAR_CONDICION.replace("__CONDICION__", condicion_js)
+        try:
+            self.sb.driver.set_script_timeout(segundos + 5)
+            return bool(self.sb.driver.execute_async_script(script, int(segundos * 1000)))
+        except Exception:
+            # Navegación en curso o documento reemplazado: reintentar en el siguiente tramo
+            time.sleep(min(0.2, segundos))
+            return False
+
+    def esperar(self, paso: str, condicion_js: str, timeout: float = None, progreso=None) -> bool:
+        """Espera hasta que la condición sea verdadera o venza el timeout del paso"""
+        if timeout is None:
+            timeout = TIMEOUTS_SUNARP.get(paso, 10)
+        inicio = time.perf_counter()
+        cumplida = False
+        while True:
+            restante = timeout - (time.perf_counter() - inicio)
+            if restante <= 0:
+                break
+            if self._tramo(condicion_js, min(restante, ESPERA_TRAMO_MAXIMO)):
+                cumplida = True
+                break
+            if progreso:
+                progreso(time.perf_counter() - inicio)
+
+        self.tiempos[paso] = {
+            'segundos': round(time.perf_counter() - inicio, 3),
+            'cumplida': cumplida,
+            'timeout': timeout
+        }
+        return cumplida
+
+    def resumen(self) -> str:
+        return ", ".join(
+            f"{paso}={t['segundos']}s{'' if t['cumplida'] else ' (timeout)'}"
+            for paso, t in self.tiempos.items()
+        )
+
+# --- CAPTURA DE PANTALLA EN MEMORIA ---
+def capturar_pantalla_png(sb) -> bytes:
+    """Captura la ventana como bytes PNG vía CDP (sin escribir archivos temporales)"""
+    try:
+        captura = sb.driver.execute_cdp_cmd("Page.captureScreenshot", {"format": "png"})
+        return base64.b64decode(captura['data'])
+    except Exception as e:
+        print(f"⚠️ CDP no disponible para screenshot ({e}), usando WebDriver")
+        return sb.driver.get_screenshot_as_png()
+
+# --- PREPARACIÓN DE IMAGEN PARA GEMINI ---
+IMAGEN_MAX_LADO = 1024       # Resolución máxima (px) del lado mayor
+IMAGEN_FORMATO = "PNG"       # PNG en escala de grises conserva bien el texto; también "JPEG" o "WEBP"
+IMAGEN_CALIDAD = 80          # Calidad para JPEG/WEBP
+
+# Ubica el panel que contiene el título "DATOS DEL VEHÍCULO" y devuelve su rectángulo en la página
+JS_UBICAR_PANEL_VEHICULO = """
+var titulo = document.evaluate(arguments[0], document, null,
+    XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+if (!titulo) return null;
+var panel = null, nodo = titulo.parentElement;
+while (nodo && nodo !== document.body) {
+    var texto = (nodo.innerText || '').toUpperCase();
+    if (texto.indexOf('ANOTACIONES') !== -1 && texto.indexOf('MARCA') !== -1) { panel = nodo; break; }
+    if (!panel && nodo.querySelector('img, table')) { panel = nodo; }
+    nodo = nodo.parentElement;
+}
+panel = panel || titulo.parentElement;
+"""
+
+JS_RECTANGULO_PANEL_VEHICULO = JS_UBICAR_PANEL_VEHICULO + """
+panel.scrollIntoView({block: 'start'});
+var r = panel.getBoundingClientRect();
+return {x: r.left + window.scrollX, y: r.top + window.scrollY, width: r.width, height: r.height};
+"""
+
+def capturar_panel_datos_vehiculo(sb) -> bytes:
+    """Captura solo el panel 'DATOS DEL VEHÍCULO'; si no se ubica, captura la ventana completa"""
+    try:
+        rect = sb.driver.execute_script(JS_RECTANGULO_PANEL_VEHICULO, XPATH_DATOS_VEHICULO_NUEVOS)
+        if rect and rect['width'] > 0 and rect['height'] > 0:
+            captura = sb.driver.execute_cdp_cmd("Page.captureScreenshot", {
+                "format": "png",
+                "captureBeyondViewport": True,
+                "clip": {
+                    "x": rect['x'],
+                    "y": rect['y'],
+                    "width": rect['width'],
+                    "height": rect['height'],
+                    "scale": 1
+                }
+            })
+            print(f"✂️ Panel 'DATOS DEL VEHÍCULO' recortado ({int(rect['width'])}x{int(rect['height'])})")
+            return base64.b64decode(captura['data'])
+        print("⚠️ No se ubicó el panel de datos, se captura la ventana completa")
+    except Exception as e:
+        print(f"⚠️ Error recortando el panel de datos ({e}), se captura la ventana completa")
+    return capturar_pantalla_png(sb)
+
+def preparar_imagen_para_gemini(imagen_bytes: bytes) -> tuple:
+    """Escala de grises, resolución acotada y recodificación compacta. Devuelve (bytes, estadísticas)"""
+    img = cargar_imagen_en_memoria(imagen_bytes)
+    dimensiones_originales = img.size
+    
+    img = img.convert("L")
+    img.thumbnail((IMAGEN_MAX_LADO, IMAGEN_MAX_LADO), Image.LANCZOS)
+    
+    buffer = BytesIO()
+    if IMAGEN_FORMATO == "PNG":
+        img.save(buffer, format="PNG", optimize=True)
+    else:
+        img.save(buffer, format=IMAGEN_FORMATO, quality=IMAGEN_CALIDAD)
+    imagen_final = buffer.getvalue()
+    
+    dimensiones_enviadas = img.size
+    
+    # Si la recodificación no ahorra nada, se envía la captura original
+    if len(imagen_final) >= len(imagen_bytes):
+        imagen_final = imagen_bytes
+        dimensiones_enviadas = dimensiones_originales
+    
+    bytes_ahorrados = len(imagen_bytes) - len(imagen_final)
+    estadisticas = {
+        'bytes_originales': len(imagen_bytes),
+        'bytes_enviados': len(imagen_final),
+        'bytes_ahorrados': bytes_ahorrados,
+        'porcentaje_ahorro': round(100 * bytes_ahorrados / len(imagen_bytes), 1) if imagen_bytes else 0,
+        'dimensiones_originales': list(dimensiones_originales),
+        'dimensiones_enviadas': list(dimensiones_enviadas),
+        'formato': IMAGEN_FORMATO
+    }
+    print(f"🗜️ Imagen preparada: {estadisticas['bytes_originales']} → {estadisticas['bytes_enviados']} bytes "
+          f"(-{estadisticas['porcentaje_ahorro']}%)")
+    return imagen_final, estadisticas
+
+# --- EXTRACCIÓN DIRECTA DESDE EL DOM (CAMINO RÁPIDO) ---
+
+JS_TEXTO_PANEL_VEHICULO = JS_UBICAR_PANEL_VEHICULO + """
+return panel.innerText || '';
+"""
+
+# Etiqueta (sin "Nº " ni ":") -> campo de CAMPOS_VEHICULO
+_ETIQUETAS_VEHICULO = {
+    re.sub(r'^Nº\s+', '', campo.rstrip(':')): campo for campo in CAMPOS_VEHICULO
+}
+# Una etiqueta solo cuenta al inicio de su línea o celda: "MARCA: TOYOTA" o la celda "MARCA" sola
+_PATRON_ETIQUETAS_VEHICULO = re.compile(
+    r'(?:N\s*[º°O]\.?\s*)?('
+    + '|'.join(re.escape(e) for e in sorted(_ETIQUETAS_VEHICULO, key=len, reverse=True))
+    + r')\s*(?::\s*(.*))?'
+)
+
+def extraer_campos_de_texto_panel(texto_panel: str) -> DatosVehiculo:
+    """Lee cada campo de CAMPOS_VEHICULO de su propia línea o celda (o de la celda siguiente a la etiqueta)"""
+    if not texto_panel:
+        return DatosVehiculo()
+    
+    texto = texto_panel.upper()
+    inicio_seccion = texto.find("DATOS DEL VEH")
+    if inicio_seccion != -1:
+        texto = texto[inicio_seccion:]
+        texto = texto.split('\n', 1)[1] if '\n' in texto else ""
+    
+    # innerText separa las filas con saltos de línea y las celdas de una tabla con tabuladores
+    celdas = [' '.join(celda.split()) for linea in texto.split('\n') for celda in linea.split('\t')]
+    celdas = [celda for celda in celdas if celda]
+    etiquetas = [_PATRON_ETIQUETAS_VEHICULO.fullmatch(celda) for celda in celdas]
+    
+    valores = {}
+    for i, etiqueta in enumerate(etiquetas):
+        if not etiqueta:
+            continue    # Valor ya leído u otra sección del panel (SEDE, PROPIETARIOS...)
+        campo = _ETIQUETAS_VEHICULO[etiqueta.group(1)]
+        if campo in valores:
+            continue
+        valor = (etiqueta.group(2) or "").strip()
+        if not valor and i + 1 < len(celdas) and not etiquetas[i + 1]:
+            valor = celdas[i + 1]
+        valores[campo] = valor
+    
+    return DatosVehiculo.desde_etiquetas(valores)
+
+def extraer_datos_vehiculo_dom(sb) -> dict:
+    """Lee los campos del vehículo directamente del DOM renderizado (mismo formato que la salida de Gemini)"""
+    try:
+        texto_panel = sb.driver.execute_script(JS_TEXTO_PANEL_VEHICULO, XPATH_DATOS_VEHICULO_NUEVOS) or ""
+        datos = extraer_campos_de_texto_panel(texto_panel)
+        return {
+            "datos_vehiculo_crudo": texto_panel,
+            "datos": datos,
+            "campos_encontrados": datos.campos_encontrados(),
+            "error": None
+        }
+    except Exception as e:
+        print(f"⚠️ Error leyendo datos del DOM: {e}")
+        return {"datos_vehiculo_crudo": "", "datos": DatosVehiculo(), "campos_encontrados": 0, "error": str(e)}
+
+# --- CAPTURA DEL JSON DEL BACKEND (CDP NETWORK) ---
+MODOS_EXTRACCION = ("json", "dom", "gemini")   # Orden de respaldo entre métodos
+SUNARP_MODO_EXTRACCION = "dom"                  # Modo por defecto ("json" aún no se validó contra respuestas reales)
+CAMPOS_MINIMOS_EXTRACCION = 11                  # Por debajo de este número se pasa al siguiente método
+# Solo el endpoint de datos del vehículo: el último segmento de la ruta (no el subdominio) lo nombra
+SUNARP_API_PATRON = re.compile(
+    r"sunarp\.gob\.pe(?::\d+)?/(?:[^?#]*/)?(?:[^/?#]*vehicul[^/?#]*|getdatos[^/?#]*)(?:[?#]|$)",
+    re.IGNORECASE
+)
+
+# Clave JSON normalizada -> campo de CAMPOS_VEHICULO
+ALIAS_CAMPOS_JSON = {
+    'placa': "Nº PLACA:",
+    'serie': "Nº SERIE:",
+    'vin': "Nº VIN:",
+    'motor': "Nº MOTOR:",
+    'color': "COLOR:",
+    'marca': "MARCA:",
+    'modelo': "MODELO:",
+    'placavigente': "PLACA VIGENTE:",
+    'placaanterior': "PLACA ANTERIOR:",
+    'estado': "ESTADO:",
+    'anotaciones': "ANOTACIONES:",
+    'anotacion': "ANOTACIONES:",
+}
+
+def _normalizar_clave_json(clave: str) -> str:
+    clave = re.sub(r'[^a-z0-9]', '', str(clave).lower())
+    return re.sub(r'^(numero|nro|num)(?=[a-z])', '', clave)
+
+def _valor_json(valor) -> str:
+    """Texto de un valor escalar (o lista de escalares, p. ej. varias anotaciones); '' si es un objeto"""
+    if isinstance(valor, list) and all(isinstance(v, (str, int, float)) for v in valor):
+        return ' | '.join(str(v).strip() for v in valor if str(v).strip())
+    if isinstance(valor, (str, int, float)) and not isinstance(valor, bool):
+        return str(valor).strip()
+    return ""
+
+def _campos_de_objeto_json(objeto: dict) -> dict:
+    """Campos de CAMPOS_VEHICULO presentes directamente en este objeto (sin bajar a sus hijos)"""
+    valores = {}
+    for clave, valor in objeto.items():
+        campo = ALIAS_CAMPOS_JSON.get(_normalizar_clave_json(clave))
+        if campo and campo not in valores and _valor_json(valor):
+            valores[campo] = _valor_json(valor)
+    return valores
+
+def _objetos_json(nodo):
+    """Todos los objetos del documento, a cualquier profundidad"""
+    if isinstance(nodo, dict):
+        yield nodo
+        for valor in nodo.values():
+            yield from _objetos_json(valor)
+    elif isinstance(nodo, list):
+        for elemento in nodo:
+            yield from _objetos_json(elemento)
+
+def campos_desde_json(respuestas: list) -> DatosVehiculo:
+    """Convierte las respuestas JSON del backend en el registro de datos del vehículo.
+    
+    Todos los campos salen de un solo objeto: el que tiene más claves del vehículo (a igualdad,
+    el que tiene la placa). Así las claves del sobre ("estado": "00") no pisan las del vehículo.
+    """
+    mejor = {}
+    for respuesta in respuestas:
+        for objeto in _objetos_json(respuesta):
+            valores = _campos_de_objeto_json(objeto)
+            if (len(valores), "Nº PLACA:" in valores) > (len(mejor), "Nº PLACA:" in mejor):
+                mejor = valores
+    return DatosVehiculo.desde_etiquetas(mejor)
+
+def limpiar_log_red(sb):
+    """Descarta los eventos de red acumulados (get_log vacía el buffer)"""
+    try:
+        sb.driver.get_log("performance")
+    except Exception:
+        pass
+
+def capturar_respuestas_json(sb) -> list:
+    """Lee los eventos Network.responseReceived del log de CDP y devuelve los cuerpos JSON de SUNARP"""
+    respuestas = []
+    for entrada in sb.driver.get_log("performance"):
+        try:
+            mensaje = json.loads(entrada['message'])['message']
+        except Exception:
+            continue
+        if mensaje.get('method') != 'Network.responseReceived':
+            continue
+        params = mensaje.get('params', {})
+        respuesta = params.get('response', {})
+        if 'json' not in respuesta.get('mimeType', '') or not SUNARP_API_PATRON.search(respuesta.get('url', '')):
+            continue
+        try:
+            cuerpo = sb.driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": params['requestId']})
+            texto = cuerpo.get('body', '')
+            if cuerpo.get('base64Encoded'):
+                texto = base64.b64decode(texto).decode('utf-8')
+            respuestas.append(json.loads(texto))
+            print(f"📡 JSON capturado: {respuesta['url']}")
+        except Exception as e:
+            print(f"⚠️ No se pudo leer la respuesta {respuesta.get('url')}: {e}")
+    return respuestas
+
+def extraer_datos_vehiculo_json(sb) -> dict:
+    """Extrae los datos del vehículo del JSON que devolvió el backend de SUNARP"""
+    try:
+        respuestas = capturar_respuestas_json(sb)
+        datos = campos_desde_json(respuestas)
+        return {
+            "datos_vehiculo_crudo": json.dumps(respuestas, ensure_ascii=False) if respuestas else "",
+            "datos": datos,
+            "campos_encontrados": datos.campos_encontrados(),
+            "error": None if respuestas else "No se capturó JSON de SUNARP"
+        }
+    except Exception as e:
+        print(f"⚠️ Error capturando JSON de SUNARP: {e}")
+        return {"datos_vehiculo_crudo": "", "datos": DatosVehiculo(), "campos_encontrados": 0, "error": str(e)}
+
+def extraer_datos_vehiculo(sb, modo: str) -> dict:
+    """Extrae los datos según el modo (json → dom → gemini) y registra el tiempo de cada método"""
+    resultado_final = {"datos_vehiculo_crudo": "", "datos": DatosVehiculo(), "campos_encontrados": 0, "error": None}
+    metodo_usado = None
+    tiempos = {}
+    campos_por_metodo = {}
+    estadisticas_imagen = None
+    error_gemini = None
+    modelo_gemini = None
+    
+    for metodo in MODOS_EXTRACCION[MODOS_EXTRACCION.index(modo):]:
+        inicio = time.perf_counter()
+        if metodo == "json":
+            print("\n📡 LEYENDO DATOS DEL VEHÍCULO DESDE EL JSON DEL BACKEND...")
+            resultado = extraer_datos_vehiculo_json(sb)
+        elif metodo == "dom":
+            print("\n🔍 LEYENDO DATOS DEL VEHÍCULO DESDE EL DOM...")
+            resultado = extraer_datos_vehiculo_dom(sb)
+        else:
+            screenshot_png = capturar_panel_datos_vehiculo(sb)
+            print(f"📸 Screenshot capturado en memoria ({len(screenshot_png)} bytes)")
+            imagen_gemini, estadisticas_imagen = preparar_imagen_para_gemini(screenshot_png)
             
-            # 6) Extraer datos con Gemini
             print("\n🔍 EXTRACIENDO SOLO DATOS DEL VEHÍCULO CON GEMINI...")
-            resultado_gemini = obtener_datos_vehiculo_con_gemini(screenshot_filename)
-            
-            datos_vehiculo = resultado_gemini.get("datos_vehiculo_limpio", "")
-            
-            # 7) Parsear datos
-            datos_parseados = parsear_datos_vehiculo(datos_vehiculo)
-            
-            # 8) Guardar en base de datos
-            db_resultado = guardar_placa_sunarp_en_db(placa, datos_parseados)
-            
-            # 9) Eliminar archivo temporal
-            if os.path.exists(screenshot_filename):
-                os.remove(screenshot_filename)
-                print(f"🗑️ Archivo temporal eliminado: {screenshot_filename}")
-            
-            print("\n⏳ Navegador se mantendrá abierto 3 segundos...")
-            time.sleep(3)
+            resultado = obtener_datos_vehiculo_enrutado(imagen_gemini)
+            error_gemini = resultado.get("error")
+            modelo_gemini = resultado.get("modelo")
+        
+        tiempos[metodo] = round(time.perf_counter() - inicio, 3)
+        campos_por_metodo[metodo] = resultado.get("campos_encontrados", 0)
+        print(f"📋 Campos obtenidos ({metodo}): {campos_por_metodo[metodo]}/{len(CAMPOS_VEHICULO)} en {tiempos[metodo]}s")
+        
+        if metodo_usado is None or campos_por_metodo[metodo] > resultado_final.get("campos_encontrados", 0):
+            resultado_final = resultado
+            metodo_usado = metodo
+        if campos_por_metodo[metodo] >= CAMPOS_MINIMOS_EXTRACCION:
+            break
+        print(f"⚠️ Extracción '{metodo}' incompleta, probando el siguiente método")
+    
+    return {
+        "resultado": resultado_final,
+        "metodo": metodo_usado,
+        "tiempos": tiempos,
+        "campos_por_metodo": campos_por_metodo,
+        "imagen": estadisticas_imagen,
+        "error_gemini": error_gemini,
+        "modelo_gemini": modelo_gemini
+    }
+
+def preparar_formulario_sunarp(sb, esperas: MotorEsperas) -> bool:
+    """Deja #nroPlaca listo para otra placa; solo recarga la página si no se puede reutilizar"""
+    if URL_SUNARP.rstrip('/') in sb.get_current_url():
+        # Cerrar la alerta que haya dejado la consulta anterior
+        if sb.driver.execute_script(f"return {JS_ALERTA_VISIBLE}"):
+            try:
+                sb.click(".swal2-confirm")
+                esperas.esperar('alerta_cerrada', JS_ALERTA_CERRADA)
+            except Exception:
+                pass
+        if esperas.esperar('formulario_reuso', JS_FORMULARIO_LISTO):
+            # Marcar el resultado anterior para no confundirlo con el de esta placa
+            if sb.driver.execute_script(JS_MARCAR_RESULTADO_ANTERIOR):
+                print("♻️ Reutilizando la página con el resultado anterior marcado")
+            return True
+        print("🔄 El formulario no se puede reutilizar, recargando SUNARP...")
+    else:
+        print("🌐 Navegando a SUNARP...")
+    sb.open(URL_SUNARP)
+    return esperas.esperar('formulario', JS_FORMULARIO_LISTO)
+
+# --- FUNCIÓN DE CONSULTA SUNARP (OPTIMIZADA) ---
+def consultar_sunarp_con_gemini(placa: str, modo: str = None, sesion: SesionNavegador = None):
+    """Consulta una placa con un navegador del pool, o con 'sesion' si el llamador ya tiene uno prestado"""
+    if sesion is None:
+        reportar_etapa('navegador')
+        with pool_sunarp.prestar() as sesion:
+            return consultar_sunarp_con_gemini(placa, modo, sesion)
+    
+    modo = modo or SUNARP_MODO_EXTRACCION
+    print("=" * 80)
+    print("🚗 CONSULTA SUNARP - GEMINI (SOLO DATOS DEL VEHÍCULO)")
+    print("=" * 80)
+    print(f"🎯 Consultando placa: {placa}")
+    
+    sb = sesion.sb
+    try:
+        esperas = MotorEsperas(sb)
+        
+        # 1) Abrir SUNARP (el navegador del pool ya suele estar en la página)
+        print(f"\n🌐 Usando navegador #{sesion.numero} del pool (uso {sesion.usos + 1})")
+        if not preparar_formulario_sunarp(sb, esperas):
+            raise Exception("El formulario de SUNARP no cargó a tiempo")
+        print(f"📄 Título: {sb.get_title()}")
+        
+        # 2) Detectar CAPTCHA
+        reportar_etapa('captcha')
+        print("\n🔍 Verificando CAPTCHA...")
+        sb.driver.execute_script(JS_VIGILAR_MUTACIONES)
+        esperas.esperar('captcha_deteccion', JS_CAPTCHA_O_FORMULARIO_LISTO)
+        captcha_detectado = bool(sb.driver.execute_script(f"return {JS_CAPTCHA_PRESENTE}"))
+        
+        if captcha_detectado and esperas.esperar('captcha_auto', JS_TOKEN_TURNSTILE):
+            print("✅ CAPTCHA resuelto automáticamente")
+        elif captcha_detectado:
+            print("\n👤 CAPTCHA detectado - Requiere intervención manual")
+            print("=" * 60)
+            print("INSTRUCCIONES:")
+            print("1. Busque el widget de Cloudflare en la página")
+            print("2. Resuelva el CAPTCHA manualmente")
+            print("3. El script continuará automáticamente")
+            print("=" * 60)
             
-            return {
-                "success": True,
-                "placa": placa,
-                "datos_vehiculo_texto": datos_vehiculo,
-                "datos_vehiculo_estructurado": datos_parseados,
-                "base_datos": db_resultado,
-                "estadisticas": {
-                    "campos_encontrados": resultado_gemini.get("campos_encontrados", 0),
-                    "exito_extraccion": bool(datos_vehiculo),
-                    "error_gemini": resultado_gemini.get("error")
-                }
-            }
+            timeout_token = TIMEOUTS_SUNARP['captcha_token']
+            print(f"\n⏳ Esperando a que resuelva el CAPTCHA (máximo {timeout_token} segundos)...")
             
-        except Exception as e:
-            print(f"❌ Error general: {e}")
-            import traceback
-            traceback.print_exc()
+            def aviso_captcha(transcurrido):
+                minutos, segundos = divmod(int(transcurrido), 60)
+                print(f"⏳ Esperando... {minutos}:{segundos:02d} / {timeout_token // 60}:{timeout_token % 60:02d}")
             
+            if esperas.esperar('captcha_token', JS_TOKEN_TURNSTILE, progreso=aviso_captcha):
+                print("✅ CAPTCHA resuelto exitosamente")
+        else:
+            print("✅ No se detectó CAPTCHA, continuando...")
+        
+        # 3) Consultar placa
+        reportar_etapa('envio_placa')
+        print(f"\n📝 CONSULTANDO PLACA: {placa}")
+        sb.wait_for_element("#nroPlaca", timeout=TIMEOUTS_SUNARP['formulario'])
+        sb.clear("#nroPlaca")
+        esperas.esperar('campo_limpio', JS_CAMPO_PLACA_VACIO)
+        sb.type("#nroPlaca", placa)
+        print(f"✅ Placa '{placa}' ingresada")
+        
+        sb.wait_for_element("button.btn-sunarp-green", timeout=5)
+        limpiar_log_red(sb)   # Solo interesan las respuestas posteriores al clic
+        sb.click("button.btn-sunarp-green")
+        print("✅ Consulta enviada")
+        
+        # 4) Esperar resultados (sección de datos o alerta de error)
+        reportar_etapa('resultado')
+        print("\n⏳ Esperando resultados...")
+        resultado_visible = esperas.esperar('resultado', JS_RESULTADO_O_ALERTA)
+        if resultado_visible:
             try:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                sb.save_screenshot(f"error_sunarp_{placa}_{timestamp}.png")
-                print(f"📸 Screenshot del error guardado")
+                if sb.is_element_visible(".swal2-popup"):
+                    alert_text = sb.get_text(".swal2-title")
+                    if "captcha" in alert_text.lower() or "verificación" in alert_text.lower():
+                        print("❌ Error de CAPTCHA - Intente nuevamente")
+                        try:
+                            sb.click(".swal2-confirm")
+                            esperas.esperar('alerta_cerrada', JS_ALERTA_CERRADA)
+                        except:
+                            pass
+                        return {"success": False, "error": "CAPTCHA no resuelto", "tiempos_espera": esperas.tiempos}
             except:
                 pass
-            
-            return {"success": False, "error": str(e)}
+            print("✅ Sección 'DATOS DEL VEHÍCULO' detectada")
+        else:
+            print("⚠️ La sección 'DATOS DEL VEHÍCULO' no apareció a tiempo")
+        
+        # 5) Extraer datos (JSON del backend, DOM o Gemini según el modo)
+        reportar_etapa('extraccion')
+        print(f"\n🧭 Modo de extracción: {modo}")
+        extraccion = extraer_datos_vehiculo(sb, modo)
+        resultado_extraccion = extraccion["resultado"]
+        datos = resultado_extraccion["datos"]
+        
+        # Una fila vacía o de otra consulta se serviría desde caché durante SUNARP_CACHE_MAX_EDAD
+        if not resultado_visible or datos.campos_encontrados() == 0:
+            print(f"⏱️ Esperas: {esperas.resumen()}")
+            return {
+                "success": False,
+                "error": ("La sección 'DATOS DEL VEHÍCULO' no apareció a tiempo" if not resultado_visible
+                          else "No se extrajo ningún dato del vehículo"),
+                "tiempos_espera": esperas.tiempos
+            }
+        
+        # 6) Guardar en base de datos
+        reportar_etapa('guardado')
+        db_resultado = guardar_placa_sunarp_en_db(placa, datos)
+        
+        print(f"⏱️ Esperas: {esperas.resumen()}")
+        
+        return {
+            "success": True,
+            "placa": placa,
+            "datos_vehiculo_texto": datos.a_texto(),
+            "datos_vehiculo_estructurado": datos.a_dict(),
+            "base_datos": db_resultado,
+            "estadisticas": {
+                "campos_encontrados": resultado_extraccion.get("campos_encontrados", 0),
+                "modo_extraccion": modo,
+                "metodo_extraccion": extraccion["metodo"],
+                "campos_por_metodo": extraccion["campos_por_metodo"],
+                "tiempos_extraccion": extraccion["tiempos"],
+                "exito_extraccion": datos.campos_encontrados() > 0,
+                "error_gemini": extraccion["error_gemini"],
+                "modelo_gemini": extraccion["modelo_gemini"],
+                "tiempos_espera": esperas.tiempos,
+                "imagen": extraccion["imagen"]
+            }
+        }
+        
+    except Exception as e:
+        print(f"❌ Error general: {e}")
+        import traceback
+        traceback.print_exc()
+        sesion.reciclar = True
+        
+        try:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            sb.save_screenshot(f"error_sunarp_{placa}_{timestamp}.png")
+            print(f"📸 Screenshot del error guardado")
+        except:
+            pass
+        
+        return {"success": False, "error": str(e)}
+
+def consultar_sunarp_coordinado(placa: str, modo: str = None, sesion: SesionNavegador = None) -> dict:
+    """Consulta SUNARP con un solo nodo del clúster haciendo el scraping de cada placa"""
+    # El navegador se toma antes del lock: esperar el pool con el lock tomado consumiría el
+    # lease (COORDINACION_LEASE) y otro nodo repetiría el scraping
+    if sesion is None and COORDINACION_ACTIVA:
+        reportar_etapa('navegador')
+        with pool_sunarp.prestar() as sesion:
+            return consultar_sunarp_coordinado(placa, modo, sesion)
+    
+    def leer_reciente(max_edad):
+        registro = buscar_placa_en_cache(placa, max_edad)
+        if not registro:
+            return None
+        respuesta = respuesta_sunarp_desde_cache(registro, max_edad)
+        respuesta['estadisticas']['metodo_extraccion'] = 'otro_nodo'
+        return respuesta
+    
+    return coordinador_nodos.ejecutar(
+        'sunarp', normalizar_placa(placa), consultar_sunarp_con_gemini, (placa, modo, sesion), leer_reciente
+    )
 
 # ==============================================
 # SECCIÓN 4: FUNCIONES SCPPP
 # ==============================================
 
-def obtener_texto_con_easyocr(imagen_bytes):
-    """Envía la imagen a EasyOCR para extraer el texto"""
+# --- SOLUCIONADOR DE CAPTCHA SCPPP (NUMPY) ---
+# Preprocesado vectorizado + segmentación por columnas + clasificador por centroides.
+# Los centroides se generan con entrenar_modelo_captcha() a partir de CAPTCHAs etiquetados.
+# Arranque sin modelo: mientras no exista CAPTCHA_MODELO_RUTA se resuelve con EasyOCR y se guardan
+# los CAPTCHAs que el SCPPP aceptó; al juntar CAPTCHA_AUTOENTRENAR_MUESTRAS se entrena solo
+# (o a mano con "python flask_mix.py entrenar-captcha").
+CAPTCHA_MODELO_RUTA = "captcha_scppp_modelo.npz"
+CAPTCHA_AUTOENTRENAR_MUESTRAS = 300   # CAPTCHAs aceptados para el primer modelo; 0 = no capturar sin modelo
+CAPTCHA_CARACTERES = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+CAPTCHA_LONGITUD_MIN = 4
+CAPTCHA_LONGITUD_MAX = 6
+CAPTCHA_LADO_GLIFO = 20            # Cada carácter se normaliza a un cuadrado de N x N píxeles
+CAPTCHA_ANCHO_MINIMO = 2           # Columnas: segmentos más angostos se consideran ruido
+CAPTCHA_CONFIANZA_MINIMA = 0.55    # Similitud coseno mínima por carácter para no usar EasyOCR
+
+_modelo_captcha = None
+_modelo_captcha_lock = threading.Lock()
+_modelo_captcha_cargado = False
+
+def binarizar_captcha(imagen_bytes: bytes) -> np.ndarray:
+    """Escala de grises + umbral de Otsu + limpieza de píxeles sueltos. Devuelve una matriz booleana (True = tinta)"""
+    np = obtener_numpy()
+    gris = np.asarray(Image.open(BytesIO(imagen_bytes)).convert('L'), dtype=np.uint8)
+    
+    # Umbral de Otsu sobre el histograma
+    histograma = np.bincount(gris.ravel(), minlength=256).astype(np.float64)
+    niveles = np.arange(256)
+    peso_fondo = np.cumsum(histograma)
+    peso_tinta = peso_fondo[-1] - peso_fondo
+    suma_fondo = np.cumsum(histograma * niveles)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        media_fondo = suma_fondo / peso_fondo
+        media_tinta = (suma_fondo[-1] - suma_fondo) / peso_tinta
+        varianza = peso_fondo * peso_tinta * (media_fondo - media_tinta) ** 2
+    umbral = int(np.nanargmax(varianza))
+    
+    tinta = gris <= umbral
+    if tinta.mean() > 0.5:   # Texto claro sobre fondo oscuro
+        tinta = ~tinta
+    
+    # Quitar ruido: un píxel de tinta sobrevive si tiene al menos 2 vecinos de tinta
+    relleno = np.pad(tinta, 1).astype(np.uint8)
+    alto, ancho = tinta.shape
+    vecinos = sum(
+        relleno[1 + dy:1 + dy + alto, 1 + dx:1 + dx + ancho]
+        for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx
+    )
+    return tinta & (vecinos >= 2)
+
+def segmentar_caracteres(tinta: np.ndarray, cantidad: int = None) -> list:
+    """Corta la imagen en columnas sin tinta. Con 'cantidad' divide o descarta segmentos hasta llegar a ella"""
+    np = obtener_numpy()
+    columnas = tinta.sum(axis=0)
+    ocupadas = np.concatenate(([0], (columnas > 0).astype(np.int8), [0]))
+    cambios = np.flatnonzero(np.diff(ocupadas))
+    segmentos = [
+        (inicio, fin) for inicio, fin in zip(cambios[::2], cambios[1::2])
+        if fin - inicio >= CAPTCHA_ANCHO_MINIMO
+    ]
+    minimo = cantidad or CAPTCHA_LONGITUD_MIN
+    maximo = cantidad or CAPTCHA_LONGITUD_MAX
+    
+    # Caracteres pegados: partir el segmento más ancho por su columna con menos tinta
+    while segmentos and len(segmentos) < minimo:
+        i = max(range(len(segmentos)), key=lambda k: segmentos[k][1] - segmentos[k][0])
+        inicio, fin = segmentos[i]
+        if fin - inicio < 2 * CAPTCHA_ANCHO_MINIMO:
+            break
+        cuarto = (fin - inicio) // 4
+        corte = inicio + cuarto + int(np.argmin(columnas[inicio + cuarto:fin - cuarto]))
+        segmentos[i:i + 1] = [(inicio, corte), (corte, fin)]
+    
+    # Manchas sobrantes: descartar los segmentos con menos tinta
+    while len(segmentos) > maximo:
+        i = min(range(len(segmentos)), key=lambda k: columnas[segmentos[k][0]:segmentos[k][1]].sum())
+        del segmentos[i]
+    
+    return [tinta[:, inicio:fin] for inicio, fin in segmentos]
+
+def vectorizar_glifos(glifos: list) -> np.ndarray:
+    """Recorta, centra en un cuadrado y reduce cada glifo a CAPTCHA_LADO_GLIFO²; filas con norma 1"""
+    np = obtener_numpy()
+    lado = CAPTCHA_LADO_GLIFO
+    vectores = np.zeros((len(glifos), lado * lado), dtype=np.float32)
+    for i, glifo in enumerate(glifos):
+        filas = np.flatnonzero(glifo.any(axis=1))
+        if filas.size == 0:
+            continue
+        glifo = glifo[filas[0]:filas[-1] + 1]
+        alto, ancho = glifo.shape
+        tamano = max(alto, ancho)
+        cuadrado = np.zeros((tamano, tamano), dtype=np.float32)
+        y, x = (tamano - alto) // 2, (tamano - ancho) // 2
+        cuadrado[y:y + alto, x:x + ancho] = glifo
+        indices = (np.arange(lado) * tamano) // lado
+        vectores[i] = cuadrado[np.ix_(indices, indices)].ravel()
+    
+    vectores -= vectores.mean(axis=1, keepdims=True)
+    normas = np.linalg.norm(vectores, axis=1, keepdims=True)
+    return vectores / np.where(normas == 0, 1, normas)
+
+def entrenar_modelo_captcha(muestras: list, ruta: str = CAPTCHA_MODELO_RUTA) -> dict:
+    """Genera los centroides por carácter a partir de [(imagen_bytes, texto_correcto), ...]"""
+    np = obtener_numpy()
+    sumas = np.zeros((len(CAPTCHA_CARACTERES), CAPTCHA_LADO_GLIFO ** 2), dtype=np.float64)
+    conteos = np.zeros(len(CAPTCHA_CARACTERES), dtype=np.int64)
+    usadas = 0
+    for imagen_bytes, texto in muestras:
+        texto = ''.join(c for c in texto.upper() if c.isalnum())
+        if not texto or any(c not in CAPTCHA_CARACTERES for c in texto):
+            continue
+        glifos = segmentar_caracteres(binarizar_captcha(imagen_bytes), len(texto))
+        if len(glifos) != len(texto):
+            continue
+        indices = [CAPTCHA_CARACTERES.index(c) for c in texto]
+        np.add.at(sumas, indices, vectorizar_glifos(glifos))
+        np.add.at(conteos, indices, 1)
+        usadas += 1
+    
+    presentes = np.flatnonzero(conteos)
+    centroides = (sumas[presentes] / conteos[presentes, None]).astype(np.float32)
+    centroides /= np.linalg.norm(centroides, axis=1, keepdims=True)
+    caracteres = ''.join(CAPTCHA_CARACTERES[i] for i in presentes)
+    np.savez_compressed(ruta, caracteres=np.array(caracteres), centroides=centroides)
+    
+    global _modelo_captcha_cargado
+    with _modelo_captcha_lock:
+        _modelo_captcha_cargado = False   # Recargar en la próxima lectura
+    
+    print(f"✅ Modelo de CAPTCHA guardado en {ruta}: {usadas}/{len(muestras)} muestras, {len(caracteres)} caracteres")
+    return {'muestras_usadas': usadas, 'muestras_total': len(muestras), 'caracteres': caracteres}
+
+def obtener_modelo_captcha():
+    """Centroides cargados desde CAPTCHA_MODELO_RUTA (None si aún no se entrenó)"""
+    np = obtener_numpy()
+    global _modelo_captcha, _modelo_captcha_cargado
+    with _modelo_captcha_lock:
+        if not _modelo_captcha_cargado:
+            _modelo_captcha_cargado = True
+            _modelo_captcha = None
+            if os.path.exists(CAPTCHA_MODELO_RUTA):
+                with np.load(CAPTCHA_MODELO_RUTA) as archivo:
+                    _modelo_captcha = (str(archivo['caracteres']), archivo['centroides'])
+                print(f"✅ Modelo de CAPTCHA cargado ({len(_modelo_captcha[0])} caracteres)")
+            else:
+                print(f"⚠️ No existe {CAPTCHA_MODELO_RUTA}: los CAPTCHAs se resolverán con EasyOCR")
+        return _modelo_captcha
+
+def resolver_captcha_local(imagen_bytes: bytes) -> tuple:
+    """Lee el CAPTCHA con el clasificador propio. Devuelve (texto, confianzas por carácter) o None"""
+    np = obtener_numpy()
+    modelo = obtener_modelo_captcha()
+    if modelo is None:
+        return None
+    caracteres, centroides = modelo
+    
+    glifos = segmentar_caracteres(binarizar_captcha(imagen_bytes))
+    if not CAPTCHA_LONGITUD_MIN <= len(glifos) <= CAPTCHA_LONGITUD_MAX:
+        return None
+    
+    similitudes = vectorizar_glifos(glifos) @ centroides.T
+    mejores = similitudes.argmax(axis=1)
+    texto = ''.join(caracteres[i] for i in mejores)
+    confianzas = similitudes[np.arange(len(mejores)), mejores].round(3).tolist()
+    return texto, confianzas
+
+def leer_captcha(imagen_bytes: bytes) -> tuple:
+    """Lee el CAPTCHA con el clasificador propio y, si no está seguro, con EasyOCR.
+    
+    Devuelve (texto, confianza por carácter, método) o None. EasyOCR da una confianza por
+    fragmento detectado, que se asigna a cada carácter del fragmento.
+    """
+    try:
+        local = resolver_captcha_local(imagen_bytes)
+        if local and min(local[1]) >= CAPTCHA_CONFIANZA_MINIMA:
+            return local[0], local[1], 'local'
+    except Exception as e:
+        print(f"⚠️ Error en solucionador de CAPTCHA propio: {e}")
+    
+    return leer_captcha_easyocr(imagen_bytes)
+
+def leer_captcha_easyocr(imagen_bytes: bytes) -> tuple:
+    """Lectura solo con EasyOCR: (texto, confianza por carácter, 'easyocr') o None"""
     try:
-        img = Image.open(BytesIO(imagen_bytes))
-        img_array = np.array(img)
-        resultados = reader.readtext(img_array, detail=0)
-        texto_limpio = ''.join(resultados).strip().replace(" ", "").upper()
-        texto_limpio = ''.join(c for c in texto_limpio if c.isalnum())
-        return texto_limpio
+        if OCR_SERVIDOR_ACTIVO:
+            fragmentos = leer_fragmentos_ocr_remoto(imagen_bytes)
+        else:
+            img = Image.open(BytesIO(imagen_bytes))
+            img_array = obtener_numpy().array(img)
+            fragmentos = [(texto, confianza) for _, texto, confianza in obtener_lector_easyocr().readtext(img_array)]
+        texto_limpio = ''
+        confianzas = []
+        for fragmento, confianza in fragmentos:
+            fragmento = ''.join(c for c in fragmento.upper() if c.isalnum())
+            texto_limpio += fragmento
+            confianzas += [round(float(confianza), 3)] * len(fragmento)
+        if not texto_limpio:
+            return None
+        return texto_limpio, confianzas, 'easyocr'
     except Exception as e:
         print(f"⚠️ Error en EasyOCR: {e}")
         return None
 
+# --- SERVIDOR OCR COMPARTIDO (SOCKET UNIX) ---
+# Tramas: 4 bytes big-endian con la longitud + contenido. Petición = imagen, respuesta = JSON.
+def enviar_trama(conexion, datos: bytes):
+    conexion.sendall(struct.pack('>I', len(datos)) + datos)
+
+def _recibir_exacto(conexion, cantidad: int) -> bytes:
+    partes = []
+    while cantidad:
+        parte = conexion.recv(min(cantidad, 65536))
+        if not parte:
+            return None
+        partes.append(parte)
+        cantidad -= len(parte)
+    return b''.join(partes)
+
+def recibir_trama(conexion) -> bytes:
+    """Contenido de la siguiente trama, o None si el otro extremo cerró la conexión"""
+    cabecera = _recibir_exacto(conexion, 4)
+    if cabecera is None:
+        return None
+    return _recibir_exacto(conexion, struct.unpack('>I', cabecera)[0])
+
+_conexion_ocr = threading.local()   # Una conexión persistente por hilo
+
+def leer_fragmentos_ocr_remoto(imagen_bytes: bytes) -> list:
+    """Pide el OCR al servidor compartido. Devuelve [(texto, confianza), ...] como readtext"""
+    for intento in range(2):
+        conexion = getattr(_conexion_ocr, 'socket', None)
+        try:
+            if conexion is None:
+                conexion = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                conexion.settimeout(OCR_TIMEOUT)
+                conexion.connect(OCR_SOCKET)
+                _conexion_ocr.socket = conexion
+            enviar_trama(conexion, imagen_bytes)
+            respuesta = recibir_trama(conexion)
+            if respuesta is None:
+                raise ConnectionError("El servidor OCR cerró la conexión")
+            break
+        except OSError as e:
+            # Una respuesta tardía desfasaría las tramas: la conexión nunca se reutiliza tras un error
+            if conexion is not None:
+                conexion.close()
+            _conexion_ocr.socket = None
+            # Conexión vencida o servidor reiniciado: reconectar una vez. Tras un timeout no se
+            # reenvía: el servidor sigue procesando la imagen y duplicaría su trabajo
+            if intento or not isinstance(e, ConnectionError):
+                raise
+    
+    respuesta = json.loads(respuesta)
+    if 'error' in respuesta:
+        raise RuntimeError(f"Servidor OCR: {respuesta['error']}")
+    return [tuple(fragmento) for fragmento in respuesta['fragmentos']]
+
+class ServidorOCR:
+    """Proceso único con EasyOCR cargado; agrupa las imágenes que llegan juntas en una sola inferencia"""
+    def __init__(self, ruta: str, espera: float, maximo: int):
+        self.ruta = ruta
+        self.espera = espera
+        self.maximo = maximo
+        self._pendientes = queue.Queue()
+        self.estadisticas = {'solicitudes': 0, 'inferencias': 0, 'lecturas_directas': 0}
+
+    def _juntar_lote(self) -> list:
+        lote = [self._pendientes.get()]
+        limite = time.perf_counter() + self.espera
+        while len(lote) < self.maximo:
+            restante = limite - time.perf_counter()
+            if restante <= 0:
+                break
+            try:
+                lote.append(self._pendientes.get(timeout=restante))
+            except queue.Empty:
+                break
+        return lote
+
+    def _ejecutar(self, lote: list):
+        np = obtener_numpy()
+        # readtext_batched necesita imágenes del mismo tamaño: un grupo por forma
+        grupos = {}
+        for solicitud in lote:
+            try:
+                solicitud['imagen'] = np.array(Image.open(BytesIO(solicitud['bytes'])))
+                grupos.setdefault(solicitud['imagen'].shape, []).append(solicitud)
+            except Exception as e:
+                solicitud['respuesta'] = {'error': f"Imagen inválida: {e}"}
+                solicitud['listo'].set()
+        
+        lector = obtener_lector_easyocr()
+        for grupo in grupos.values():
+            try:
+                resultados = lector.readtext_batched([s['imagen'] for s in grupo], batch_size=len(grupo))
+                for solicitud, fragmentos in zip(grupo, resultados):
+                    solicitud['respuesta'] = {
+                        'fragmentos': [[texto, float(confianza)] for _, texto, confianza in fragmentos]
+                    }
+            except Exception as e:
+                for solicitud in grupo:
+                    solicitud['respuesta'] = {'error': str(e)}
+            finally:
+                self.estadisticas['inferencias'] += 1
+                for solicitud in grupo:
+                    solicitud['listo'].set()
+
+    def _procesar_lotes(self):
+        while True:
+            lote = self._juntar_lote()
+            self.estadisticas['solicitudes'] += len(lote)
+            try:
+                self._ejecutar(lote)
+            except Exception as e:
+                # El hilo de lotes no debe morir: las solicitudes sin respuesta pasan a leerse solas
+                print(f"❌ Error en lote OCR: {e}")
+
+    def _resolver_directo(self, imagen_bytes: bytes) -> dict:
+        """Lectura individual, fuera del hilo de lotes"""
+        try:
+            img_array = obtener_numpy().array(Image.open(BytesIO(imagen_bytes)))
+            fragmentos = obtener_lector_easyocr().readtext(img_array)
+            return {'fragmentos': [[texto, float(confianza)] for _, texto, confianza in fragmentos]}
+        except Exception as e:
+            return {'error': str(e)}
+
+    def resolver(self, imagen_bytes: bytes) -> dict:
+        solicitud = {'bytes': imagen_bytes, 'listo': threading.Event(), 'respuesta': None}
+        self._pendientes.put(solicitud)
+        if solicitud['listo'].wait(OCR_LOTE_TIMEOUT) and solicitud['respuesta'] is not None:
+            return solicitud['respuesta']
+        print(f"⚠️ El lote OCR no respondió en {OCR_LOTE_TIMEOUT}s, leyendo la imagen por separado")
+        self.estadisticas['lecturas_directas'] += 1
+        return self._resolver_directo(imagen_bytes)
+
+    def servir(self):
+        """Atiende el socket hasta que se detenga el proceso"""
+        obtener_lector_easyocr()
+        if os.path.exists(self.ruta):
+            os.unlink(self.ruta)
+        threading.Thread(target=self._procesar_lotes, daemon=True, name="lotes-ocr").start()
+        
+        servidor_ocr = self
+        class ManejadorOCR(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    imagen_bytes = recibir_trama(self.request)
+                    if imagen_bytes is None:
+                        return
+                    enviar_trama(self.request, json.dumps(servidor_ocr.resolver(imagen_bytes)).encode())
+        
+        class ServidorUnix(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+        
+        with ServidorUnix(self.ruta, ManejadorOCR) as servidor:
+            print(f"🔤 Servidor OCR escuchando en {self.ruta} (lotes de hasta {self.maximo}, espera {self.espera * 1000:.0f} ms)")
+            servidor.serve_forever()
+
+def obtener_texto_con_easyocr(imagen_bytes):
+    """Resuelve el CAPTCHA y devuelve solo el texto"""
+    lectura = leer_captcha(imagen_bytes)
+    return lectura[0] if lectura else None
+
+# --- CORPUS ETIQUETADO DE CAPTCHAS Y BENCHMARK DE SOLUCIONADORES ---
+CAPTCHA_CAPTURA_ACTIVA = False                # Guardar cada CAPTCHA enviado junto con el resultado de la búsqueda
+CAPTCHA_CORPUS_DIR = "corpus_captcha_scppp"   # Imágenes + etiquetas.jsonl
+CAPTCHA_CORPUS_INDICE = "etiquetas.jsonl"
+
+_corpus_lock = threading.Lock()
+
+_autoentrenamiento = {'correctas': None, 'iniciado': False}
+
+def autoentrenamiento_pendiente() -> bool:
+    """Sin modelo de CAPTCHA todavía: el corpus se captura para entrenar el primero"""
+    return bool(CAPTCHA_AUTOENTRENAR_MUESTRAS) and not os.path.exists(CAPTCHA_MODELO_RUTA)
+
+def entrenar_captcha_desde_corpus(directorio: str = CAPTCHA_CORPUS_DIR) -> dict:
+    """Entrena el modelo con las muestras correctas del corpus"""
+    corpus = cargar_corpus_captcha(directorio)
+    return entrenar_modelo_captcha([(m['imagen'], m['texto_enviado']) for m in corpus if m['exito']])
+
+def _contar_muestra_autoentrenamiento():
+    """Se llama con _corpus_lock tomado, después de guardar una muestra correcta"""
+    if _autoentrenamiento['correctas'] is None:
+        with open(os.path.join(CAPTCHA_CORPUS_DIR, CAPTCHA_CORPUS_INDICE), encoding='utf-8') as f:
+            _autoentrenamiento['correctas'] = sum(1 for linea in f if linea.strip() and json.loads(linea)['exito'])
+    else:
+        _autoentrenamiento['correctas'] += 1
+    
+    if _autoentrenamiento['correctas'] >= CAPTCHA_AUTOENTRENAR_MUESTRAS and not _autoentrenamiento['iniciado']:
+        _autoentrenamiento['iniciado'] = True
+        print(f"🧠 {_autoentrenamiento['correctas']} CAPTCHAs aceptados: entrenando el primer modelo local...")
+        
+        def entrenar():
+            try:
+                entrenar_captcha_desde_corpus()
+            except Exception as e:
+                print(f"❌ Error entrenando el modelo de CAPTCHA: {e}")
+                _autoentrenamiento['iniciado'] = False
+        threading.Thread(target=entrenar, daemon=True).start()
+
+def registrar_muestra_captcha(imagen_bytes: bytes, texto_enviado: str, exito: bool, detalle: str):
+    """Agrega una muestra al corpus. exito=True: el texto enviado era correcto (la búsqueda devolvió al conductor)"""
+    autoentrenar = autoentrenamiento_pendiente()
+    if not (CAPTCHA_CAPTURA_ACTIVA or autoentrenar) or not imagen_bytes:
+        return
+    try:
+        archivo = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.img"
+        with _corpus_lock:
+            os.makedirs(CAPTCHA_CORPUS_DIR, exist_ok=True)
+            with open(os.path.join(CAPTCHA_CORPUS_DIR, archivo), 'wb') as f:
+                f.write(imagen_bytes)
+            with open(os.path.join(CAPTCHA_CORPUS_DIR, CAPTCHA_CORPUS_INDICE), 'a', encoding='utf-8') as f:
+                f.write(json.dumps({
+                    'archivo': archivo,
+                    'texto_enviado': texto_enviado,
+                    'exito': exito,
+                    'detalle': detalle,
+                    'fecha': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }) + "\n")
+            if autoentrenar and exito:
+                _contar_muestra_autoentrenamiento()
+    except Exception as e:
+        print(f"⚠️ Error guardando muestra de CAPTCHA: {e}")
+
+def cargar_corpus_captcha(directorio: str = CAPTCHA_CORPUS_DIR) -> list:
+    """Muestras del corpus: [{'imagen': bytes, 'texto_enviado', 'exito', ...}, ...]"""
+    muestras = []
+    with open(os.path.join(directorio, CAPTCHA_CORPUS_INDICE), encoding='utf-8') as f:
+        for linea in f:
+            if not linea.strip():
+                continue
+            muestra = json.loads(linea)
+            with open(os.path.join(directorio, muestra['archivo']), 'rb') as imagen:
+                muestra['imagen'] = imagen.read()
+            muestras.append(muestra)
+    return muestras
+
+SOLUCIONADORES_CAPTCHA = {
+    'combinado': obtener_texto_con_easyocr,
+    'local': lambda imagen_bytes: (resolver_captcha_local(imagen_bytes) or (None,))[0],
+    'easyocr': lambda imagen_bytes: (leer_captcha_easyocr(imagen_bytes) or (None,))[0],
+}
+
+def obtener_solucionador_captcha(nombre: str):
+    """Nombre registrado en SOLUCIONADORES_CAPTCHA o 'modulo:funcion' (funcion(imagen_bytes) -> texto)"""
+    if nombre in SOLUCIONADORES_CAPTCHA:
+        return SOLUCIONADORES_CAPTCHA[nombre]
+    if ':' not in nombre:
+        raise ValueError(f"Solucionador desconocido: {nombre} (use {', '.join(SOLUCIONADORES_CAPTCHA)} o modulo:funcion)")
+    modulo, funcion = nombre.split(':', 1)
+    return getattr(importlib.import_module(modulo), funcion)
+
+def evaluar_solucionador_captcha(solucionador, muestras: list) -> dict:
+    """Reproduce el corpus sin red: exactitud sobre muestras correctas, latencias y memoria"""
+    np = obtener_numpy()
+    latencias = []
+    aciertos = 0
+    errores_repetidos = 0   # Coincide con un texto que el servidor rechazó como CAPTCHA incorrecto
+    sin_lectura = 0
+    positivas = sum(1 for muestra in muestras if muestra['exito'])
+    
+    rss_inicial = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    for muestra in muestras:
+        inicio = time.perf_counter()
+        try:
+            texto = solucionador(muestra['imagen'])
+        except Exception as e:
+            print(f"⚠️ Error del solucionador en {muestra['archivo']}: {e}")
+            texto = None
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        
+        texto = ''.join(c for c in (texto or '').upper() if c.isalnum())
+        if not texto:
+            sin_lectura += 1
+        elif muestra['exito'] and texto == muestra['texto_enviado']:
+            aciertos += 1
+        elif muestra.get('detalle') == 'captcha_rechazado' and texto == muestra['texto_enviado']:
+            # Las muestras 'sin_datos' suelen tener el CAPTCHA bien leído: no cuentan como error
+            errores_repetidos += 1
+    _, memoria_pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_final = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss   # KB en Linux
+    
+    return {
+        'muestras': len(muestras),
+        'muestras_correctas': positivas,
+        'aciertos': aciertos,
+        'exactitud': round(aciertos / positivas, 4) if positivas else None,
+        'errores_repetidos': errores_repetidos,
+        'sin_lectura': sin_lectura,
+        'latencia_p50_ms': round(float(np.percentile(latencias, 50)), 3) if latencias else None,
+        'latencia_p99_ms': round(float(np.percentile(latencias, 99)), 3) if latencias else None,
+        'memoria_pico_python_mb': round(memoria_pico / 1024 / 1024, 2),
+        'rss_max_mb': round(rss_final / 1024, 1),
+        'rss_crecimiento_mb': round((rss_final - rss_inicial) / 1024, 1)
+    }
+
+# Cada solucionador se mide en un proceso nuevo: ru_maxrss es el pico de todo el proceso
+# y tracemalloc no ve la memoria nativa de torch, así que en un mismo proceso el segundo
+# solucionador heredaría la memoria del primero
+SCRIPT_BENCHMARK_CAPTCHA = """
+import json, sys
+sys.path.insert(0, sys.argv[1])
+modulo = __import__(sys.argv[2])
+muestras = modulo.cargar_corpus_captcha(sys.argv[4])
+resultado = modulo.evaluar_solucionador_captcha(modulo.obtener_solucionador_captcha(sys.argv[3]), muestras)
+print(json.dumps(resultado))
+"""
+
+def benchmark_captcha(nombres: list, directorio: str = CAPTCHA_CORPUS_DIR):
+    """Compara solucionadores sobre el corpus, cada uno en su propio proceso, e imprime un resumen"""
+    muestras = cargar_corpus_captcha(directorio)
+    print(f"📊 Corpus {directorio}: {len(muestras)} muestras ({sum(1 for m in muestras if m['exito'])} correctas)")
+    directorio_modulo = os.path.dirname(os.path.abspath(__file__))
+    nombre_modulo = os.path.splitext(os.path.basename(__file__))[0]
+    resultados = {}
+    for nombre in nombres:
+        print(f"\n🧪 Evaluando solucionador '{nombre}'...")
+        proceso = subprocess.run(
+            [sys.executable, '-c', SCRIPT_BENCHMARK_CAPTCHA,
+             directorio_modulo, nombre_modulo, nombre, os.path.abspath(directorio)],
+            capture_output=True, text=True
+        )
+        if proceso.returncode != 0:
+            print(f"❌ Falló el solucionador '{nombre}': {proceso.stderr.strip()[-500:]}")
+            continue
+        resultados[nombre] = json.loads(proceso.stdout.strip().splitlines()[-1])
+        for clave, valor in resultados[nombre].items():
+            print(f"   {clave}: {valor}")
+    return resultados
+
 def extraer_campos_formulario(soup):
     """Extrae todos los campos hidden del formulario"""
     form_data = {}
@@ -666,7 +2927,7 @@ def extraer_campos_formulario(soup):
 
 def analizar_resultados_scppp(html_content, valor_consultado):
     """Analiza exhaustivamente los resultados de la consulta SCPPP"""
-    soup = BeautifulSoup(html_content, 'html.parser')
+    soup = analizar_html(html_content)
     
     resultado = {
         'valor_consultado': valor_consultado,
@@ -804,30 +3065,305 @@ def guardar_scppp_en_db(licencia_dni: str, resultado: dict):
             return guardar_scppp_en_db(licencia_dni, resultado)
         return {'success': False, 'error': str(e)}
 
-# --- FUNCIÓN DE CONSULTA SCPPP ---
-def consultar_scppp(valor: str, tipo: str = '1'):
-    """Consulta en el sistema SCPPP"""
-    try:
-        print(f"🚀 Iniciando consulta SCPPP para: {valor} (tipo: {tipo})")
-        
-        session = requests.Session()
-        
+def guardar_scppp_lote_en_db(registros: list) -> dict:
+    """Upsert de varios conductores [(licencia_dni, resultado), ...] en una sola escritura.
+    
+    Un único INSERT ... ON DUPLICATE KEY UPDATE, sin lecturas previas que puedan competir con
+    guardar_scppp_en_db. Un conductor eliminado lógicamente no se restaura ni se modifica:
+    queda fuera de 'registro_ids' y se informa en 'eliminados'.
+    """
+    filas = []
+    for licencia_dni, resultado in registros:
+        datos_personales = resultado['datos_personales']
+        papeletas = resultado['papeletas']
+        filas.append((
+            licencia_dni,
+            datos_personales.get('estado_licencia'),
+            datos_personales.get('nombre_completo'),
+            datos_personales.get('dni'),
+            datos_personales.get('licencia'),
+            datos_personales.get('clase_categoria'),
+            datos_personales.get('vigencia'),
+            papeletas.get('estado'),
+            papeletas.get('cantidad', 0)
+        ))
+    
+    try:
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            # executemany agrupa las filas en un único INSERT multi-VALUES; las filas con
+            # deleted_at conservan sus valores (cada columna se asigna con IF)
+            cur.executemany('''INSERT INTO scppp_conductores (
+                licencia_dni, estado_licencia, nombre_completo, dni, licencia,
+                clase_categoria, vigencia, papeletas_estado, papeletas_cantidad
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                estado_licencia = IF(deleted_at IS NULL, VALUES(estado_licencia), estado_licencia),
+                nombre_completo = IF(deleted_at IS NULL, VALUES(nombre_completo), nombre_completo),
+                dni = IF(deleted_at IS NULL, VALUES(dni), dni),
+                licencia = IF(deleted_at IS NULL, VALUES(licencia), licencia),
+                clase_categoria = IF(deleted_at IS NULL, VALUES(clase_categoria), clase_categoria),
+                vigencia = IF(deleted_at IS NULL, VALUES(vigencia), vigencia),
+                papeletas_estado = IF(deleted_at IS NULL, VALUES(papeletas_estado), papeletas_estado),
+                papeletas_cantidad = IF(deleted_at IS NULL, VALUES(papeletas_cantidad), papeletas_cantidad),
+                consultas_realizadas = consultas_realizadas + IF(deleted_at IS NULL, 1, 0),
+                updated_at = IF(deleted_at IS NULL, CURRENT_TIMESTAMP, updated_at)''', filas)
+            
+            claves = [fila[0] for fila in filas]
+            marcadores = ", ".join(["%s"] * len(claves))
+            cur.execute(f"""SELECT id, licencia_dni FROM scppp_conductores
+                WHERE licencia_dni IN ({marcadores}) AND deleted_at IS NULL""", claves)
+            ids = {fila['licencia_dni']: fila['id'] for fila in cur.fetchall()}
+            mysql.connection.commit()
+            cur.close()
+    except Exception as e:
+        print(f"❌ Error guardando lote SCPPP: {e}")
+        if "doesn't exist" in str(e):
+            print("⚠️ La tabla no existe, intentando crear...")
+            crear_tablas_mysql()
+            return guardar_scppp_lote_en_db(registros)
+        return {'success': False, 'error': str(e)}
+    
+    eliminados = {licencia_dni for licencia_dni, _ in registros if licencia_dni not in ids}
+    for licencia_dni, resultado in registros:
+        if licencia_dni in ids:
+            cache_scppp.guardar(licencia_dni, {'datos': resultado, 'registro_id': ids[licencia_dni]})
+    
+    print(f"✅ Lote SCPPP guardado: {len(ids)} conductores en una escritura ({len(eliminados)} eliminados omitidos)")
+    return {'success': True, 'guardados': len(ids), 'registro_ids': ids, 'eliminados': sorted(eliminados)}
+
+# --- CACHÉ SCPPP (MEMORIA + TABLA scppp_conductores) ---
+SCPPP_CACHE_MAX_EDAD = 6 * 3600     # Edad máxima (s) por defecto de un conductor servido sin consultar al MTC; 0 = sin caché
+SCPPP_CACHE_MEMORIA_MAX = 1000      # Conductores recientes en memoria del proceso
+# Un DELETE solo limpia la memoria del proceso que lo atiende: en los demás procesos y nodos
+# el conductor eliminado deja de servirse a lo sumo SCPPP_CACHE_MEMORIA_TTL segundos después
+SCPPP_CACHE_MEMORIA_TTL = 60
+SCPPP_CONTEO_INTERVALO = 5          # s entre escrituras agrupadas de consultas_realizadas
+
+cache_scppp = CacheMemoria(SCPPP_CACHE_MEMORIA_MAX, SCPPP_CACHE_MEMORIA_TTL)
+
+class ContadorConsultasDiferido:
+    """Acumula las consultas servidas desde caché y las suma a la tabla en una escritura periódica"""
+    def __init__(self, intervalo: float):
+        self.intervalo = intervalo
+        self._pendientes = {}
+        self._lock = threading.Lock()
+        self._hilo = None
+
+    def sumar(self, licencia_dni: str):
+        with self._lock:
+            self._pendientes[licencia_dni] = self._pendientes.get(licencia_dni, 0) + 1
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._ciclo, daemon=True, name="conteo-scppp")
+                self._hilo.start()
+
+    def volcar(self):
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+        if not pendientes:
+            return
+        try:
+            with app.app_context():
+                cur = mysql.connection.cursor()
+                cur.executemany("""
+                    UPDATE scppp_conductores
+                    SET consultas_realizadas = consultas_realizadas + %s, updated_at = updated_at
+                    WHERE licencia_dni = %s AND deleted_at IS NULL
+                """, [(cantidad, licencia_dni) for licencia_dni, cantidad in pendientes.items()])
+                mysql.connection.commit()
+                cur.close()
+        except Exception as e:
+            print(f"⚠️ Error contando consultas SCPPP en caché: {e}")
+
+    def _ciclo(self):
+        while True:
+            time.sleep(self.intervalo)
+            self.volcar()
+
+contador_consultas_scppp = ContadorConsultasDiferido(SCPPP_CONTEO_INTERVALO)
+atexit.register(contador_consultas_scppp.volcar)
+
+def _resultado_scppp_desde_registro(registro: dict) -> dict:
+    """Reconstruye el resultado de analizar_resultados_scppp a partir de una fila de scppp_conductores"""
+    papeletas = {}
+    if registro['papeletas_estado']:
+        papeletas = {
+            'estado': registro['papeletas_estado'],
+            'cantidad': registro['papeletas_cantidad']
+        }
+    return {
+        'valor_consultado': registro['licencia_dni'],
+        'fecha_consulta': registro['updated_at'].strftime("%Y-%m-%d %H:%M:%S"),
+        'fuente': 'SCPPP - MTC',
+        'estado': registro['papeletas_estado'] or 'CONSULTA_REALIZADA',
+        'datos_personales': {
+            'nombre_completo': registro['nombre_completo'],
+            'dni': registro['dni'],
+            'licencia': registro['licencia'],
+            'clase_categoria': registro['clase_categoria'],
+            'vigencia': registro['vigencia'],
+            'estado_licencia': registro['estado_licencia']
+        },
+        'papeletas': papeletas
+    }
+
+def buscar_conductor_en_cache(licencia_dni: str, max_edad: int) -> dict:
+    """Busca un resultado reciente en memoria y luego en la tabla. Devuelve {'datos', 'registro_id', 'edad_segundos', 'origen'} o None"""
+    if max_edad <= 0:
+        return None
+    
+    # Sin acceso a la base de datos: la entrada vence a los SCPPP_CACHE_MEMORIA_TTL segundos
+    en_memoria = cache_scppp.obtener(licencia_dni, max_edad)
+    if en_memoria:
+        entrada, edad = en_memoria
+        contador_consultas_scppp.sumar(licencia_dni)
+        return {**entrada, 'edad_segundos': edad, 'origen': 'memoria'}
+    
+    try:
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            cur.execute("""
+                SELECT id, licencia_dni, estado_licencia, nombre_completo, dni, licencia,
+                       clase_categoria, vigencia, papeletas_estado, papeletas_cantidad, updated_at,
+                       TIMESTAMPDIFF(SECOND, updated_at, NOW()) AS edad_segundos
+                FROM scppp_conductores
+                WHERE licencia_dni = %s AND deleted_at IS NULL
+                  AND updated_at >= NOW() - INTERVAL %s SECOND
+            """, (licencia_dni, max_edad))
+            registro = cur.fetchone()
+            cur.close()
+    except Exception as e:
+        print(f"⚠️ Error leyendo caché SCPPP: {e}")
+        return None
+    
+    if not registro:
+        return None
+    
+    entrada = {'datos': _resultado_scppp_desde_registro(registro), 'registro_id': registro['id']}
+    cache_scppp.guardar(licencia_dni, entrada, time.time() - registro['edad_segundos'])
+    contador_consultas_scppp.sumar(licencia_dni)
+    return {**entrada, 'edad_segundos': registro['edad_segundos'], 'origen': 'base_datos'}
+
+# --- SESIONES HTTP SCPPP CON LÍMITE POR SERVIDOR ---
+SCPPP_CONCURRENCIA_POR_HOST = 4    # Peticiones HTTP simultáneas máximas contra un mismo servidor
+SCPPP_CLIENTES = 8                 # Clientes SCPPP persistentes (uno por consulta simultánea)
+SCPPP_POOL_TIMEOUT = 60            # Segundos máximos esperando un cliente libre
+
+HEADERS_AJAX_SCPPP = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+    'X-Requested-With': 'XMLHttpRequest',
+    'X-MicrosoftAjax': 'Delta=true',
+    'Referer': URL_BASE_SCPPP,
+    'Origin': URL_BASE_SCPPP.rstrip('/')
+}
+
+_semaforos_upstream = {}
+_semaforos_lock = threading.Lock()
+
+def semaforo_upstream(url: str) -> threading.BoundedSemaphore:
+    """Semáforo compartido por todas las sesiones que hablan con el mismo servidor"""
+    host = urlparse(url).netloc
+    with _semaforos_lock:
+        if host not in _semaforos_upstream:
+            _semaforos_upstream[host] = threading.BoundedSemaphore(SCPPP_CONCURRENCIA_POR_HOST)
+        return _semaforos_upstream[host]
+
+class SesionLimitada(requests.Session):
+    """requests.Session que respeta SCPPP_CONCURRENCIA_POR_HOST en cada petición"""
+    def request(self, method, url, *args, **kwargs):
+        with semaforo_upstream(url):
+            return super().request(method, url, *args, **kwargs)
+
+class ErrorFormularioScppp(Exception):
+    """No se pudo dejar el formulario SCPPP listo para buscar"""
+
+class ErrorCaptchaScppp(Exception):
+    """No se pudo descargar o leer el CAPTCHA de la sesión"""
+
+SCPPP_CAPTCHA_CONFIANZA_ENVIO = 0.4   # Confianza mínima por carácter para gastar una búsqueda con esa lectura
+SCPPP_CAPTCHA_MAX_LECTURAS = 3        # CAPTCHAs descargados por búsqueda antes de enviar la mejor lectura
+SCPPP_CAPTCHA_MAX_ENVIOS = 3          # Búsquedas por consulta cuando el servidor rechaza el CAPTCHA
+
+VALORES_VACIOS_SCPPP = (None, '', 'No encontrado')
+PATRON_CAPTCHA_INCORRECTO = re.compile(
+    r"captcha|c[oó]digo\s+de\s+(seguridad|verificaci[oó]n)|texto\s+de\s+la\s+imagen", re.IGNORECASE
+)
+PATRON_ELEMENTO_MENSAJE = re.compile(r"msj|mensaje|error|alert", re.IGNORECASE)
+
+def mensajes_respuesta_scppp(html_content: str) -> str:
+    """Texto de los avisos de la respuesta: scripts de alerta y elementos de mensaje/error"""
+    soup = analizar_html(html_content)
+    mensajes = [
+        script.get_text() for script in soup.find_all('script')
+        if re.search(r"alert\(|swal|mensaje", script.get_text(), re.IGNORECASE)
+    ]
+    for elemento in soup.find_all(['span', 'div', 'label']):
+        identificador = ' '.join([elemento.get('id', '')] + elemento.get('class', []))
+        if PATRON_ELEMENTO_MENSAJE.search(identificador):
+            mensajes.append(elemento.get_text(" ", strip=True))
+    # Las respuestas AJAX también traen avisos como scriptBlock: |scriptBlock|...|alert('...')|
+    mensajes += re.findall(r"alert\((.*?)\)", html_content)
+    return " ".join(mensajes)
+
+def captcha_incorrecto(html_content: str) -> bool:
+    """La búsqueda volvió sin conductor y con un aviso sobre el CAPTCHA"""
+    soup = analizar_html(html_content)
+    administrado = soup.find('span', {'id': 'lblAdministrado'})
+    if administrado and administrado.text.strip():
+        return False
+    return bool(PATRON_CAPTCHA_INCORRECTO.search(mensajes_respuesta_scppp(html_content)))
+
+def resultado_sin_datos(resultado: dict) -> bool:
+    """analizar_resultados_scppp no encontró ni datos personales ni tabla de papeletas"""
+    return (
+        all(valor in VALORES_VACIOS_SCPPP for valor in resultado['datos_personales'].values())
+        and not resultado['papeletas']
+    )
+
+def formulario_rechazado(respuesta) -> bool:
+    """El servidor no aceptó el VIEWSTATE/EVENTVALIDATION enviado (error o redirección en la respuesta AJAX)"""
+    if respuesta.status_code == 500:
+        return True
+    return respuesta.status_code == 200 and ('|error|' in respuesta.text or '|pageRedirect|' in respuesta.text)
+
+class ClienteScppp:
+    """Sesión keep-alive que conserva el formulario ya configurado por tipo de búsqueda.
+    
+    La primera consulta de cada tipo carga la página y cambia la opción de búsqueda; las
+    siguientes reutilizan ese VIEWSTATE/EVENTVALIDATION y solo piden CAPTCHA y búsqueda.
+    """
+    def __init__(self):
+        self.session = SesionLimitada()
+        self._formularios = {}   # tipo -> campos del formulario tras el cambio de opción
+        self.ultimo_captcha = None   # Imagen de la lectura devuelta por resolver_captcha (corpus)
+        self.estadisticas = {
+            'cebados': 0,
+            'reutilizados': 0,
+            'rechazos': 0,
+            'captchas_descartados': 0,
+            'captchas_incorrectos': 0,
+        }
+
+    def _cebar(self, tipo: str) -> dict:
         # PASO 1: Obtener página inicial
+        reportar_etapa('pagina_inicial')
         print(f"🔍 PASO 1: Cargando página inicial...")
-        response = session.get(URL_BASE_SCPPP, timeout=15, verify=False)
+        response = self.session.get(URL_BASE_SCPPP, timeout=15, verify=False)
         
         if response.status_code != 200:
-            return {"success": False, "error": f"Error al cargar página: {response.status_code}"}
+            raise ErrorFormularioScppp(f"Error al cargar página: {response.status_code}")
         
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = analizar_html(response.text)
         form_data = extraer_campos_formulario(soup)
         
         if '__VIEWSTATE' not in form_data:
-            return {"success": False, "error": "No se encontró VIEWSTATE"}
+            raise ErrorFormularioScppp("No se encontró VIEWSTATE")
         
         print(f"✅ VIEWSTATE obtenido ({len(form_data['__VIEWSTATE'])} chars)")
         
         # PASO 2: Cambiar a opción de búsqueda según tipo
+        reportar_etapa('tipo_busqueda')
         print(f"\n🔄 PASO 2: Configurando tipo de búsqueda...")
         
         form_data['rbtnlBuqueda'] = tipo
@@ -838,19 +3374,10 @@ def consultar_scppp(valor: str, tipo: str = '1'):
         form_data['__ASYNCPOST'] = 'true'
         form_data['ScriptManager'] = 'UpdatePanel|rbtnlBuqueda$1'
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-            'X-Requested-With': 'XMLHttpRequest',
-            'X-MicrosoftAjax': 'Delta=true',
-            'Referer': URL_BASE_SCPPP,
-            'Origin': URL_BASE_SCPPP.rstrip('/')
-        }
-        
-        response2 = session.post(URL_BASE_SCPPP, data=form_data, headers=headers, verify=False)
+        response2 = self.session.post(URL_BASE_SCPPP, data=form_data, headers=HEADERS_AJAX_SCPPP, verify=False)
         
         if response2.status_code != 200:
-            return {"success": False, "error": f"Error en cambio de opción: {response2.status_code}"}
+            raise ErrorFormularioScppp(f"Error en cambio de opción: {response2.status_code}")
         
         print(f"✅ Opción configurada correctamente")
         
@@ -869,68 +3396,391 @@ def consultar_scppp(valor: str, tipo: str = '1'):
             form_data['__EVENTVALIDATION'] = eventvalidation_match.group(1)
             print(f"✅ Nuevo EVENTVALIDATION extraído del AJAX")
         
-        # PASO 4: Descargar y resolver CAPTCHA
-        print(f"\n🖼️  PASO 3: Descargando CAPTCHA...")
+        self.estadisticas['cebados'] += 1
+        return form_data
+
+    def formulario(self, tipo: str) -> dict:
+        """Campos del formulario listos para buscar con el tipo indicado (2 peticiones solo si no hay uno guardado)"""
+        if tipo in self._formularios:
+            self.estadisticas['reutilizados'] += 1
+            print(f"♻️ Reutilizando formulario SCPPP (tipo {tipo}) sin recargar la página")
+        else:
+            self._formularios[tipo] = self._cebar(tipo)
+        return self._formularios[tipo]
+
+    def resolver_captcha(self) -> str:
+        """Descarga CAPTCHAs de esta sesión ASP.NET hasta obtener una lectura confiable.
+        
+        Cada descarga de Captcha.aspx reemplaza el código vigente en la sesión, así que una
+        lectura dudosa se descarta sin gastar la búsqueda. Agotado el presupuesto se envía
+        la lectura del último CAPTCHA descargado: las anteriores ya no son válidas.
+        """
         url_captcha = URL_BASE_SCPPP + "Captcha.aspx"
-        resp_img = session.get(url_captcha, verify=False)
-        
-        if resp_img.status_code != 200:
-            return {"success": False, "error": "Error descargando CAPTCHA"}
-        
-        print("🤖 Resolviendo CAPTCHA con EasyOCR...")
-        texto_captcha = obtener_texto_con_easyocr(resp_img.content)
-        
-        if not texto_captcha:
-            return {"success": False, "error": "Error resolviendo CAPTCHA"}
-        
-        print(f"✅ CAPTCHA: {texto_captcha}")
-        
-        # PASO 5: Enviar búsqueda final
-        print(f"\n📡 PASO 4: Buscando {valor}...")
-        
-        # Determinar campo a usar según tipo de búsqueda
-        campo_busqueda = 'txtNroLicencia' if tipo == '1' else 'txtNroDocumento'
-        
-        search_data = {
-            '__VIEWSTATE': form_data['__VIEWSTATE'],
-            '__VIEWSTATEGENERATOR': form_data.get('__VIEWSTATEGENERATOR', '90059987'),
-            '__VIEWSTATEENCRYPTED': form_data.get('__VIEWSTATEENCRYPTED', ''),
-            '__EVENTVALIDATION': form_data['__EVENTVALIDATION'],
-            'rbtnlBuqueda': tipo,
-            campo_busqueda: valor,
-            'txtCaptcha': texto_captcha,
-            'hdCodAdministrado': '',
-            'hdNumTipoDoc': '',
-            'hdNumDocumento': '',
-            'txtNroResolucion': '',
-            'txtFechaResolucion': '',
-            'txtIniSancion': '',
-            'txtFinSancion': '',
-            'txtSancion': '',
-            'txtTipSancion': '',
-            '__EVENTTARGET': 'ibtnBusqNroDoc',
-            '__EVENTARGUMENT': '',
-            '__LASTFOCUS': '',
-            '__ASYNCPOST': 'true',
-            'ScriptManager': 'UpdatePanel|ibtnBusqNroDoc'
+        vigente = None
+        self.ultimo_captcha = None
+        for lectura in range(1, SCPPP_CAPTCHA_MAX_LECTURAS + 1):
+            print(f"\n🖼️  PASO 3: Descargando CAPTCHA ({lectura}/{SCPPP_CAPTCHA_MAX_LECTURAS})...")
+            resp_img = self.session.get(url_captcha, verify=False)
+            
+            if resp_img.status_code != 200:
+                raise ErrorCaptchaScppp("Error descargando CAPTCHA")
+            
+            self.ultimo_captcha = resp_img.content
+            resultado_ocr = leer_captcha(resp_img.content)
+            if not resultado_ocr:
+                vigente = None
+                continue
+            
+            texto_captcha, confianzas, metodo = resultado_ocr
+            confianza = min(confianzas)
+            vigente = (texto_captcha, confianza)
+            if confianza >= SCPPP_CAPTCHA_CONFIANZA_ENVIO:
+                print(f"✅ CAPTCHA: {texto_captcha} ({metodo}, confianza {confianza:.2f})")
+                return texto_captcha
+            
+            self.estadisticas['captchas_descartados'] += 1
+            print(f"⚠️ Lectura '{texto_captcha}' poco confiable ({metodo}, {confianza:.2f}), pidiendo otro CAPTCHA...")
+        
+        if vigente is None:
+            raise ErrorCaptchaScppp("Error resolviendo CAPTCHA")
+        
+        print(f"⚠️ Se envía la lectura del último CAPTCHA: {vigente[0]} ({vigente[1]:.2f})")
+        return vigente[0]
+
+    def tiene_formulario(self, tipo: str) -> bool:
+        return tipo in self._formularios
+
+    def invalidar(self, tipo: str = None, rechazo: bool = False):
+        """Olvida el formulario guardado (todos si tipo es None)"""
+        if rechazo:
+            self.estadisticas['rechazos'] += 1
+        if tipo is None:
+            self._formularios.clear()
+        else:
+            self._formularios.pop(tipo, None)
+
+class PoolClientesScppp:
+    """Clientes SCPPP prestados de a uno por consulta (la sesión ASP.NET guarda el CAPTCHA vigente)"""
+    def __init__(self, tamano: int, timeout: float):
+        self.tamano = tamano
+        self.timeout = timeout
+        self._clientes = [ClienteScppp() for _ in range(tamano)]
+        self._libres = queue.Queue()
+        for cliente in self._clientes:
+            self._libres.put(cliente)
+
+    def tomar(self, timeout: float = None) -> ClienteScppp:
+        """Cliente libre, o None si no hay uno dentro de 'timeout' (None = esperar sin límite)"""
+        try:
+            if timeout == 0:
+                return self._libres.get_nowait()
+            return self._libres.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def devolver(self, cliente: ClienteScppp):
+        self._libres.put(cliente)
+
+    @contextmanager
+    def prestar(self):
+        cliente = self.tomar(self.timeout)
+        if cliente is None:
+            raise PoolAgotadoError(f"No hay clientes libres en el pool SCPPP ({self.timeout}s)")
+        try:
+            yield cliente
+        except Exception:
+            # Conexiones en estado dudoso: volver a cebar en la próxima consulta
+            cliente.invalidar()
+            raise
+        finally:
+            self.devolver(cliente)
+
+    def estado(self) -> dict:
+        totales = {clave: sum(c.estadisticas[clave] for c in self._clientes) for clave in self._clientes[0].estadisticas}
+        return {
+            'tamano': self.tamano,
+            'libres': self._libres.qsize(),
+            'concurrencia_por_host': SCPPP_CONCURRENCIA_POR_HOST,
+            **totales
+        }
+
+pool_clientes_scppp = PoolClientesScppp(SCPPP_CLIENTES, SCPPP_POOL_TIMEOUT)
+
+# --- PRECARGA DE CAPTCHAS SCPPP ---
+SCPPP_PRECARGA_ACTIVA = True
+SCPPP_PRECARGA_MAX = SCPPP_CLIENTES // 2   # Sesiones cebadas máximas; el resto del pool queda para consultas en frío
+SCPPP_PRECARGA_TTL = 10 * 60               # s de vida de una sesión cebada (la sesión ASP.NET del MTC vence a los ~20 min)
+SCPPP_PRECARGA_VENTANA = 300               # s de historial usados para estimar la tasa de consultas
+SCPPP_PRECARGA_HORIZONTE = 30              # s de demanda que se intenta tener cubiertos con sesiones cebadas
+SCPPP_PRECARGA_INTERVALO = 1.0             # s entre ciclos del productor
+
+@dataclass(slots=True)
+class SesionCebada:
+    """Cliente con formulario vigente y CAPTCHA ya resuelto, listo para una sola búsqueda"""
+    cliente: ClienteScppp
+    tipo: str
+    texto_captcha: str
+    expira_en: float
+
+class PrecargaCaptchasScppp:
+    """Productor en segundo plano que mantiene sesiones cebadas según la tasa reciente de consultas"""
+    def __init__(self, pool: PoolClientesScppp, maximo: int):
+        self.pool = pool
+        self.maximo = maximo
+        self._cebadas = {}     # tipo -> deque de SesionCebada
+        self._demanda = {}     # tipo -> deque de instantes de consulta
+        self._lock = threading.Lock()
+        self._hilo = None
+        self.estadisticas = {
+            'cebadas': 0,
+            'servidas': 0,
+            'expiradas': 0,
+            'fallos': 0,
         }
+
+    def registrar_demanda(self, tipo: str):
+        with self._lock:
+            self._demanda.setdefault(tipo, deque()).append(time.time())
+
+    def _tasa(self, tipo: str, ahora: float) -> float:
+        """Consultas por segundo en la ventana reciente (con el lock tomado)"""
+        instantes = self._demanda.get(tipo)
+        if not instantes:
+            return 0.0
+        while instantes and instantes[0] < ahora - SCPPP_PRECARGA_VENTANA:
+            instantes.popleft()
+        return len(instantes) / SCPPP_PRECARGA_VENTANA
+
+    def _objetivo(self, tipo: str, ahora: float) -> int:
+        return min(self.maximo, math.ceil(self._tasa(tipo, ahora) * SCPPP_PRECARGA_HORIZONTE))
+
+    def tomar(self, tipo: str) -> SesionCebada:
+        """Saca una sesión cebada vigente para el tipo, o None"""
+        ahora = time.time()
+        vencidas = []
+        cebada = None
+        with self._lock:
+            cola = self._cebadas.get(tipo)
+            while cola:
+                candidata = cola.popleft()
+                if candidata.expira_en > ahora:
+                    cebada = candidata
+                    self.estadisticas['servidas'] += 1
+                    break
+                vencidas.append(candidata)
+        self._descartar(vencidas)
+        return cebada
+
+    def _descartar(self, vencidas: list):
+        for cebada in vencidas:
+            with self._lock:
+                self.estadisticas['expiradas'] += 1
+            self.pool.devolver(cebada.cliente)
+
+    def _purgar(self, ahora: float):
+        vencidas = []
+        with self._lock:
+            for cola in self._cebadas.values():
+                while cola and cola[0].expira_en <= ahora:
+                    vencidas.append(cola.popleft())
+        self._descartar(vencidas)
+
+    def _cebar(self, tipo: str) -> bool:
+        """Toma un cliente libre sin esperar y lo deja listo para buscar. False si no fue posible"""
+        cliente = self.pool.tomar(timeout=0)
+        if cliente is None:
+            return False
+        try:
+            cliente.formulario(tipo)
+            texto_captcha = cliente.resolver_captcha()
+        except Exception as e:
+            print(f"⚠️ Precarga SCPPP falló: {e}")
+            cliente.invalidar(tipo)
+            self.pool.devolver(cliente)
+            with self._lock:
+                self.estadisticas['fallos'] += 1
+            return False
+        
+        cebada = SesionCebada(cliente, tipo, texto_captcha, time.time() + SCPPP_PRECARGA_TTL)
+        with self._lock:
+            self._cebadas.setdefault(tipo, deque()).append(cebada)
+            self.estadisticas['cebadas'] += 1
+        return True
+
+    def _ciclo(self):
+        ahora = time.time()
+        self._purgar(ahora)
+        with self._lock:
+            faltantes = {}
+            for tipo in self._demanda:
+                faltan = self._objetivo(tipo, ahora) - len(self._cebadas.get(tipo, ()))
+                if faltan > 0:
+                    faltantes[tipo] = faltan
+            libres = self.maximo - sum(len(cola) for cola in self._cebadas.values())
+        
+        for tipo, faltan in faltantes.items():
+            for _ in range(min(faltan, libres)):
+                if not self._cebar(tipo):
+                    return
+                libres -= 1
+
+    def _bucle(self):
+        while True:
+            try:
+                self._ciclo()
+            except Exception as e:
+                print(f"❌ Error en precarga de CAPTCHAs SCPPP: {e}")
+            time.sleep(SCPPP_PRECARGA_INTERVALO)
+
+    def iniciar(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._bucle, daemon=True, name="precarga-scppp")
+            self._hilo.start()
+
+    def estado(self) -> dict:
+        ahora = time.time()
+        with self._lock:
+            return {
+                'activa': self._hilo is not None,
+                'maximo': self.maximo,
+                'por_tipo': {
+                    tipo: {
+                        'listas': len(self._cebadas.get(tipo, ())),
+                        'objetivo': self._objetivo(tipo, ahora),
+                        'consultas_por_minuto': round(self._tasa(tipo, ahora) * 60, 2)
+                    }
+                    for tipo in self._demanda
+                },
+                **self.estadisticas
+            }
+
+precarga_scppp = PrecargaCaptchasScppp(pool_clientes_scppp, SCPPP_PRECARGA_MAX)
+
+# --- FUNCIÓN DE CONSULTA SCPPP ---
+def consultar_scppp(valor: str, tipo: str = '1', cliente: ClienteScppp = None, guardar: bool = True,
+                    texto_captcha: str = None):
+    """Consulta en el sistema SCPPP (con guardar=False el llamador se encarga de la base de datos)"""
+    if cliente is None:
+        precarga_scppp.registrar_demanda(tipo)
+        cebada = precarga_scppp.tomar(tipo)
+        if cebada:
+            print("⚡ Usando sesión SCPPP con CAPTCHA precargado")
+            try:
+                return consultar_scppp(valor, tipo, cebada.cliente, guardar, cebada.texto_captcha)
+            finally:
+                pool_clientes_scppp.devolver(cebada.cliente)
+        with pool_clientes_scppp.prestar() as cliente:
+            return consultar_scppp(valor, tipo, cliente, guardar)
+    
+    try:
+        print(f"🚀 Iniciando consulta SCPPP para: {valor} (tipo: {tipo})")
+        session = cliente.session
+        
+        # Un formulario reutilizado puede haber caducado: se vuelve a cebar una sola vez.
+        # Un CAPTCHA rechazado se reintenta en la misma sesión hasta SCPPP_CAPTCHA_MAX_ENVIOS búsquedas.
+        envios = 0
+        puede_recebar = True
+        while True:
+            reutilizado = cliente.tiene_formulario(tipo)
+            try:
+                form_data = cliente.formulario(tipo)
+            except ErrorFormularioScppp as e:
+                return {"success": False, "error": str(e)}
+            
+            # PASO 4: Descargar y resolver CAPTCHA (salvo que venga precargado)
+            reportar_etapa('captcha')
+            if not texto_captcha:
+                try:
+                    texto_captcha = cliente.resolver_captcha()
+                except ErrorCaptchaScppp as e:
+                    return {"success": False, "error": str(e)}
+        
+            # PASO 5: Enviar búsqueda final
+            reportar_etapa('busqueda')
+            print(f"\n📡 PASO 4: Buscando {valor}...")
+        
+            # Determinar campo a usar según tipo de búsqueda
+            campo_busqueda = 'txtNroLicencia' if tipo == '1' else 'txtNroDocumento'
         
-        final_response = session.post(URL_BASE_SCPPP, data=search_data, headers=headers, verify=False, timeout=30)
+            search_data = {
+                '__VIEWSTATE': form_data['__VIEWSTATE'],
+                '__VIEWSTATEGENERATOR': form_data.get('__VIEWSTATEGENERATOR', '90059987'),
+                '__VIEWSTATEENCRYPTED': form_data.get('__VIEWSTATEENCRYPTED', ''),
+                '__EVENTVALIDATION': form_data['__EVENTVALIDATION'],
+                'rbtnlBuqueda': tipo,
+                campo_busqueda: valor,
+                'txtCaptcha': texto_captcha,
+                'hdCodAdministrado': '',
+                'hdNumTipoDoc': '',
+                'hdNumDocumento': '',
+                'txtNroResolucion': '',
+                'txtFechaResolucion': '',
+                'txtIniSancion': '',
+                'txtFinSancion': '',
+                'txtSancion': '',
+                'txtTipSancion': '',
+                '__EVENTTARGET': 'ibtnBusqNroDoc',
+                '__EVENTARGUMENT': '',
+                '__LASTFOCUS': '',
+                '__ASYNCPOST': 'true',
+                'ScriptManager': 'UpdatePanel|ibtnBusqNroDoc'
+            }
+        
+            final_response = session.post(URL_BASE_SCPPP, data=search_data, headers=HEADERS_AJAX_SCPPP, verify=False, timeout=30)
         
-        print(f"\n{'='*70}")
-        print(f"📊 Status Code: {final_response.status_code}")
-        print(f"📏 Respuesta: {len(final_response.text)} bytes")
-        print(f"{'='*70}")
+            print(f"\n{'='*70}")
+            print(f"📊 Status Code: {final_response.status_code}")
+            print(f"📏 Respuesta: {len(final_response.text)} bytes")
+            print(f"{'='*70}")
+            
+            envios += 1
+            texto_enviado, texto_captcha = texto_captcha, None
+            imagen_enviada = cliente.ultimo_captcha
+            
+            if reutilizado and puede_recebar and formulario_rechazado(final_response):
+                print("🔄 El servidor rechazó el formulario guardado, volviendo a cebarlo...")
+                cliente.invalidar(tipo, rechazo=True)
+                puede_recebar = False
+                continue
+            
+            if final_response.status_code == 200 and captcha_incorrecto(final_response.text):
+                cliente.estadisticas['captchas_incorrectos'] += 1
+                registrar_muestra_captcha(imagen_enviada, texto_enviado, False, 'captcha_rechazado')
+                if envios < SCPPP_CAPTCHA_MAX_ENVIOS:
+                    print(f"🔁 CAPTCHA '{texto_enviado}' rechazado por el servidor, reintentando ({envios}/{SCPPP_CAPTCHA_MAX_ENVIOS})...")
+                    continue
+                return {"success": False, "error": f"CAPTCHA rechazado en {envios} intentos"}
+            break
         
         if final_response.status_code == 500:
             return {"success": False, "error": "Error 500 del servidor"}
         
         if final_response.status_code == 200:
-            print("\n✅ CONSULTA SCPPP EXITOSA")
             resultado = analizar_resultados_scppp(final_response.text, valor)
             
+            # Una respuesta sin conductor no se guarda: dejaría campos 'No encontrado' en la tabla
+            registrar_muestra_captcha(
+                imagen_enviada, texto_enviado, not resultado_sin_datos(resultado),
+                'sin_datos' if resultado_sin_datos(resultado) else 'conductor_encontrado'
+            )
+            if resultado_sin_datos(resultado):
+                print("⚠️ La respuesta no contiene datos del conductor, no se guarda")
+                return {
+                    "success": False,
+                    "encontrado": False,
+                    "error": f"No hay registros en el SCPPP para {valor}"
+                }
+            
+            print("\n✅ CONSULTA SCPPP EXITOSA")
+            
+            if not guardar:
+                return {"success": True, "valor": valor, "datos": resultado, "base_datos": None}
+            
             # Guardar en base de datos
+            reportar_etapa('guardado')
             db_resultado = guardar_scppp_en_db(valor, resultado)
+            if db_resultado.get('success'):
+                cache_scppp.guardar(valor, {'datos': resultado, 'registro_id': db_resultado.get('registro_id')})
             
             return {
                 "success": True,
@@ -945,51 +3795,132 @@ def consultar_scppp(valor: str, tipo: str = '1'):
         print(f"\n❌ ERROR SCPPP: {e}")
         import traceback
         traceback.print_exc()
+        cliente.invalidar(tipo)
         
         return {"success": False, "error": f"Error interno: {str(e)}"}
 
+def consultar_scppp_coordinado(valor: str, tipo: str = '1') -> dict:
+    """Consulta SCPPP con un solo nodo del clúster haciendo el scraping de cada licencia/DNI"""
+    def leer_reciente(max_edad):
+        en_cache = buscar_conductor_en_cache(valor, max_edad)
+        if not en_cache:
+            return None
+        return {
+            "success": True,
+            "valor": valor,
+            "datos": en_cache['datos'],
+            "base_datos": {
+                'success': True,
+                'accion': 'otro_nodo',
+                'registro_id': en_cache['registro_id'],
+                'licencia_dni': valor
+            }
+        }
+    
+    return coordinador_nodos.ejecutar(
+        'scppp', normalizar_clave_scppp(valor, tipo), consultar_scppp, (valor, tipo), leer_reciente
+    )
+
 # ==============================================
 # SECCIÓN 5: ENDPOINTS FLASK
 # ==============================================
 
 # --- ENDPOINTS SUNARP ---
+def leer_parametros_sunarp(data: dict) -> dict:
+    """Valida el cuerpo de /sunarp/consultar. Lanza ValueError con el mensaje para el cliente"""
+    if not data or 'placa' not in data:
+        raise ValueError('Se requiere el parámetro "placa"')
+    
+    modo = data.get('modo', SUNARP_MODO_EXTRACCION)
+    if modo not in MODOS_EXTRACCION:
+        raise ValueError(f'Modo de extracción inválido: {modo} (use {", ".join(MODOS_EXTRACCION)})')
+    
+    max_edad, forzar = leer_politica_cache(data, SUNARP_CACHE_MAX_EDAD)
+    return {
+        'placa': data['placa'].strip().upper(),
+        'modo': modo,
+        'max_edad': max_edad,
+        'forzar': forzar
+    }
+
+def ejecutar_consulta_sunarp(placa: str, modo: str, max_edad: int, forzar: bool,
+                             sesion: SesionNavegador = None) -> tuple:
+    """Caché + coalescencia + scraping. Devuelve (respuesta, código HTTP)"""
+    # Servir desde la base de datos si el registro es suficientemente reciente
+    if not forzar:
+        reportar_etapa('cache')
+        registro = buscar_placa_en_cache(placa, max_edad)
+        if registro:
+            print(f"⚡ SUNARP {placa} servida desde caché ({registro['edad_segundos']}s)")
+            return respuesta_sunarp_desde_cache(registro, max_edad), 200
+    
+    print(f"\n{'='*60}")
+    print(f"🚗 NUEVA CONSULTA SUNARP: {placa}")
+    print(f"{'='*60}")
+    
+    # Ejecutar consulta. Con un navegador ya prestado (lotes) no se espera a otra consulta en vuelo:
+    # esa podría estar esperando justamente un navegador del pool
+    try:
+        if sesion is not None:
+            resultado, coalescida = consultar_sunarp_coordinado(placa, modo, sesion), False
+        else:
+            resultado, coalescida = consultas_en_vuelo.ejecutar(
+                'sunarp', normalizar_placa(placa), consultar_sunarp_coordinado, placa, modo, sesion
+            )
+    except PoolAgotadoError as e:
+        return {
+            'success': False,
+            'error': str(e),
+            'placa': placa,
+            'pool': pool_sunarp.estado()
+        }, 503
+    
+    if resultado['success']:
+        return {
+            'success': True,
+            'message': 'Consulta SUNARP realizada exitosamente',
+            'placa': placa,
+            'datos_vehiculo_texto': resultado['datos_vehiculo_texto'],
+            'datos_vehiculo_estructurado': resultado['datos_vehiculo_estructurado'],
+            'base_datos': resultado['base_datos'],
+            'estadisticas': resultado['estadisticas'],
+            'cache': {
+                'hit': False,
+                'force_refresh': forzar,
+                'max_edad_segundos': max_edad
+            },
+            'coalescida': coalescida
+        }, 200
+    else:
+        return {
+            'success': False,
+            'error': resultado.get('error', 'Error desconocido'),
+            'placa': placa,
+            'coalescida': coalescida
+        }, 500
+
 @app.route('/sunarp/consultar', methods=['POST'])
 def sunarp_consultar():
-    """Endpoint para consultar SUNARP"""
+    """Endpoint para consultar SUNARP (con "async": true devuelve un trabajo en lugar de esperar)"""
     try:
         data = request.json
         
-        if not data or 'placa' not in data:
+        try:
+            parametros = leer_parametros_sunarp(data)
+        except ValueError as e:
             return jsonify({
                 'success': False,
-                'error': 'Se requiere el parámetro "placa"'
+                'error': str(e)
             }), 400
         
-        placa = data['placa'].strip().upper()
-        
-        print(f"\n{'='*60}")
-        print(f"🚗 NUEVA CONSULTA SUNARP: {placa}")
-        print(f"{'='*60}")
+        if MODO_DESPLIEGUE == "api":
+            return consultar_en_modo_api('sunarp', parametros)
         
-        # Ejecutar consulta
-        resultado = consultar_sunarp_con_gemini(placa)
+        if es_modo_asincrono(data):
+            return encolar_trabajo('sunarp', ejecutar_consulta_sunarp, parametros)
         
-        if resultado['success']:
-            return jsonify({
-                'success': True,
-                'message': 'Consulta SUNARP realizada exitosamente',
-                'placa': placa,
-                'datos_vehiculo_texto': resultado['datos_vehiculo_texto'],
-                'datos_vehiculo_estructurado': resultado['datos_vehiculo_estructurado'],
-                'base_datos': resultado['base_datos'],
-                'estadisticas': resultado['estadisticas']
-            }), 200
-        else:
-            return jsonify({
-                'success': False,
-                'error': resultado.get('error', 'Error desconocido'),
-                'placa': placa
-            }), 500
+        respuesta, codigo = ejecutar_consulta_sunarp(**parametros)
+        return jsonify(respuesta), codigo
             
     except Exception as e:
         return jsonify({
@@ -997,6 +3928,156 @@ def sunarp_consultar():
             'error': f'Error interno: {str(e)}'
         }), 500
 
+# --- CONSULTA SUNARP POR LOTES ---
+SUNARP_LOTE_MAX_PLACAS = 500                   # Placas máximas por solicitud
+# Navegadores del pool que un lote puede ocupar a la vez: uno queda libre para /sunarp/consultar
+SUNARP_LOTE_NAVEGADORES = max(1, SUNARP_POOL_TAMANO - 1)
+
+def leer_parametros_sunarp_lote(data: dict) -> dict:
+    """Valida el cuerpo de /sunarp/consultar/lote. Lanza ValueError con el mensaje para el cliente"""
+    if not data or not isinstance(data.get('placas'), list) or not data['placas']:
+        raise ValueError('Se requiere el parámetro "placas" (lista no vacía)')
+    if len(data['placas']) > SUNARP_LOTE_MAX_PLACAS:
+        raise ValueError(f'Máximo {SUNARP_LOTE_MAX_PLACAS} placas por lote')
+    if not all(isinstance(placa, str) and placa.strip() for placa in data['placas']):
+        raise ValueError('Cada placa debe ser un texto no vacío')
+    
+    parametros = leer_parametros_sunarp({**data, 'placa': ''})
+    del parametros['placa']
+    parametros['placas'] = [placa.strip().upper() for placa in data['placas']]
+    return parametros
+
+def consultar_sunarp_lote(placas: list, modo: str, max_edad: int, forzar: bool):
+    """Genera (índice, respuesta, código HTTP) a medida que termina cada placa.
+    
+    Las placas en caché salen primero; el resto se reparte entre hasta SUNARP_LOTE_NAVEGADORES
+    navegadores, y cada uno consulta varias placas seguidas reutilizando la página.
+    """
+    pendientes = queue.Queue()
+    for indice, placa in enumerate(placas):
+        if not forzar:
+            registro = buscar_placa_en_cache(placa, max_edad)
+            if registro:
+                yield indice, respuesta_sunarp_desde_cache(registro, max_edad), 200
+                continue
+        pendientes.put((indice, placa))
+    
+    hilos = min(SUNARP_LOTE_NAVEGADORES, pendientes.qsize())
+    if hilos == 0:
+        return
+    
+    resultados = queue.Queue()
+    cancelado = threading.Event()   # El cliente cerró la conexión: no tomar más placas
+    lock = threading.Lock()
+    activos = [hilos]
+    
+    def tomar():
+        if cancelado.is_set():
+            return None
+        try:
+            return pendientes.get_nowait()
+        except queue.Empty:
+            return None
+    
+    def consultar(sesion, indice, placa):
+        try:
+            respuesta, codigo = ejecutar_consulta_sunarp(placa, modo, max_edad, forzar, sesion=sesion)
+        except Exception as e:
+            print(f"❌ Error en lote SUNARP ({placa}): {e}")
+            respuesta, codigo = {'success': False, 'error': str(e), 'placa': placa}, 500
+        resultados.put((indice, respuesta, codigo))
+    
+    def trabajador():
+        try:
+            while not pendientes.empty() and not cancelado.is_set():
+                with pool_sunarp.prestar() as sesion:
+                    siguiente = tomar()
+                    while siguiente:
+                        consultar(sesion, *siguiente)
+                        # devolver() recicla o recarga el navegador; aquí solo se cuentan las placas extra
+                        if sesion.reciclar or sesion.usos + 1 >= pool_sunarp.max_usos:
+                            break
+                        siguiente = tomar()
+                        if siguiente:
+                            sesion.usos += 1
+        except PoolAgotadoError as e:
+            error = str(e)
+        except Exception as e:
+            print(f"❌ Error en trabajador del lote SUNARP: {e}")
+            error = str(e)
+        else:
+            error = 'No hay navegadores disponibles para el lote'
+        finally:
+            with lock:
+                activos[0] -= 1
+                ultimo = activos[0] == 0
+            # Mientras quede otro navegador del lote, él termina las placas pendientes;
+            # el último en salir responde 503 por las que nadie alcanzó a consultar
+            while ultimo:
+                siguiente = tomar()
+                if not siguiente:
+                    break
+                indice, placa = siguiente
+                resultados.put((indice, {'success': False, 'error': error, 'placa': placa}, 503))
+            resultados.put(None)
+    
+    print(f"📦 Lote SUNARP: {len(placas)} placas, {pendientes.qsize()} por consultar con {hilos} navegador(es)")
+    for _ in range(hilos):
+        threading.Thread(target=trabajador, daemon=True).start()
+    
+    terminados = 0
+    try:
+        while terminados < hilos:
+            item = resultados.get()
+            if item is None:
+                terminados += 1
+            else:
+                yield item
+    finally:
+        cancelado.set()
+
+def respuesta_ndjson(resultados):
+    """Transmite cada (índice, respuesta, código) como una línea JSON apenas está disponible"""
+    def generar():
+        for indice, respuesta, codigo in resultados:
+            yield json.dumps({'indice': indice, 'codigo_http': codigo, **respuesta}, default=str) + "\n"
+    return Response(stream_with_context(generar()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/sunarp/consultar/lote', methods=['POST'])
+def sunarp_consultar_lote():
+    """Consulta una lista de placas y devuelve NDJSON, una línea por placa en orden de llegada"""
+    try:
+        parametros = leer_parametros_sunarp_lote(request.json)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    if MODO_DESPLIEGUE == "api":
+        return respuesta_ndjson(encolar_lote_en_modo_api('sunarp', 'placa', parametros.pop('placas'), parametros))
+    return respuesta_ndjson(consultar_sunarp_lote(**parametros))
+
+@app.route('/sunarp/pool', methods=['GET'])
+def sunarp_estado_pool():
+    """Ocupación y estadísticas del pool de navegadores SUNARP"""
+    return jsonify({
+        'success': True,
+        'pool': pool_sunarp.estado()
+    })
+
+@app.route('/gemini/modelos', methods=['GET'])
+def gemini_estado_modelos():
+    """Latencias, fallos y enfriamiento de cada modelo Gemini"""
+    return jsonify({
+        'success': True,
+        'orden': registro_gemini.orden,
+        'timeout': registro_gemini.timeout,
+        'modelos': registro_gemini.estado(),
+        'enrutamiento': estado_enrutamiento()
+    })
+
 @app.route('/sunarp/placas', methods=['GET'])
 def sunarp_listar_placas():
     """Lista todas las placas registradas en SUNARP"""
@@ -1190,38 +4271,119 @@ def sunarp_obtener_estadisticas():
         }), 500
 
 # --- ENDPOINTS SCPPP ---
+def leer_parametros_scppp(data: dict) -> dict:
+    """Valida el cuerpo de /scppp/consultar. Lanza ValueError con el mensaje para el cliente"""
+    if not data or 'valor' not in data:
+        raise ValueError('Se requiere el parámetro "valor" (licencia o DNI)')
+    
+    max_edad, forzar = leer_politica_cache(data, SCPPP_CACHE_MAX_EDAD)
+    return {
+        'valor': data['valor'],
+        'tipo': data.get('tipo', '1'),  # 1=Licencia, 0=Documento
+        'max_edad': max_edad,
+        'forzar': forzar
+    }
+
+def respuesta_scppp_desde_cache(valor: str, max_edad: int) -> dict:
+    """Respuesta de /scppp/consultar servida desde caché, o None si no hay un resultado reciente"""
+    en_cache = buscar_conductor_en_cache(valor, max_edad)
+    if not en_cache:
+        return None
+    print(f"⚡ SCPPP {valor} servido desde caché ({en_cache['origen']}, {en_cache['edad_segundos']}s)")
+    return {
+        'success': True,
+        'message': 'Consulta SCPPP servida desde caché',
+        'valor': valor,
+        'datos': en_cache['datos'],
+        'base_datos': {
+            'success': True,
+            'accion': 'cache',
+            'registro_id': en_cache['registro_id'],
+            'licencia_dni': valor
+        },
+        'cache': {
+            'hit': True,
+            'origen': en_cache['origen'],
+            'edad_segundos': en_cache['edad_segundos'],
+            'max_edad_segundos': max_edad
+        }
+    }
+
+def ejecutar_consulta_scppp(valor: str, tipo: str, max_edad: int, forzar: bool) -> tuple:
+    """Caché + coalescencia + consulta al MTC. Devuelve (respuesta, código HTTP)"""
+    # Servir desde caché (memoria o tabla) si el conductor se consultó hace poco
+    if not forzar:
+        reportar_etapa('cache')
+        respuesta = respuesta_scppp_desde_cache(valor, max_edad)
+        if respuesta:
+            return respuesta, 200
+    
+    # Ejecutar consulta SCPPP (una sola por licencia/DNI en vuelo)
+    try:
+        resultado, coalescida = consultas_en_vuelo.ejecutar(
+            'scppp', normalizar_clave_scppp(valor, tipo), consultar_scppp_coordinado, valor, tipo
+        )
+    except PoolAgotadoError as e:
+        return {
+            'success': False,
+            'error': str(e),
+            'valor': valor,
+            'pool': pool_clientes_scppp.estado()
+        }, 503
+    
+    if resultado['success']:
+        return {
+            'success': True,
+            'message': 'Consulta SCPPP realizada y guardada en base de datos',
+            'valor': valor,
+            'datos': resultado['datos'],
+            'base_datos': resultado['base_datos'],
+            'cache': {
+                'hit': False,
+                'force_refresh': forzar,
+                'max_edad_segundos': max_edad
+            },
+            'coalescida': coalescida
+        }, 200
+    elif resultado.get('encontrado') is False:
+        # Búsqueda correcta sin conductor: no es un error del servidor ni se reintenta
+        return {
+            'success': False,
+            'encontrado': False,
+            'error': resultado['error'],
+            'valor': valor,
+            'coalescida': coalescida
+        }, 404
+    else:
+        return {
+            'success': False,
+            'error': resultado.get('error', 'Error desconocido en SCPPP'),
+            'valor': valor,
+            'coalescida': coalescida
+        }, 500
+
 @app.route('/scppp/consultar', methods=['POST'])
 def scppp_consultar():
-    """Endpoint principal para consultar en el SCPPP"""
+    """Endpoint principal para consultar en el SCPPP (con "async": true devuelve un trabajo)"""
     try:
         data = request.json
         
-        if not data or 'valor' not in data:
+        try:
+            parametros = leer_parametros_scppp(data)
+        except ValueError as e:
             return jsonify({
                 'success': False,
-                'error': 'Se requiere el parámetro "valor" (licencia o DNI)'
+                'error': str(e)
             }), 400
         
-        valor = data['valor']
-        tipo = data.get('tipo', '1')  # 1=Licencia, 0=Documento
+        if MODO_DESPLIEGUE == "api":
+            return consultar_en_modo_api('scppp', parametros)
         
-        # Ejecutar consulta SCPPP
-        resultado = consultar_scppp(valor, tipo)
+        if es_modo_asincrono(data):
+            return encolar_trabajo('scppp', ejecutar_consulta_scppp, parametros)
         
-        if resultado['success']:
-            return jsonify({
-                'success': True,
-                'message': 'Consulta SCPPP realizada y guardada en base de datos',
-                'valor': valor,
-                'datos': resultado['datos'],
-                'base_datos': resultado['base_datos']
-            }), 200
-        else:
-            return jsonify({
-                'success': False,
-                'error': resultado.get('error', 'Error desconocido en SCPPP'),
-                'valor': valor
-            }), 500
+        respuesta, codigo = ejecutar_consulta_scppp(**parametros)
+        return jsonify(respuesta), codigo
         
     except Exception as e:
         return jsonify({
@@ -1229,6 +4391,135 @@ def scppp_consultar():
             'error': f'Error interno SCPPP: {str(e)}'
         }), 500
 
+# --- CONSULTA SCPPP POR LOTES ---
+SCPPP_LOTE_MAX = 500               # Licencias/DNIs máximos por solicitud
+SCPPP_LOTE_ESCRITURA = 25          # Conductores por escritura agrupada en scppp_conductores
+
+def leer_parametros_scppp_lote(data: dict) -> dict:
+    """Valida el cuerpo de /scppp/consultar/lote. Lanza ValueError con el mensaje para el cliente"""
+    if not data or not isinstance(data.get('valores'), list) or not data['valores']:
+        raise ValueError('Se requiere el parámetro "valores" (lista no vacía de licencias o DNIs)')
+    if len(data['valores']) > SCPPP_LOTE_MAX:
+        raise ValueError(f'Máximo {SCPPP_LOTE_MAX} valores por lote')
+    if not all(isinstance(valor, str) and valor.strip() for valor in data['valores']):
+        raise ValueError('Cada valor debe ser un texto no vacío')
+    
+    parametros = leer_parametros_scppp({**data, 'valor': ''})
+    del parametros['valor']
+    parametros['valores'] = [valor.strip() for valor in data['valores']]
+    return parametros
+
+def consultar_scppp_lote(valores: list, tipo: str, max_edad: int, forzar: bool):
+    """Genera (índice, respuesta, código HTTP) a medida que termina cada licencia/DNI.
+    
+    Los conductores en caché salen primero; el resto se consulta en paralelo sobre
+    pool_clientes_scppp (una vez por valor repetido) y se guarda de a SCPPP_LOTE_ESCRITURA
+    por escritura. Las líneas de un grupo se emiten después de guardarlo, con el resultado real.
+    """
+    pendientes = {}     # valor -> índices del lote que lo piden
+    for indice, valor in enumerate(valores):
+        if not forzar:
+            respuesta = respuesta_scppp_desde_cache(valor, max_edad)
+            if respuesta:
+                yield indice, respuesta, 200
+                continue
+        pendientes.setdefault(valor, []).append(indice)
+    
+    if not pendientes:
+        return
+    
+    def consultar(valor):
+        return consultar_scppp(valor, tipo, guardar=False)
+    
+    def respuesta_guardada(valor, datos, db_lote):
+        if not db_lote['success']:
+            base_datos = {'success': False, 'error': db_lote['error'], 'licencia_dni': valor}
+        elif valor in db_lote['registro_ids']:
+            base_datos = {
+                'success': True,
+                'accion': 'escritura_en_lote',
+                'registro_id': db_lote['registro_ids'][valor],
+                'licencia_dni': valor
+            }
+        else:
+            base_datos = {'success': False, 'error': 'Conductor eliminado lógicamente, no se actualiza', 'licencia_dni': valor}
+        return {
+            'success': True,
+            'message': 'Consulta SCPPP realizada',
+            'valor': valor,
+            'datos': datos,
+            'base_datos': base_datos,
+            'cache': {
+                'hit': False,
+                'force_refresh': forzar,
+                'max_edad_segundos': max_edad
+            }
+        }
+    
+    def guardar_grupo(grupo):
+        db_lote = guardar_scppp_lote_en_db(grupo)
+        for valor, datos in grupo:
+            respuesta = respuesta_guardada(valor, datos, db_lote)
+            for indice in pendientes[valor]:
+                yield indice, respuesta, 200
+    
+    print(f"📦 Lote SCPPP: {len(valores)} valores, {len(pendientes)} distintos por consultar")
+    por_guardar = []
+    executor = ThreadPoolExecutor(max_workers=min(SCPPP_CLIENTES, len(pendientes)), thread_name_prefix="lote-scppp")
+    futuros = {executor.submit(consultar, valor): valor for valor in pendientes}
+    try:
+        for futuro in as_completed(futuros):
+            valor = futuros[futuro]
+            codigo = 500
+            try:
+                resultado = futuro.result()
+            except PoolAgotadoError as e:
+                resultado, codigo = {'success': False, 'error': str(e)}, 503
+            except Exception as e:
+                resultado = {'success': False, 'error': f'Error interno: {str(e)}'}
+            
+            if not resultado['success']:
+                respuesta = {
+                    'success': False,
+                    'error': resultado.get('error', 'Error desconocido en SCPPP'),
+                    'valor': valor
+                }
+                if resultado.get('encontrado') is False:
+                    respuesta['encontrado'] = False
+                    codigo = 404
+                for indice in pendientes[valor]:
+                    yield indice, respuesta, codigo
+                continue
+            
+            por_guardar.append((valor, resultado['datos']))
+            if len(por_guardar) >= SCPPP_LOTE_ESCRITURA:
+                grupo, por_guardar = por_guardar, []
+                yield from guardar_grupo(grupo)
+        
+        if por_guardar:
+            grupo, por_guardar = por_guardar, []
+            yield from guardar_grupo(grupo)
+    finally:
+        # Si el cliente se desconecta no se lanzan las consultas que faltan, pero se guarda lo obtenido
+        executor.shutdown(wait=False, cancel_futures=True)
+        if por_guardar:
+            guardar_scppp_lote_en_db(por_guardar)
+
+@app.route('/scppp/consultar/lote', methods=['POST'])
+def scppp_consultar_lote():
+    """Consulta una lista de licencias/DNIs y devuelve NDJSON, una línea por valor en orden de llegada"""
+    try:
+        parametros = leer_parametros_scppp_lote(request.json)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    if MODO_DESPLIEGUE == "api":
+        return respuesta_ndjson(encolar_lote_en_modo_api('scppp', 'valor', parametros.pop('valores'), parametros))
+    return respuesta_ndjson(consultar_scppp_lote(**parametros))
+
 @app.route('/scppp/conductores', methods=['GET'])
 def scppp_listar_conductores():
     """Lista todos los conductores registrados en SCPPP"""
@@ -1326,6 +4617,7 @@ def scppp_obtener_conductor(licencia_dni):
 @app.route('/scppp/conductores/<licencia_dni>', methods=['DELETE'])
 def scppp_eliminar_conductor(licencia_dni):
     """Elimina lógicamente un conductor SCPPP (soft delete)"""
+    cache_scppp.invalidar(licencia_dni)
     try:
         with app.app_context():
             cur = mysql.connection.cursor()
@@ -1430,6 +4722,107 @@ def scppp_obtener_estadisticas():
             'error': f'Error obteniendo estadísticas SCPPP: {str(e)}'
         }), 500
 
+# --- ENDPOINTS DE TRABAJOS ASÍNCRONOS ---
+cola_trabajos.registrar_funcion('sunarp', ejecutar_consulta_sunarp)
+cola_trabajos.registrar_funcion('scppp', ejecutar_consulta_scppp)
+
+def estado_trabajos() -> dict:
+    if TRABAJOS_BACKEND == "mysql":
+        try:
+            return cola_trabajos.estado()
+        except Exception as e:
+            return {'backend': 'mysql', 'error': str(e)}
+    return {'backend': 'memoria', **gestor_trabajos.estado()}
+
+def es_modo_asincrono(data: dict) -> bool:
+    valor = data.get('async', request.args.get('async', False))
+    if isinstance(valor, str):
+        return valor.strip().lower() in ('1', 'true', 'si', 'sí', 'yes')
+    return bool(valor)
+
+def encolar_trabajo(fuente: str, funcion, parametros: dict):
+    """Encola la consulta y responde 202 con el id del trabajo"""
+    try:
+        if TRABAJOS_BACKEND == "mysql":
+            trabajo = cola_trabajos.encolar(fuente, parametros)
+        else:
+            trabajo = gestor_trabajos.crear(fuente, funcion, parametros)
+    except TrabajosSaturadosError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'trabajos': estado_trabajos()
+        }), 503
+    return jsonify({
+        'success': True,
+        'message': f'Consulta {fuente.upper()} encolada',
+        'job_id': trabajo['id'],
+        'estado': trabajo['estado'],
+        'url': f"/jobs/{trabajo['id']}"
+    }), 202
+
+# --- MODO API: CACHÉ O COLA PARA LOS PROCESOS SCRAPER ---
+def respuesta_desde_cache(fuente: str, parametros: dict) -> dict:
+    """Respuesta servida desde la base de datos sin scraping, o None"""
+    if parametros['forzar']:
+        return None
+    if fuente == 'sunarp':
+        registro = buscar_placa_en_cache(parametros['placa'], parametros['max_edad'])
+        return respuesta_sunarp_desde_cache(registro, parametros['max_edad']) if registro else None
+    return respuesta_scppp_desde_cache(parametros['valor'], parametros['max_edad'])
+
+def consultar_en_modo_api(fuente: str, parametros: dict):
+    """Sirve desde caché si se puede; si no, deja la consulta en trabajos_consulta y responde 202"""
+    respuesta = respuesta_desde_cache(fuente, parametros)
+    if respuesta:
+        return jsonify(respuesta), 200
+    return encolar_trabajo(fuente, None, parametros)
+
+def encolar_lote_en_modo_api(fuente: str, campo: str, claves: list, parametros: dict):
+    """Genera (índice, respuesta, código): caché o un trabajo encolado por cada elemento del lote"""
+    for indice, clave in enumerate(claves):
+        parametros_item = {campo: clave, **parametros}
+        respuesta = respuesta_desde_cache(fuente, parametros_item)
+        if respuesta:
+            yield indice, respuesta, 200
+            continue
+        try:
+            trabajo = cola_trabajos.encolar(fuente, parametros_item)
+        except Exception as e:
+            yield indice, {'success': False, 'error': f'Error encolando: {str(e)}', campo: clave}, 500
+            continue
+        yield indice, {
+            'success': True,
+            'message': f'Consulta {fuente.upper()} encolada',
+            campo: clave,
+            'job_id': trabajo['id'],
+            'estado': trabajo['estado'],
+            'url': f"/jobs/{trabajo['id']}"
+        }, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def obtener_trabajo(job_id):
+    """Estado, etapas y resultado de un trabajo asíncrono"""
+    try:
+        if TRABAJOS_BACKEND == "mysql":
+            trabajo = cola_trabajos.obtener(job_id)
+        else:
+            trabajo = gestor_trabajos.obtener(job_id)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Error obteniendo trabajo: {str(e)}'
+        }), 500
+    if not trabajo:
+        return jsonify({
+            'success': False,
+            'error': f'Trabajo {job_id} no encontrado'
+        }), 404
+    return jsonify({
+        'success': True,
+        'trabajo': trabajo
+    })
+
 # --- ENDPOINTS COMUNES ---
 @app.route('/estado', methods=['GET'])
 def estado():
@@ -1459,9 +4852,17 @@ def estado():
                     'total_registros': total_sunarp + total_scppp
                 },
                 'apis': {
-                    'gemini': 'configurada',
-                    'easyocr': 'listo'
+                    'gemini': 'configurada' if _gemini_configurado else 'sin_configurar',
+                    'easyocr': 'servidor_ocr' if OCR_SERVIDOR_ACTIVO else ('listo' if reader is not None else 'sin_cargar')
                 },
+                'modo_despliegue': MODO_DESPLIEGUE,
+                'modulos_cargados': sorted(_modulos_diferidos),
+                'pool_sunarp': pool_sunarp.estado(),
+                'pool_scppp': pool_clientes_scppp.estado(),
+                'precarga_scppp': precarga_scppp.estado(),
+                'consultas_en_vuelo': consultas_en_vuelo.estado(),
+                'coordinacion_nodos': coordinador_nodos.estado(),
+                'trabajos': estado_trabajos(),
                 'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             })
     except Exception as e:
@@ -1483,26 +4884,174 @@ def estado():
 # SECCIÓN 6: INICIALIZACIÓN DEL SERVIDOR
 # ==============================================
 
-# Crear tablas al inicio
-print("🔧 Creando tablas en la base de datos...")
-crear_tablas_mysql()
+# --- INICIALIZACIÓN DIFERIDA ---
+# Importar el módulo no toca la base de datos ni carga dependencias pesadas: las tablas se
+# verifican en la primera petición y el scraping se prepara en la primera consulta.
+RUTAS_SCRAPING = ('/sunarp/consultar', '/scppp/consultar')
+
+_inicializacion_lock = threading.Lock()
+_tablas_verificadas = False
+_scraping_iniciado = False
+
+def asegurar_tablas():
+    """crear_tablas_mysql() una sola vez por proceso"""
+    global _tablas_verificadas
+    with _inicializacion_lock:
+        if not _tablas_verificadas:
+            print("🔧 Creando tablas en la base de datos...")
+            crear_tablas_mysql()
+            _tablas_verificadas = True
+
+def iniciar_scraping():
+    """Modelos Gemini, pool de navegadores SUNARP y precarga de CAPTCHAs SCPPP (en segundo plano)"""
+    global _scraping_iniciado
+    with _inicializacion_lock:
+        if _scraping_iniciado:
+            return
+        _scraping_iniciado = True
+    
+    threading.Thread(target=registro_gemini.precargar, daemon=True).start()
+    
+    # Precalentar el pool de navegadores SUNARP en segundo plano
+    if SUNARP_POOL_PRECALENTAR:
+        print(f"🔧 Precalentando pool SUNARP ({SUNARP_POOL_TAMANO} navegadores)...")
+        threading.Thread(target=pool_sunarp.calentar, daemon=True).start()
+    
+    # Precargar sesiones SCPPP con CAPTCHA resuelto según la demanda reciente
+    if SCPPP_PRECARGA_ACTIVA:
+        precarga_scppp.iniciar()
+
+@app.before_request
+def inicializar_en_primer_uso():
+    asegurar_tablas()
+    if MODO_DESPLIEGUE == "completo" and request.path.startswith(RUTAS_SCRAPING):
+        iniciar_scraping()
+
+def cargar_dependencias_scraping():
+    """Importa todo lo que usa una consulta (sin abrir navegadores ni llamar a servicios externos)"""
+    for nombre in ('numpy', 'bs4', 'seleniumbase', 'google.generativeai'):
+        importar_diferido(nombre)
+    if not OCR_SERVIDOR_ACTIVO:
+        obtener_lector_easyocr()
+
+# --- BENCHMARK DE ARRANQUE ---
+SCRIPT_BENCHMARK_ARRANQUE = """
+import json, resource, sys, time
+inicio = time.perf_counter()
+modulo = __import__(sys.argv[1])
+segundos_importacion = time.perf_counter() - inicio
+rss_importado = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+segundos_carga = None
+if sys.argv[2] == 'scraping':
+    inicio = time.perf_counter()
+    modulo.cargar_dependencias_scraping()
+    segundos_carga = time.perf_counter() - inicio
+print(json.dumps({
+    'segundos_importacion': round(segundos_importacion, 3),
+    'segundos_carga_scraping': round(segundos_carga, 3) if segundos_carga is not None else None,
+    'rss_importado_mb': round(rss_importado / 1024, 1),
+    'rss_max_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+}))
+"""
+
+def benchmark_arranque(repeticiones: int = 3) -> dict:
+    """Mide, en procesos nuevos, importación y RSS del camino de solo lectura contra el de scraping"""
+    directorio = os.path.dirname(os.path.abspath(__file__))
+    nombre_modulo = os.path.splitext(os.path.basename(__file__))[0]
+    resultados = {}
+    for camino in ('solo_lectura', 'scraping'):
+        mediciones = []
+        for _ in range(repeticiones):
+            proceso = subprocess.run(
+                [sys.executable, '-c', SCRIPT_BENCHMARK_ARRANQUE, nombre_modulo, camino],
+                cwd=directorio, capture_output=True, text=True
+            )
+            if proceso.returncode != 0:
+                raise RuntimeError(f"Falló el arranque '{camino}': {proceso.stderr.strip()[-500:]}")
+            mediciones.append(json.loads(proceso.stdout.strip().splitlines()[-1]))
+        resultados[camino] = {
+            clave: min(m[clave] for m in mediciones) if mediciones[0][clave] is not None else None
+            for clave in mediciones[0]
+        }
+        print(f"\n⏱️ Camino {camino} (mejor de {repeticiones}):")
+        for clave, valor in resultados[camino].items():
+            print(f"   {clave}: {valor}")
+    return resultados
+
+# Comandos de línea que trabajan sin red ni base de datos
+COMANDOS_FUERA_DE_LINEA = ("benchmark-captcha", "entrenar-captcha", "ocr-servidor", "benchmark-arranque")
+COMANDO = sys.argv[1] if __name__ == "__main__" and len(sys.argv) > 1 else None
+
+# Con debug=True Werkzeug relanza este script: el proceso vigilante no atiende peticiones,
+# solo el hijo (WERKZEUG_RUN_MAIN=true) debe abrir navegadores y precargar CAPTCHAs
+RECARGADOR_ACTIVO = True
+PROCESO_SIRVE = (not RECARGADOR_ACTIVO or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+                 or COMANDO in ("worker", "scraper"))
+
+if __name__ == "__main__" and COMANDO not in COMANDOS_FUERA_DE_LINEA:
+    # El servidor completo y los workers arrancan con todo listo para consultar
+    asegurar_tablas()
+    if MODO_DESPLIEGUE != "api" and PROCESO_SIRVE:
+        iniciar_scraping()
+
+if COMANDO == "benchmark-arranque":
+    # python flask_mix.py benchmark-arranque [repeticiones]
+    benchmark_arranque(int(sys.argv[2]) if len(sys.argv) > 2 else 3)
+    sys.exit(0)
+
+if COMANDO == "benchmark-captcha":
+    # python flask_mix.py benchmark-captcha [solucionador,...] [directorio]
+    benchmark_captcha(
+        sys.argv[2].split(',') if len(sys.argv) > 2 else list(SOLUCIONADORES_CAPTCHA),
+        sys.argv[3] if len(sys.argv) > 3 else CAPTCHA_CORPUS_DIR
+    )
+    sys.exit(0)
+
+if COMANDO == "ocr-servidor":
+    # python flask_mix.py ocr-servidor - único proceso con EasyOCR para todos los workers
+    ServidorOCR(OCR_SOCKET, OCR_LOTE_ESPERA, OCR_LOTE_MAX).servir()
+    sys.exit(0)
+
+if COMANDO == "entrenar-captcha":
+    # python flask_mix.py entrenar-captcha [directorio] - centroides a partir de las muestras correctas
+    entrenar_captcha_desde_corpus(sys.argv[2] if len(sys.argv) > 2 else CAPTCHA_CORPUS_DIR)
+    sys.exit(0)
+
+if COMANDO == "worker":
+    # python flask_mix.py worker [hilos] - consume la cola durable trabajos_consulta
+    cola_trabajos.ejecutar_worker(int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+
+if COMANDO == "scraper":
+    # python flask_mix.py scraper [hilos] - worker con los límites de LIMITES_MODO['scraper']
+    limites = LIMITES_MODO['scraper']
+    cola_trabajos.ejecutar_worker(
+        int(sys.argv[2]) if len(sys.argv) > 2 else limites['hilos'],
+        rss_max_mb=limites['rss_max_mb'],
+        trabajos_max=limites['trabajos_max']
+    )
+    sys.exit(0)
 
 if __name__ == "__main__":
-    print("🚀 Iniciando servidor Flask API Combinada SUNARP + SCPPP...")
+    print(f"🚀 Iniciando servidor Flask API Combinada SUNARP + SCPPP (modo {MODO_DESPLIEGUE})...")
     print("📌 Endpoints SUNARP disponibles:")
     print("   POST /sunarp/consultar      - Consultar vehículo en SUNARP")
     print("   GET  /sunarp/placas         - Listar todas las placas SUNARP")
     print("   GET  /sunarp/placas/<placa> - Obtener placa específica SUNARP")
     print("   DELETE /sunarp/placas/<placa> - Eliminar placa SUNARP")
     print("   GET  /sunarp/estadisticas   - Estadísticas SUNARP")
+    print("   POST /sunarp/consultar/lote - Consultar lista de placas (respuesta NDJSON)")
+    print("   GET  /sunarp/pool           - Ocupación del pool de navegadores")
+    print("   GET  /gemini/modelos        - Latencias y fallos de los modelos Gemini")
     print("\n📌 Endpoints SCPPP disponibles:")
     print("   POST /scppp/consultar           - Consultar conductor en SCPPP")
+    print("   POST /scppp/consultar/lote      - Consultar lista de licencias/DNIs (respuesta NDJSON)")
     print("   GET  /scppp/conductores         - Listar todos los conductores SCPPP")
     print("   GET  /scppp/conductores/<id>    - Obtener conductor específico SCPPP")
     print("   DELETE /scppp/conductores/<id>  - Eliminar conductor SCPPP")
     print("   GET  /scppp/estadisticas        - Estadísticas SCPPP")
     print("\n📌 Endpoints comunes:")
     print("   GET  /estado                   - Estado del servicio completo")
+    print("   GET  /jobs/<id>                - Estado y resultado de una consulta asíncrona")
     print(f"\n🔗 Servidor en: http://localhost:5000")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=RECARGADOR_ACTIVO)
\ No newline at end of file